@@ -1,6 +1,10 @@
 from fathomapi.api.handler import handler as fathom_handler
 from fathomapi.api.flask_app import app
 import json
+import os
+import time
+
+from concurrency import set_request_deadline
 
 from routes.accessory import app as accessory_routes
 from routes.sensor import app as sensor_routes
@@ -11,9 +15,13 @@ app.register_blueprint(sensor_routes, url_prefix='/sensor')
 app.register_blueprint(firmware_routes, url_prefix='/firmware')
 app.register_blueprint(misc_routes, url_prefix='/misc')
 
+# Leave enough time at the end of the invocation to return whatever we have
+REQUEST_DEADLINE_MARGIN = float(os.environ.get('REQUEST_DEADLINE_MARGIN', 1))
+
 
 def handler(event, context):
     print(json.dumps(event))
+    set_request_deadline(time.monotonic() + context.get_remaining_time_in_millis() / 1000 - REQUEST_DEADLINE_MARGIN)
     ret = fathom_handler(event, context)
     print(json.dumps(ret))
     return ret
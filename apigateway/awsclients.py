@@ -0,0 +1,134 @@
+from botocore.config import Config as BotocoreConfig
+import boto3
+import botocore
+import os
+import threading
+
+# Clients are created lazily, once per container, and shared across invocations and threads.  Resources (and their
+# Table objects) aren't thread-safe, so each thread has its own.
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_thread_state = threading.local()
+# Incremented by `reset()`, to discard every thread's resources
+_generation = 0
+_stand_ins = {}
+
+
+def _get_botocore_config():
+    kwargs = {
+        'max_pool_connections': int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 25)),
+        'connect_timeout': float(os.environ.get('AWS_CONNECT_TIMEOUT', 2)),
+        'read_timeout': float(os.environ.get('AWS_READ_TIMEOUT', 10)),
+        'retries': {
+            'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', 3)),
+            'mode': os.environ.get('AWS_RETRY_MODE', 'standard'),
+        },
+    }
+    if _supports_tcp_keepalive(botocore.__version__):
+        kwargs['tcp_keepalive'] = True
+    return BotocoreConfig(**kwargs)
+
+
+def _supports_tcp_keepalive(botocore_version):
+    """
+    Botocore added `tcp_keepalive` in 1.27.0, which needs Python 3.7; the last release for Python 3.6 rejects it
+    :param str botocore_version: eg `1.26.10`
+    :return: bool
+    """
+    try:
+        return tuple(int(part) for part in botocore_version.split('.')[:2]) >= (1, 27)
+    except ValueError:
+        return False
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def get_client(service_name, region_name=None):
+    """
+    Get a shared low-level client for an AWS service
+    :param str service_name: eg `cognito-idp`
+    :param str region_name: defaults to the region the Lambda is running in
+    :return: botocore.client.BaseClient
+    """
+    if service_name in _stand_ins:
+        return _stand_ins[service_name]
+    key = (service_name, region_name)
+    if key not in _clients:
+        with _lock:
+            if key not in _clients:
+                _clients[key] = _get_session().client(service_name, region_name=region_name, config=_get_botocore_config())
+    return _clients[key]
+
+
+def get_resource(service_name, region_name=None):
+    """
+    Get a resource for an AWS service, shared by everything running on the current thread
+    :param str service_name: eg `dynamodb`
+    :param str region_name: defaults to the region the Lambda is running in
+    :return: boto3.resources.base.ServiceResource
+    """
+    if service_name in _stand_ins:
+        return _stand_ins[service_name]
+    resources, _ = _get_thread_caches()
+    key = (service_name, region_name)
+    if key not in resources:
+        # The session is shared, and isn't thread-safe either
+        with _lock:
+            resources[key] = _get_session().resource(service_name, region_name=region_name, config=_get_botocore_config())
+    return resources[key]
+
+
+def get_table(table_name):
+    """
+    Get a DynamoDB Table resource, shared by everything running on the current thread
+    :param str table_name:
+    :return: boto3.resources.factory.dynamodb.Table
+    """
+    if 'dynamodb' in _stand_ins:
+        return _stand_ins['dynamodb'].Table(table_name)
+    _, tables = _get_thread_caches()
+    if table_name not in tables:
+        tables[table_name] = get_resource('dynamodb').Table(table_name)
+    return tables[table_name]
+
+
+def _get_thread_caches():
+    """
+    :return: (dict, dict) the current thread's resources and tables
+    """
+    if getattr(_thread_state, 'generation', None) != _generation:
+        _thread_state.generation = _generation
+        _thread_state.resources = {}
+        _thread_state.tables = {}
+    return _thread_state.resources, _thread_state.tables
+
+
+def set_stand_in(service_name, stand_in):
+    """
+    Replace the client and resource for a service, eg with a local DynamoDB resource or a stub, for testing
+    :param str service_name:
+    :param stand_in: the object to return from `get_client()` and `get_resource()`, or None to remove it
+    """
+    with _lock:
+        if stand_in is None:
+            _stand_ins.pop(service_name, None)
+        else:
+            _stand_ins[service_name] = stand_in
+
+
+def reset():
+    """
+    Discard all clients, resources and stand-ins
+    """
+    global _session, _generation
+    with _lock:
+        _session = None
+        _generation += 1
+        _clients.clear()
+        _stand_ins.clear()
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+# Objects which are too big for memory are read from disk in chunks of this size
+_READ_CHUNK_SIZE = 1024 * 1024
+
+
+class CachedObject:
+    def __init__(self, name, etag, size, checksum, path, metadata):
+        self.name = name
+        self.etag = etag
+        self.size = size
+        self.checksum = checksum
+        self.path = path
+        self.metadata = metadata
+
+
+class BinaryCache:
+    """
+    A two-tier cache of immutable binary objects: an in-memory LRU with a byte budget, backed by files on local disk
+    (eg the Lambda's /tmp) with their own byte budget.  Objects are identified by name and ETag, and verified against
+    their SHA-256 checksum whenever they are read from disk.
+    """
+    def __init__(self, memory_budget, directory, disk_budget):
+        self.memory_budget = memory_budget
+        self.directory = directory
+        self.disk_budget = disk_budget
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.RLock()
+        self.metrics = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+            'checksum_failures': 0,
+        }
+
+    def __contains__(self, name):
+        return name in self._disk
+
+    def get(self, name):
+        """
+        :param str name:
+        :return: CachedObject, or None if the object is not cached
+        """
+        with self._lock:
+            if name in self._memory:
+                self._memory.move_to_end(name)
+                self._disk.move_to_end(name)
+                self.metrics['memory_hits'] += 1
+                return self._memory[name][0]
+            elif name in self._disk:
+                self._disk.move_to_end(name)
+                self.metrics['disk_hits'] += 1
+                return self._disk[name]
+            else:
+                self.metrics['misses'] += 1
+                return None
+
+    def put(self, name, etag, chunks, metadata=None):
+        """
+        Store an object, streaming it to disk so that it never needs to be held in memory in its entirety
+        :param str name:
+        :param str etag:
+        :param chunks: an iterable of bytes
+        :param dict metadata: any other information to keep with the object
+        :return: CachedObject
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, hashlib.sha256('{}:{}'.format(name, etag).encode()).hexdigest())
+        checksum = hashlib.sha256()
+        size = 0
+        # Concurrent misses for the same object each write their own file, and the last to finish replaces the others'
+        fd, part_path = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    checksum.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(part_path)
+            raise
+
+        cached = CachedObject(name, etag, size, checksum.hexdigest(), path, metadata or {})
+        with self._lock:
+            # Which may delete the file at `path`, if it is the same object
+            self._discard(name)
+            os.replace(part_path, path)
+            self._disk[name] = cached
+            self._disk_bytes += size
+            self._evict()
+        return cached
+
+    def read(self, cached, start=0, end=None):
+        """
+        Read all or part of a cached object
+        :param CachedObject cached:
+        :param int start: the first byte to read
+        :param int end: the last byte to read (inclusive), or None to read to the end
+        :return: bytes
+        """
+        end = cached.size - 1 if end is None else min(end, cached.size - 1)
+        with self._lock:
+            if cached.name in self._memory:
+                return self._memory[cached.name][1][start:end + 1]
+
+        if cached.size <= self.memory_budget:
+            return self._promote(cached)[start:end + 1]
+
+        # Too big to keep in memory, so stream it from disk, verifying all of it but keeping just the requested part
+        checksum = hashlib.sha256()
+        parts = []
+        position = 0
+        with open(cached.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_READ_CHUNK_SIZE), b''):
+                checksum.update(chunk)
+                if position + len(chunk) > start and position <= end:
+                    parts.append(chunk[max(start - position, 0):end + 1 - position])
+                position += len(chunk)
+        if checksum.hexdigest() != cached.checksum:
+            self._fail_checksum(cached)
+        return b''.join(parts)
+
+    def invalidate(self, name):
+        with self._lock:
+            self._discard(name)
+
+    def _promote(self, cached):
+        with open(cached.path, 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != cached.checksum:
+            self._fail_checksum(cached)
+
+        with self._lock:
+            if cached.name in self._disk and cached.name not in self._memory:
+                self._memory[cached.name] = (cached, data)
+                self._memory_bytes += cached.size
+                self._evict()
+        return data
+
+    def _fail_checksum(self, cached):
+        with self._lock:
+            self.metrics['checksum_failures'] += 1
+            self._discard(cached.name)
+        raise IOError('Cached copy of {} is corrupt'.format(cached.name))
+
+    def _discard(self, name):
+        if name in self._memory:
+            self._memory_bytes -= self._memory.pop(name)[0].size
+        if name in self._disk:
+            cached = self._disk.pop(name)
+            self._disk_bytes -= cached.size
+            try:
+                os.remove(cached.path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        while self._memory_bytes > self.memory_budget and len(self._memory) > 0:
+            _, (cached, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= cached.size
+            self.metrics['memory_evictions'] += 1
+        while self._disk_bytes > self.disk_budget and len(self._disk) > 0:
+            name = next(iter(self._disk))
+            self._discard(name)
+            self.metrics['disk_evictions'] += 1
@@ -0,0 +1,38 @@
+"""
+The model of each accessory's clock drift.  This module has no dependencies outside the standard library, so that
+scripts/backfill_clock_drift.py can share it.
+"""
+from decimal import Decimal
+
+# Syncs closer together than this (in ms) accumulate too little drift to measure
+CLOCK_DRIFT_MIN_INTERVAL = 8 * 3600 * 1000
+
+
+def update_clock_drift_model(model, true_time, local_time):
+    """
+    The clock drift model is a least-squares fit, through the origin, of the error in the accessory's clock at each sync
+    against the time since the previous sync (when the clock was last set).  Only the running sums are stored, so each
+    sync updates it in constant time.
+    :param dict model: the current AccessoryData, including the true time at the previous sync
+    :param true_time: the true time at this sync, in ms
+    :param local_time: the accessory's clock at this sync, in ms
+    :return: dict the fields of the AccessoryData to update
+    """
+    previous_true_time = model.get('true_time')
+    if previous_true_time is None:
+        return {}
+    interval = Decimal(str(true_time)) - Decimal(str(previous_true_time))
+    if interval < CLOCK_DRIFT_MIN_INTERVAL:
+        return {}
+
+    # Sums are in seconds, to keep the numbers small
+    interval /= 1000
+    error = (Decimal(str(local_time)) - Decimal(str(true_time))) / 1000
+    sum_error_interval = Decimal(model.get('clock_drift_sum_error_interval', 0)) + error * interval
+    sum_interval_squared = Decimal(model.get('clock_drift_sum_interval_squared', 0)) + interval * interval
+    return {
+        'clock_drift_sum_error_interval': sum_error_interval,
+        'clock_drift_sum_interval_squared': sum_interval_squared,
+        'clock_drift_samples': Decimal(model.get('clock_drift_samples', 0)) + 1,
+        'clock_drift_rate': sum_error_interval / sum_interval_squared,
+    }
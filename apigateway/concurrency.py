@@ -0,0 +1,274 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, FIRST_EXCEPTION
+from flask import copy_current_request_context, has_request_context
+from functools import partial
+import os
+import threading
+import time
+
+from fathomapi.utils.xray import xray_recorder
+
+# Shared by all requests in the container, so that the number of concurrent backend calls stays bounded
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('CONCURRENCY_MAX_WORKERS', 16)))
+_worker_state = threading.local()
+_request_state = threading.local()
+# Thread-local state which tasks inherit from the thread which submitted them
+_propagated_state = []
+
+# A step given no fallback fails the whole graph
+_REQUIRED = object()
+
+
+class ConcurrentTimeoutException(Exception):
+    pass
+
+
+class CancelledException(Exception):
+    pass
+
+
+def set_request_deadline(deadline):
+    """
+    :param float deadline: the `time.monotonic()` value by which the current request must have finished, or None
+    """
+    _request_state.deadline = deadline
+
+
+def get_request_deadline():
+    """
+    :return: float the `time.monotonic()` value by which the current request must have finished, or None
+    """
+    return getattr(_request_state, 'deadline', None)
+
+
+def propagate_thread_state(getter, setter):
+    """
+    Have tasks run on the thread pool inherit some thread-local state from the thread which submitted them
+    :param callable getter: returns the state of the current thread
+    :param callable setter: sets the state of the current thread
+    """
+    _propagated_state.append((getter, setter))
+
+
+def check_cancelled():
+    """
+    Stop a task which has been abandoned, eg because it timed out, before it has side effects which the request that
+    started it no longer expects
+    :raises CancelledException: if the current task has been abandoned
+    """
+    cancelled = getattr(_worker_state, 'cancelled', None)
+    if cancelled is not None and cancelled.is_set():
+        raise CancelledException()
+
+
+def _get_trace_entity():
+    try:
+        return xray_recorder.get_trace_entity()
+    except Exception:
+        # Not tracing, eg when running locally
+        return None
+
+
+def _run_in_worker(trace_entity, state, cancelled, fn):
+    _worker_state.in_worker = True
+    _worker_state.cancelled = cancelled
+    for setter, value in state:
+        setter(value)
+    if trace_entity is not None:
+        # Subsegments created by `fn` belong to the caller's segment
+        xray_recorder.set_trace_entity(trace_entity)
+    try:
+        return fn()
+    finally:
+        if trace_entity is not None:
+            xray_recorder.clear_trace_entities()
+        for setter, _ in state:
+            setter(None)
+        _worker_state.cancelled = None
+        _worker_state.in_worker = False
+
+
+def _is_in_worker():
+    return getattr(_worker_state, 'in_worker', False)
+
+
+def _get_submitter():
+    """
+    :return: callable which submits a task to the pool, to run in the context of the calling thread, and returns its
+        future and a `threading.Event` which cancels it
+    """
+    trace_entity = _get_trace_entity()
+    state = [(setter, getter()) for getter, setter in _propagated_state]
+    with_request_context = has_request_context()
+
+    def _submit(fn):
+        if with_request_context:
+            fn = copy_current_request_context(fn)
+        # A cancelled future only stops the task if it hasn't started yet
+        cancelled = threading.Event()
+        return _executor.submit(_run_in_worker, trace_entity, state, cancelled, fn), cancelled
+    return _submit
+
+
+def run_concurrently(tasks, timeout=None):
+    """
+    Run several independent callables at the same time on the shared thread pool, and wait for them all to finish.
+    If any of them raises an exception, tasks which have not started yet are cancelled and the exception is re-raised.
+    :param dict tasks: a mapping of name to a callable taking no arguments
+    :param float timeout: the maximum number of seconds to wait
+    :return: dict a mapping of name to the return value of each callable
+    """
+    if _is_in_worker():
+        # Already on a pool thread: waiting on other pool threads from here could deadlock the pool
+        return {name: fn() for name, fn in tasks.items()}
+
+    submit = _get_submitter()
+    submitted = {name: submit(fn) for name, fn in tasks.items()}
+    futures = {name: future for name, (future, _) in submitted.items()}
+    done, not_done = wait(futures.values(), timeout=timeout, return_when=FIRST_EXCEPTION)
+    for future, cancelled in submitted.values():
+        if future in not_done:
+            future.cancel()
+            cancelled.set()
+
+    for future in futures.values():
+        if future in done and future.exception() is not None:
+            raise future.exception()
+    if len(not_done) > 0:
+        raise ConcurrentTimeoutException('Timed out waiting for {}'.format(
+            ', '.join(name for name, future in futures.items() if future in not_done)
+        ))
+
+    return {name: future.result() for name, future in futures.items()}
+
+
+class RateLimiter:
+    """
+    Spaces out calls to a rate-limited backend, however many threads are making them
+    """
+    def __init__(self, rate):
+        """
+        :param float rate: the maximum number of calls per second
+        """
+        self._interval = 1 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until the next call may be made
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait_until = max(now, self._next)
+            self._next = wait_until + self._interval
+        if wait_until > now:
+            time.sleep(wait_until - now)
+
+
+class _Step:
+    def __init__(self, name, fn, depends_on, timeout, fallback):
+        self.name = name
+        self.fn = fn
+        self.depends_on = depends_on
+        self.timeout = timeout
+        self.fallback = fallback
+
+
+class TaskGraph:
+    """
+    A set of steps, some of which need the results of others, each started as soon as the steps it depends on have
+    finished.  Each step may have its own timeout, and the graph as a whole has a deadline.  A step which fails or
+    runs out of time either fails the graph or, if it has a fallback, degrades to the fallback value.
+    """
+    def __init__(self, deadline=None):
+        """
+        :param float deadline: the `time.monotonic()` value by which all steps must finish; defaults to the deadline
+            of the current request
+        """
+        self.deadline = get_request_deadline() if deadline is None else deadline
+        self.failures = {}
+        self._steps = OrderedDict()
+
+    def add(self, name, fn, depends_on=(), timeout=None, fallback=_REQUIRED):
+        """
+        :param str name:
+        :param callable fn: called with the results of the steps it depends on as keyword arguments
+        :param tuple depends_on: the names of steps, already added, which must finish first
+        :param float timeout: the maximum number of seconds the step may take
+        :param fallback: the result of the step if it fails or times out.  If not given, the graph fails instead.
+        :return: TaskGraph
+        """
+        for dependency in depends_on:
+            if dependency not in self._steps:
+                raise ValueError('Step {} depends on unknown step {}'.format(name, dependency))
+        self._steps[name] = _Step(name, fn, tuple(depends_on), timeout, fallback)
+        return self
+
+    def run(self):
+        """
+        Run all the steps.  Steps which are abandoned because they timed out carry on in the background, but their
+        results are discarded, and they are stopped if they try to write anything (see `check_cancelled()`).
+        :return: dict a mapping of step name to result
+        """
+        results = {}
+        pending = list(self._steps.values())
+        running = {}
+        # Already on a pool thread, so run the steps one at a time in the order they were added
+        submit = None if _is_in_worker() else _get_submitter()
+
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for step in [s for s in pending if all(d in results for d in s.depends_on)]:
+                    pending.remove(step)
+                    fn = partial(step.fn, **{d: results[d] for d in step.depends_on})
+                    if submit is None:
+                        try:
+                            results[step.name] = fn()
+                        except Exception as e:
+                            results[step.name] = self._fail(step, e)
+                    else:
+                        future, cancelled = submit(fn)
+                        running[future] = (step, self._get_expiry(step), cancelled)
+                if len(running) == 0:
+                    continue
+
+                expiries = [expiry for _, expiry, _ in running.values() if expiry is not None]
+                timeout = max(0, min(expiries) - time.monotonic()) if len(expiries) > 0 else None
+                done, _ = wait(list(running.keys()), timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    step, _, _ = running.pop(future)
+                    if future.exception() is not None:
+                        results[step.name] = self._fail(step, future.exception())
+                    else:
+                        results[step.name] = future.result()
+
+                now = time.monotonic()
+                for future, (step, expiry, cancelled) in list(running.items()):
+                    if expiry is not None and now >= expiry:
+                        del running[future]
+                        future.cancel()
+                        cancelled.set()
+                        timeout_exception = ConcurrentTimeoutException('Timed out waiting for {}'.format(step.name))
+                        results[step.name] = self._fail(step, timeout_exception)
+        finally:
+            for future, (_, _, cancelled) in running.items():
+                future.cancel()
+                cancelled.set()
+
+        return results
+
+    def _get_expiry(self, step):
+        expiry = self.deadline
+        if step.timeout is not None:
+            step_expiry = time.monotonic() + step.timeout
+            expiry = step_expiry if expiry is None else min(expiry, step_expiry)
+        return expiry
+
+    def _fail(self, step, exception):
+        if step.fallback is _REQUIRED:
+            raise exception
+        print('Step {} degraded: {}'.format(step.name, exception))
+        self.failures[step.name] = exception
+        return step.fallback
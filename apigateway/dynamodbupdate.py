@@ -2,22 +2,56 @@ class DynamodbUpdate:
     def __init__(self):
         self._add = set([])
         self._set = set([])
+        self._remove = set([])
         self._parameters = {}
+        self._names = {}
 
     def set(self, field, value):
-        self._set.add("{field} = :{field}".format(field=field))
+        # Attribute names are always substituted, so that fields can be called eg `state`, which is a reserved word
+        self._set.add("#{field} = :{field}".format(field=field))
         self._parameters[':' + field] = value
+        self._names['#' + field] = field
+
+    def set_if_not_exists(self, field, value):
+        self._set.add("#{field} = if_not_exists(#{field}, :{field})".format(field=field))
+        self._parameters[':' + field] = value
+        self._names['#' + field] = field
 
     def add(self, field, value):
-        self._add.add("{field} :{field}".format(field=field))
+        self._add.add("#{field} :{field}".format(field=field))
         self._parameters[':' + field] = value
+        self._names['#' + field] = field
+
+    def remove(self, field):
+        self._remove.add("#{field}".format(field=field))
+        self._names['#' + field] = field
+
+    @property
+    def is_empty(self):
+        return len(self._names) == 0
 
     @property
     def update_expression(self):
         set = 'SET {}'.format(', '.join(self._set)) if len(self._set) else ''
         add = 'ADD {}'.format(', '.join(self._add)) if len(self._add) else ''
-        return set + ' ' + add
+        remove = 'REMOVE {}'.format(', '.join(self._remove)) if len(self._remove) else ''
+        return ' '.join([set, add, remove])
 
     @property
     def parameters(self):
         return self._parameters
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def kwargs(self):
+        """
+        :return: dict the expression arguments for `update_item()`
+        """
+        ret = {'UpdateExpression': self.update_expression, 'ExpressionAttributeNames': self._names}
+        # DynamoDB rejects an empty map of values, eg if the update only removes attributes
+        if len(self._parameters) > 0:
+            ret['ExpressionAttributeValues'] = self._parameters
+        return ret
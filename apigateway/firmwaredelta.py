@@ -0,0 +1,154 @@
+"""
+Binary deltas between firmware versions.
+
+A delta is a header followed by a zlib-compressed stream of operations which rebuild the target binary from the base
+binary:
+
+    header:  b'FWD1', base size (u32), target size (u32), base SHA-256 (32 bytes), target SHA-256 (32 bytes)
+    COPY:    0x01, offset in base (u32), length (u32)
+    INSERT:  0x02, length (u32), literal bytes
+
+All integers are big-endian.
+"""
+import hashlib
+import struct
+import time
+import zlib
+
+MAGIC = b'FWD1'
+_HEADER = struct.Struct('>4sII32s32s')
+_COPY = struct.Struct('>BII')
+_INSERT = struct.Struct('>BI')
+_OP_COPY = 0x01
+_OP_INSERT = 0x02
+
+# Matches shorter than this aren't worth a COPY operation
+_BLOCK_SIZE = 16
+# Only every nth offset in the base is indexed; any match of at least _BLOCK_SIZE + _INDEX_STRIDE - 1 bytes is found
+_INDEX_STRIDE = 4
+# How many offsets to try between checks of the deadline
+_DEADLINE_CHECK_INTERVAL = 64 * 1024
+
+
+class InvalidDeltaException(Exception):
+    pass
+
+
+class DeltaTimeoutException(Exception):
+    pass
+
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+def create_delta(base, target, deadline=None):
+    """
+    Compute a delta which transforms `base` into `target`
+    :param bytes base:
+    :param bytes target:
+    :param float deadline: the `time.monotonic()` value by which to give up, raising DeltaTimeoutException
+    :return: bytes
+    """
+    index = {}
+    for offset in range(0, len(base) - _BLOCK_SIZE + 1, _INDEX_STRIDE):
+        if offset % _DEADLINE_CHECK_INTERVAL == 0:
+            _check_deadline(deadline)
+        index.setdefault(base[offset:offset + _BLOCK_SIZE], offset)
+
+    ops = []
+    literal_start = 0
+    i = 0
+    previous_copy_end = None
+    steps = 0
+    while i <= len(target) - _BLOCK_SIZE:
+        steps += 1
+        if steps % _DEADLINE_CHECK_INTERVAL == 0:
+            _check_deadline(deadline)
+        block = target[i:i + _BLOCK_SIZE]
+        # Firmware changes tend to be local, so carrying on from where the last copy left off is the likeliest match
+        if previous_copy_end is not None and base[previous_copy_end:previous_copy_end + _BLOCK_SIZE] == block:
+            base_offset = previous_copy_end
+        else:
+            base_offset = index.get(block)
+        if base_offset is None:
+            i += 1
+            continue
+
+        # Extend the match backwards into the pending literal, and then forwards as far as it goes
+        while i > literal_start and base_offset > 0 and base[base_offset - 1] == target[i - 1]:
+            i -= 1
+            base_offset -= 1
+        length = _BLOCK_SIZE
+        while i + length < len(target) and base_offset + length < len(base) \
+                and base[base_offset + length] == target[i + length]:
+            length += 1
+
+        if literal_start < i:
+            ops.append(_INSERT.pack(_OP_INSERT, i - literal_start) + target[literal_start:i])
+        ops.append(_COPY.pack(_OP_COPY, base_offset, length))
+        i += length
+        literal_start = i
+        previous_copy_end = base_offset + length
+
+    if literal_start < len(target):
+        ops.append(_INSERT.pack(_OP_INSERT, len(target) - literal_start) + target[literal_start:])
+
+    header = _HEADER.pack(MAGIC, len(base), len(target), sha256(base), sha256(target))
+    return header + zlib.compress(b''.join(ops), 9)
+
+
+def _check_deadline(deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise DeltaTimeoutException('Ran out of time generating the delta')
+
+
+def read_header(delta):
+    """
+    :param bytes delta:
+    :return: dict with the base and target sizes and checksums
+    """
+    if len(delta) < _HEADER.size:
+        raise InvalidDeltaException('Delta is truncated')
+    magic, base_size, target_size, base_checksum, target_checksum = _HEADER.unpack_from(delta)
+    if magic != MAGIC:
+        raise InvalidDeltaException('Not a firmware delta')
+    return {
+        'base_size': base_size,
+        'target_size': target_size,
+        'base_checksum': base_checksum.hex(),
+        'target_checksum': target_checksum.hex(),
+    }
+
+
+def apply_delta(base, delta):
+    """
+    Rebuild the target binary from the base binary and a delta, verifying both checksums
+    :param bytes base:
+    :param bytes delta:
+    :return: bytes
+    """
+    header = read_header(delta)
+    if sha256(base).hex() != header['base_checksum']:
+        raise InvalidDeltaException('Base binary does not match the delta')
+
+    ops = zlib.decompress(delta[_HEADER.size:])
+    target = bytearray()
+    position = 0
+    while position < len(ops):
+        if ops[position] == _OP_COPY:
+            _, offset, length = _COPY.unpack_from(ops, position)
+            target += base[offset:offset + length]
+            position += _COPY.size
+        elif ops[position] == _OP_INSERT:
+            _, length = _INSERT.unpack_from(ops, position)
+            position += _INSERT.size
+            target += ops[position:position + length]
+            position += length
+        else:
+            raise InvalidDeltaException('Unknown operation 0x{:02x}'.format(ops[position]))
+
+    target = bytes(target)
+    if sha256(target).hex() != header['target_checksum']:
+        raise InvalidDeltaException('Result does not match the delta')
+    return target
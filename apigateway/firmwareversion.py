@@ -0,0 +1,40 @@
+"""
+Firmware version numbers.  This module has no dependencies besides `semver`, so that scripts/ can share it.
+"""
+from semver import VersionInfo
+import re
+
+
+def parse_version(version):
+    """
+    :param str version: a semantic version, or `MAJOR.MINOR`
+    :return: VersionInfo
+    :raises ValueError: if it isn't a valid version number
+    """
+    if re.match(r'^\d+\.\d+$', version):
+        # MAJOR.MINOR versions are implicitly patch 0
+        version += '.0'
+    return VersionInfo.parse(version)
+
+
+def get_version_key(version):
+    """
+    Encode a semantic version as a string which sorts lexicographically in the same order as the versions themselves
+    :param str version:
+    :return: str
+    """
+    v = parse_version(version)
+    key = '{:05d}.{:05d}.{:05d}'.format(v.major, v.minor, v.patch)
+    if v.prerelease is None:
+        # A release sorts after all of its prereleases
+        return key + '~'
+
+    identifiers = []
+    for identifier in v.prerelease.split('.'):
+        if identifier.isdigit():
+            # Numeric identifiers compare numerically, and sort before alphanumeric ones
+            identifiers.append('0{:010d}'.format(int(identifier)))
+        else:
+            identifiers.append('1' + identifier)
+    # `!` sorts before every character which is valid in an identifier
+    return key + '-' + '!'.join(identifiers)
@@ -0,0 +1,158 @@
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from decimal import Decimal
+from flask import request
+from functools import wraps
+import hashlib
+import json
+import os
+import time
+
+from awsclients import get_table
+from fathomapi.api.config import Config
+
+IDEMPOTENCY_WINDOW = int(os.environ.get('IDEMPOTENCY_WINDOW', 60))
+# How long an identical request is turned away for while the first is being processed, in case the first never
+# finishes (eg the Lambda timed out); longer than any request takes
+IDEMPOTENCY_IN_PROGRESS_TIMEOUT = int(os.environ.get('IDEMPOTENCY_IN_PROGRESS_TIMEOUT', 30))
+# How long a client should wait before retrying a request which is still in progress, in seconds
+IDEMPOTENCY_RETRY_AFTER = 2
+
+
+def _get_fingerprints(mac_address):
+    """
+    Identify a request by the accessory, endpoint and body, and either the client's Idempotency-Key header or else the
+    window of time in which it was made.  In the latter case the request is also identified with the previous window,
+    so that a retry which crosses into the next window is still recognised.
+    :return: list[str] the fingerprints to claim the request under
+    """
+    body = json.dumps(request.get_json(silent=True), sort_keys=True, separators=(',', ':'), default=str)
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None:
+        identifiers = ['key:' + idempotency_key]
+    else:
+        time_bucket = int(Config.get('REQUEST_TIME') / 1000 / IDEMPOTENCY_WINDOW)
+        identifiers = [str(time_bucket), str(time_bucket - 1)]
+    return [
+        'response:' + hashlib.sha256('\n'.join([
+            request.method, request.path, mac_address.upper(), identifier, body,
+        ]).encode()).hexdigest()
+        for identifier in identifiers
+    ]
+
+
+def _claim(table_name, fingerprint):
+    """
+    Record that a request is in progress, so that identical requests which arrive before it finishes aren't processed
+    as well
+    :return: bool False if an identical request has already been made
+    """
+    now = int(time.time())
+    try:
+        get_table(table_name).put_item(
+            Item={'id': fingerprint, 'expiry_date': now + IDEMPOTENCY_IN_PROGRESS_TIMEOUT},
+            # DynamoDB only deletes expired items eventually
+            ConditionExpression=Attr('id').not_exists() | Attr('expiry_date').lte(now),
+        )
+    except ClientError as e:
+        if 'ConditionalCheckFailed' in str(e):
+            return False
+        # At worst a retry will be processed again
+        print(json.dumps({'exception': str(e)}))
+    return True
+
+
+def _release(table_name, fingerprint):
+    """
+    Forget a request which didn't succeed, so that it can be retried straight away
+    """
+    try:
+        get_table(table_name).delete_item(Key={'id': fingerprint})
+    except ClientError as e:
+        # Retries will be turned away until the claim expires
+        print(json.dumps({'exception': str(e)}))
+
+
+def _get_stored_response(table_name, fingerprint):
+    """
+    :return: (dict, int) the response and status to an identical request, or None if it is still in progress
+    """
+    try:
+        res = get_table(table_name).get_item(Key={'id': fingerprint}, ConsistentRead=True)
+    except ClientError as e:
+        print(json.dumps({'exception': str(e)}))
+        return None
+    item = res.get('Item')
+    if item is None or item['expiry_date'] <= int(time.time()) or 'response' not in item:
+        return None
+    return json.loads(item['response'], parse_float=Decimal), int(item['status'])
+
+
+def _store_response(table_name, fingerprint, response, status):
+    try:
+        get_table(table_name).put_item(Item={
+            'id': fingerprint,
+            'response': json.dumps(response, default=_json_default),
+            'status': status,
+            'expiry_date': int(time.time()) + 2 * IDEMPOTENCY_WINDOW,
+        })
+    except ClientError as e:
+        # The request has succeeded; at worst a retry will be processed again
+        print(json.dumps({'exception': str(e)}))
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _get_duplicate_response(table_name, fingerprint):
+    stored = _get_stored_response(table_name, fingerprint)
+    if stored is not None:
+        print(json.dumps({'replayed_response': fingerprint}))
+        return stored
+    print(json.dumps({'request_in_progress': fingerprint}))
+    return (
+        {'message': 'An identical request is still being processed'},
+        409,
+        {'Status': 'RequestInProgress', 'Retry-After': str(IDEMPOTENCY_RETRY_AFTER)},
+    )
+
+
+def idempotent(func):
+    """
+    Decorate an accessory route so that a retry of a successful request, with the same body and either the same
+    Idempotency-Key header or within IDEMPOTENCY_WINDOW seconds, gets the original response back without the request
+    being processed again.  A retry which arrives while the original request is still being processed gets a 409, and
+    should be retried shortly.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        table_name = os.environ.get('DYNAMODB_IDEMPOTENCY_TABLE_NAME')
+        if table_name is None:
+            return func(*args, **kwargs)
+
+        fingerprints = _get_fingerprints(kwargs['mac_address'])
+        for i, fingerprint in enumerate(fingerprints):
+            if not _claim(table_name, fingerprint):
+                for claimed in fingerprints[:i]:
+                    _release(table_name, claimed)
+                return _get_duplicate_response(table_name, fingerprint)
+
+        try:
+            ret = func(*args, **kwargs)
+        except Exception:
+            for fingerprint in fingerprints:
+                _release(table_name, fingerprint)
+            raise
+        response, status = ret[:2] if isinstance(ret, tuple) else (ret, 200)
+        for fingerprint in fingerprints:
+            if 200 <= status < 300:
+                _store_response(table_name, fingerprint, response, status)
+            else:
+                _release(table_name, fingerprint)
+        return ret
+    return wrapper
@@ -0,0 +1,183 @@
+"""
+Paginated listings of devices (accessories and sensors), as described by a request's query string:
+
+* `page_size`: the maximum number of devices to return;
+* `fields`: a comma-separated list of the fields to return for each device;
+* `continuation_token`: from the previous page of the same listing;
+* `owner_id`, `hardware_model`, `firmware_version`: only devices with exactly this value;
+* `firmware_version_lt`, `firmware_version_gte`: only devices whose firmware version is before, or at least, this one;
+* `battery_level_lt`, `battery_level_gte`, `memory_level_lt`, `memory_level_gte`: likewise, for the levels.
+
+A listing queries a secondary index whose partition key is one of the exact-match filters, and otherwise scans the
+table.  Firmware versions are compared by their `firmware_version_key`, so devices whose firmware version is not a
+semantic version are never matched by a firmware version filter.
+"""
+from boto3.dynamodb.conditions import Attr, Key
+from decimal import Decimal, InvalidOperation
+from functools import reduce
+from operator import iand
+import base64
+import binascii
+import json
+import os
+
+from concurrency import get_request_deadline
+from fathomapi.utils.exceptions import InvalidSchemaException
+from firmwareversion import get_version_key
+from models.entity import get_page
+
+LIST_DEFAULT_PAGE_SIZE = int(os.environ.get('LIST_DEFAULT_PAGE_SIZE', 50))
+LIST_MAX_PAGE_SIZE = int(os.environ.get('LIST_MAX_PAGE_SIZE', 500))
+# Stop reading a sparse listing this many seconds before the request times out, and return a short page
+LIST_DEADLINE_MARGIN = float(os.environ.get('LIST_DEADLINE_MARGIN', 2))
+
+_EQUALITY_FILTERS = ['owner_id', 'hardware_model', 'firmware_version']
+_RANGE_FILTERS = ['firmware_version', 'battery_level', 'memory_level']
+
+
+class ListQuery:
+    def __init__(self, args, fields):
+        """
+        :param args: the query string
+        :param list[str] fields: the fields which may be returned or filtered on
+        """
+        self.page_size = _parse_page_size(args.get('page_size'))
+        self.projection = _parse_projection(args.get('fields'), fields)
+        self.continuation_token = args.get('continuation_token')
+
+        # (field, operator, value), where firmware versions have been converted to version keys
+        self.filters = []
+        for field in _EQUALITY_FILTERS:
+            if field in fields and args.get(field) is not None:
+                self.filters.append(_parse_filter(field, 'eq', args[field]))
+        for field in _RANGE_FILTERS:
+            for operator in ['lt', 'gte']:
+                parameter = '{}_{}'.format(field, operator)
+                if field in fields and args.get(parameter) is not None:
+                    self.filters.append(_parse_filter(field, operator, args[parameter]))
+
+
+def get_list_page(table, list_query, indexes, base_filter=None):
+    """
+    :param table: a DynamoDB Table resource
+    :param ListQuery list_query:
+    :param OrderedDict indexes: the secondary indexes which may be queried, in order of preference, as a mapping of
+        index name to (partition key, sort key or None)
+    :param base_filter: a condition which every listed item must also satisfy
+    :return: (list[dict], str) the items, and the continuation token for the next page, or None if there are no more
+    """
+    index_name, key_condition_expression, filters = _plan(list_query.filters, indexes)
+    conditions = [getattr(Attr(field), operator)(value) for field, operator, value in filters]
+    if base_filter is not None:
+        conditions.append(base_filter)
+
+    deadline = get_request_deadline()
+    items, last_evaluated_key = get_page(
+        table,
+        key_condition_expression,
+        index_name=index_name,
+        projection=list_query.projection,
+        filter_expression=reduce(iand, conditions) if len(conditions) > 0 else None,
+        page_size=list_query.page_size,
+        start_key=_decode_continuation_token(list_query.continuation_token, index_name),
+        deadline=None if deadline is None else deadline - LIST_DEADLINE_MARGIN,
+    )
+    return items, _encode_continuation_token(last_evaluated_key, index_name)
+
+
+def get_continuation_token(list_query, indexes, primary_key_fields, item):
+    """
+    The continuation token for a page which has been cut short after one of its items, so that the next page starts
+    with the item after it
+    :param ListQuery list_query:
+    :param OrderedDict indexes: as for `get_list_page()`
+    :param list[str] primary_key_fields: the table's key attributes
+    :param dict item: the last item of the page, which must have the key attributes of the table and of the index
+    :return: str
+    """
+    index_name, _, _ = _plan(list_query.filters, indexes)
+    key_fields = list(primary_key_fields)
+    if index_name is not None:
+        key_fields += [field for field in indexes[index_name] if field is not None]
+    return _encode_continuation_token({field: item[field] for field in key_fields}, index_name)
+
+
+def _plan(filters, indexes):
+    """
+    :return: (str, key condition, list) the index to query (or None to scan the table), the key condition for it, and
+        the filters which it doesn't satisfy
+    """
+    for index_name, (partition_key, sort_key) in indexes.items():
+        partition_filter = next((f for f in filters if f[0] == partition_key and f[1] == 'eq'), None)
+        if partition_filter is None:
+            continue
+        filters = [f for f in filters if f is not partition_filter]
+        key_condition_expression = Key(partition_key).eq(partition_filter[2])
+
+        # Only one condition can be on the sort key, so prefer the most selective
+        sort_filters = sorted((f for f in filters if f[0] == sort_key), key=lambda f: f[1] != 'eq')
+        if len(sort_filters) > 0:
+            field, operator, value = sort_filters[0]
+            key_condition_expression &= getattr(Key(field), operator)(value)
+            filters = [f for f in filters if f is not sort_filters[0]]
+        return index_name, key_condition_expression, filters
+
+    return None, None, filters
+
+
+def _parse_page_size(value):
+    if value is None:
+        return LIST_DEFAULT_PAGE_SIZE
+    try:
+        page_size = int(value)
+    except ValueError:
+        page_size = 0
+    if page_size < 1 or page_size > LIST_MAX_PAGE_SIZE:
+        raise InvalidSchemaException('page_size must be a whole number between 1 and {}'.format(LIST_MAX_PAGE_SIZE))
+    return page_size
+
+
+def _parse_projection(value, fields):
+    if value is None:
+        # Not every attribute on a record is a field
+        return list(fields)
+    projection = [field.strip() for field in value.split(',') if field.strip() != '']
+    unknown_fields = [field for field in projection if field not in fields]
+    if len(projection) == 0 or len(unknown_fields) > 0:
+        raise InvalidSchemaException('fields must be a comma-separated list of: {}'.format(', '.join(fields)))
+    return projection
+
+
+def _parse_filter(field, operator, value):
+    if field == 'firmware_version':
+        try:
+            return 'firmware_version_key', operator, get_version_key(value)
+        except ValueError:
+            raise InvalidSchemaException('{} must be a VersionNumber'.format(field))
+    if field in _RANGE_FILTERS:
+        try:
+            return field, operator, Decimal(value)
+        except InvalidOperation:
+            raise InvalidSchemaException('{}_{} must be a number'.format(field, operator))
+    return field, operator, value
+
+
+def _encode_continuation_token(last_evaluated_key, index_name):
+    if last_evaluated_key is None:
+        return None
+    token = json.dumps({'index': index_name, 'key': last_evaluated_key}, sort_keys=True, separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+
+def _decode_continuation_token(continuation_token, index_name):
+    if continuation_token is None:
+        return None
+    try:
+        token = json.loads(base64.urlsafe_b64decode(continuation_token.encode('ascii')).decode('utf-8'))
+        valid = isinstance(token, dict) and isinstance(token.get('key'), dict) and token.get('index') == index_name
+    except (binascii.Error, UnicodeError, ValueError):
+        valid = False
+    if not valid:
+        # Including a token from a listing with different filters, which would have read from a different index
+        raise InvalidSchemaException('Invalid continuation_token')
+    return token['key']
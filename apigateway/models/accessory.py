@@ -1,31 +1,148 @@
 from botocore.exceptions import ClientError
-import boto3
+from functools import partial
 import datetime
 import json
 import os
 
+from awsclients import get_client
+from concurrency import RateLimiter, TaskGraph, get_request_deadline
 from models.entity import Entity
-from models.accessory_data import AccessoryData
-from fathomapi.utils.exceptions import DuplicateEntityException, InvalidSchemaException, NoSuchEntityException, \
-    UnauthorizedException, NoUpdatesException
+from models.accessory_data import AccessoryData, LIST_KEY_FIELDS
+from fathomapi.utils.exceptions import ApplicationException, DuplicateEntityException, InvalidSchemaException, \
+    NoSuchEntityException, UnauthorizedException, NoUpdatesException
 from fathomapi.utils.formatters import format_datetime
+from listing import LIST_DEADLINE_MARGIN, ListQuery
+from unitofwork import get_unit_of_work
 
-cognito_client = boto3.client('cognito-idp')
+# Cognito's admin read quota is shared by the whole account, so bulk reads must leave room for everything else.  This
+# only limits each container (shared by all of its requests), so it must be set to the share of the quota left for
+# bulk reads divided by the number of containers which may be making them at once.
+COGNITO_BULK_READ_RATE = float(os.environ.get('COGNITO_BULK_READ_RATE', 20))
+_cognito_bulk_read_limiter = RateLimiter(COGNITO_BULK_READ_RATE)
+# Accessories which haven't been mirrored are read from Cognito, at the rate above, so a page of a listing stops after
+# this many of them
+ACCESSORY_LIST_MAX_UNMIRRORED = max(1, int(os.environ.get('ACCESSORY_LIST_MAX_UNMIRRORED', 40)))
+# The only AccessoryData attributes, besides the accessory's own, which a patch may write.  The rest (the sync log
+# state, the clock drift model and the mirror date) are maintained by the service.
+_PATCHABLE_DATA_FIELDS = ['last_sync_date', 'true_time', 'local_time']
 
 
 class Accessory(Entity):
+    _schema_name = 'accessory'
+
     def __init__(self, mac_address):
         self._mac_address = mac_address.upper()
         super().__init__({'mac_address': self._mac_address})
 
-    @staticmethod
-    def schema():
-        with open('schemas/accessory.json', 'r') as f:
-            return json.load(f)
+    def _get(self):
+        accessory_data = self._get_accessory_data()
+        if accessory_data.get('attributes_mirrored_date') is None:
+            # Registered before the attributes were mirrored, so copy them over from Cognito.  This makes reads write
+            # to the accessory table, once per accessory; scripts/reconcile_accessory_attributes.py mirrors them all
+            # up front.
+            accessory_data = self._mirror_attributes(self._get_cognito_attributes(), overwrite=False)
+        return self._from_accessory_data(accessory_data)
+
+    def _from_accessory_data(self, accessory_data):
+        ret = dict(self.primary_key)
+        for key in self.get_fields(primary_key=False):
+            if accessory_data.get(key) is not None:
+                ret[key] = accessory_data[key]
+            else:
+                ret[key] = self._schema.defaults[key]
+        ret['last_sync_date'] = None
+        ret['clock_drift_rate'] = None
+
+        if accessory_data.get('last_sync_date') is not None:
+            ret['last_sync_date'] = accessory_data.get('last_sync_date')
+        if accessory_data.get('clock_drift_rate') is not None:
+            ret['clock_drift_rate'] = accessory_data.get('clock_drift_rate')
+        if accessory_data.get('true_time') is not None:
+            ret['true_time'] = accessory_data.get('true_time')
+
+        return ret
+
+    @classmethod
+    def get_page(cls, args):
+        """
+        One page of a listing of accessories, which may be filtered (see listing.py)
+        :param args: the query string
+        :return: (list[dict], str) the accessories, and the continuation token for the next page
+        """
+        fields = list(cls.schema()['properties']) + ['last_sync_date', 'clock_drift_rate']
+        list_query = ListQuery(args, fields)
+        requested_fields = list_query.projection
+        # The AccessoryData's id is the accessory's mac_address
+        list_query.projection = list(set(
+            ['attributes_mirrored_date'] + LIST_KEY_FIELDS +
+            ['id' if f == 'mac_address' else f for f in requested_fields]
+        ))
+        items, continuation_token = AccessoryData.get_page(list_query)
+
+        unmirrored = [item['id'] for item in items if item.get('attributes_mirrored_date') is None]
+        deadline = get_request_deadline()
+        fetched = cls.get_many(
+            unmirrored[:ACCESSORY_LIST_MAX_UNMIRRORED],
+            # Leaving time to return the accessories which have been fetched
+            deadline=None if deadline is None else deadline - LIST_DEADLINE_MARGIN,
+        )
+
+        ret = []
+        for i, item in enumerate(items):
+            if item.get('attributes_mirrored_date') is not None:
+                accessory = cls(item['id'])._from_accessory_data(item)
+            else:
+                accessory = fetched.get(item['id'])
+                if accessory is None or (
+                        isinstance(accessory, Exception) and not isinstance(accessory, NoSuchEntityException)):
+                    # Over the limit, or it failed or ran out of time: end the page before it, so that the next page
+                    # starts with it
+                    if i == 0:
+                        print(accessory)
+                        raise ApplicationException(503, 'ServiceUnavailable', 'Could not retrieve all requested items')
+                    return ret, AccessoryData.get_continuation_token(list_query, items[i - 1])
+                if isinstance(accessory, NoSuchEntityException):
+                    # AccessoryData left behind by an accessory which has been deleted from Cognito
+                    continue
+                # An unmirrored item has no attributes except perhaps its owner, so it was either listed without
+                # filters or matched an owner_id filter.  Cognito is authoritative until it's mirrored.
+                if args.get('owner_id') is not None and accessory['owner_id'] != args['owner_id']:
+                    continue
+            ret.append({field: accessory[field] for field in requested_fields})
+
+        return ret, continuation_token
 
-    def get(self):
+    @classmethod
+    def get_many(cls, mac_addresses, deadline=None):
+        """
+        Get several accessories at once.  Their AccessoryData is fetched in as few round trips as possible; only those
+        which haven't been mirrored yet need Cognito, and those reads are rate-limited.
+        :param list[str] mac_addresses:
+        :param float deadline: the `time.monotonic()` value by which to give up on reads from Cognito; defaults to the
+            deadline of the current request
+        :return: dict mapping each mac address (upper-cased) to the accessory, or to the exception raised getting it
+        """
+        accessories = {mac_address.upper(): cls(mac_address) for mac_address in mac_addresses}
+        items = AccessoryData.get_many([{'id': mac_address} for mac_address in accessories])
+
+        ret = {}
+        graph = TaskGraph(deadline)
+        for mac_address, accessory in accessories.items():
+            item = items.get(mac_address)
+            if item is not None and item.get('attributes_mirrored_date') is not None:
+                ret[mac_address] = accessory._from_accessory_data(item)
+            else:
+                # So that the fallback doesn't fetch it again
+                AccessoryData(mac_address)._remember(item)
+                graph.add(mac_address, partial(_get_rate_limited, accessory, _cognito_bulk_read_limiter), fallback=None)
+
+        ret.update(graph.run())
+        ret.update(graph.failures)
+        return ret
+
+    def _get_cognito_attributes(self):
         try:
-            res = cognito_client.admin_get_user(
+            res = get_client('cognito-idp').admin_get_user(
                 UserPoolId=os.environ['COGNITO_USER_POOL_ID'],
                 Username=self._mac_address,
             )
@@ -34,81 +151,98 @@ class Accessory(Entity):
                 raise NoSuchEntityException()
             raise
 
-        custom_properties = {prop['Name'].split(':')[-1]: prop['Value'] for prop in res['UserAttributes']}
-
-        ret = self.primary_key
-        for key in self.get_fields(primary_key=False):
-            if key in custom_properties:
-                ret[key] = self.cast(key, custom_properties[key])
-            else:
-                ret[key] = self.schema()['properties'][key].get('default', None)
-        ret['last_sync_date'] = None
-        ret['clock_drift_rate'] = None
+        return {prop['Name'].split(':')[-1]: prop['Value'] for prop in res['UserAttributes']}
 
+    def _get_accessory_data(self):
         try:
-            accessory_data = AccessoryData(self._mac_address).get()
-            if accessory_data.get('last_sync_date') is not None:
-                ret['last_sync_date'] = accessory_data.get('last_sync_date')
-            if accessory_data.get('clock_drift_rate') is not None:
-                ret['clock_drift_rate'] = accessory_data.get('clock_drift_rate')
-            if accessory_data.get('true_time') is not None:
-                ret['true_time'] = accessory_data.get('true_time')
+            return AccessoryData(self._mac_address).get()
         except NoSuchEntityException as e:
             print(e)
-            pass
-        except Exception as e:
-            print(e)
-            raise
+            return {}
 
-        return ret
+    def _mirror_attributes(self, attributes, overwrite):
+        """
+        Copy the accessory's attributes into its AccessoryData, which is where they are read from
+        :param dict attributes: the attributes, as stored in Cognito or given on registration
+        :param bool overwrite: False to leave alone any attributes which have already been mirrored, eg by a
+            concurrent patch
+        :return: dict the AccessoryData
+        """
+        mirror = {
+            key: self.cast(key, attributes[key])
+            for key in self.get_fields(primary_key=False)
+            if attributes.get(key) is not None
+        }
+        mirror['attributes_mirrored_date'] = format_datetime(datetime.datetime.utcnow())
+        if overwrite:
+            return AccessoryData(self._mac_address).upsert(mirror)
+        return AccessoryData(self._mac_address).upsert({}, defaults=mirror)
 
     def patch(self, body):
-        attributes_to_update = []
-        attributes_to_delete = []
-        for key in self.get_fields(immutable=False, primary_key=False):
-            if key in body:
-                if body[key] is None:
-                    attributes_to_delete.append('custom:{}'.format(key))
-                else:
-                    attributes_to_update.append({'Name': 'custom:{}'.format(key), 'Value': str(body[key])})
-
-        if self.exists():
-            if len(attributes_to_update) > 0:
-                cognito_client.admin_update_user_attributes(
-                    UserPoolId=os.environ['COGNITO_USER_POOL_ID'],
-                    Username=self._mac_address,
-                    UserAttributes=attributes_to_update
-                )
-            if len(attributes_to_delete) > 0:
-                cognito_client.admin_delete_user_attributes(
-                    UserPoolId=os.environ['COGNITO_USER_POOL_ID'],
-                    Username=self._mac_address,
-                    UserAttributeNames=attributes_to_delete
-                )
-        else:
+        if not self.exists():
             # TODO
             raise NotImplementedError
+
         res = self.get()
+        # Only send Cognito the attributes which have actually changed
+        changes = {}
+        for key in self.get_fields(immutable=False, primary_key=False):
+            if key in body:
+                value = self._schema.defaults[key] if body[key] is None else self.cast(key, body[key])
+                if value != res[key]:
+                    changes[key] = body[key]
+                    res[key] = value
+
         res['last_sync_date'] = None
         res['clock_drift_rate'] = None
-        body['owner_id'] = res['owner_id']
+        # The attributes are written through to AccessoryData, which is where they are read from
+        data_body = {key: body[key] for key in _PATCHABLE_DATA_FIELDS if key in body}
+        data_body.update({key: res[key] for key in changes})
+        if body.get('true_time') is not None and body.get('local_time') is not None:
+            data_body.update(
+                AccessoryData(self._mac_address).get_clock_drift_update(body['true_time'], body['local_time'])
+            )
+        acc_data = {}
         try:
-            accessory_data = AccessoryData(self._mac_address)
-            acc_data = accessory_data.patch(body)
-        except DuplicateEntityException:  # TODO: this seems to be incorrect exception raised in DynamodbEntity.patch
-            try:  # First patch call after creation of accessory data table -> add informaiton
-                AccessoryData(self._mac_address).create(body)
-                acc_data = AccessoryData(self._mac_address).get()
-            except DuplicateEntityException as e:
-                print(e)
-        except NoUpdatesException as e:  # for patch
+            acc_data = AccessoryData(self._mac_address).upsert(data_body)
+        except NoUpdatesException as e:
             print(e)
         if 'last_sync_date' in acc_data:
             res['last_sync_date'] = acc_data['last_sync_date']
         if 'clock_drift_rate' in acc_data:
             res['clock_drift_rate'] = acc_data['clock_drift_rate']
+
+        if len(changes) == 0:
+            self._remember(res)
+        elif get_unit_of_work() is None:
+            self._write_cognito_attributes(changes)
+        else:
+            get_unit_of_work().write(
+                self, changes, lambda merged_changes, _: self._write_cognito_attributes(merged_changes), res
+            )
         return res
 
+    def _write_cognito_attributes(self, changes):
+        attributes_to_update = []
+        attributes_to_delete = []
+        for key, value in changes.items():
+            if value is None:
+                attributes_to_delete.append('custom:{}'.format(key))
+            else:
+                attributes_to_update.append({'Name': 'custom:{}'.format(key), 'Value': str(value)})
+
+        if len(attributes_to_update) > 0:
+            get_client('cognito-idp').admin_update_user_attributes(
+                UserPoolId=os.environ['COGNITO_USER_POOL_ID'],
+                Username=self._mac_address,
+                UserAttributes=attributes_to_update
+            )
+        if len(attributes_to_delete) > 0:
+            get_client('cognito-idp').admin_delete_user_attributes(
+                UserPoolId=os.environ['COGNITO_USER_POOL_ID'],
+                Username=self._mac_address,
+                UserAttributeNames=attributes_to_delete
+            )
 
     def create(self, body):
         body['mac_address'] = self._mac_address
@@ -116,7 +250,7 @@ class Accessory(Entity):
             if key not in body:
                 raise InvalidSchemaException('Missing required request parameters: {}'.format(key))
         try:
-            cognito_client.admin_create_user(
+            get_client('cognito-idp').admin_create_user(
                 UserPoolId=os.environ['COGNITO_USER_POOL_ID'],
                 Username=self._mac_address,
                 TemporaryPassword=body['password'],
@@ -130,7 +264,10 @@ class Accessory(Entity):
 
             # Log in straight away so there's no risk of the Cognito user expiring
             self.login(body['password'])
+            self._mirror_attributes(body, overwrite=True)
 
+            # Any earlier attempt to load the accessory in this request found that it didn't exist
+            self._forget()
             return self.get()
 
         except ClientError as e:
@@ -142,7 +279,7 @@ class Accessory(Entity):
 
     def login(self, password):
         try:
-            response = cognito_client.admin_initiate_auth(
+            response = get_client('cognito-idp').admin_initiate_auth(
                 UserPoolId=os.environ['COGNITO_USER_POOL_ID'],
                 ClientId=os.environ['COGNITO_USER_POOL_CLIENT_ID'],
                 AuthFlow='ADMIN_NO_SRP_AUTH',
@@ -160,7 +297,7 @@ class Accessory(Entity):
             raise
         if 'ChallengeName' in response and response['ChallengeName'] == "NEW_PASSWORD_REQUIRED":
             # Need to set a new password
-            response = cognito_client.admin_respond_to_auth_challenge(
+            response = get_client('cognito-idp').admin_respond_to_auth_challenge(
                 UserPoolId=os.environ['COGNITO_USER_POOL_ID'],
                 ClientId=os.environ['COGNITO_USER_POOL_CLIENT_ID'],
                 ChallengeName='NEW_PASSWORD_REQUIRED',
@@ -174,3 +311,8 @@ class Accessory(Entity):
             'jwt': response['AuthenticationResult']['AccessToken'],
             'expires': expiry_date.strftime("%Y-%m-%dT%H:%M:%SZ")
         }
+
+
+def _get_rate_limited(accessory, limiter):
+    limiter.acquire()
+    return accessory.get()
@@ -1,10 +1,27 @@
-from boto3.dynamodb.conditions import Attr
+from collections import OrderedDict
 
+from clockdrift import update_clock_drift_model
 from fathomapi.api.config import Config
-from fathomapi.models.dynamodb_entity import DynamodbEntity
+from fathomapi.utils.exceptions import NoSuchEntityException
+from listing import get_continuation_token, get_list_page
+from models.entity import DynamodbEntity, SECONDARY_INDEX_STAGE
+from models.firmware import get_firmware_version_key_update
+
+# Sparse: only accessories with an owner have an owner_id
+OWNER_ID_INDEX = 'owner_id'
+# Sparse: only accessories whose attributes have been mirrored, and which have a semantic firmware version
+HARDWARE_MODEL_INDEX = 'hardware_model-firmware_version_key'
+# The attributes which key the table and its indexes, which a listing needs to cut a page short
+LIST_KEY_FIELDS = ['id', 'owner_id', 'hardware_model', 'firmware_version_key']
+# The indexes which listings may query, in order of preference
+_LIST_INDEXES = OrderedDict([(OWNER_ID_INDEX, ('owner_id', None))])
+if SECONDARY_INDEX_STAGE >= 2:
+    # Until then, listings filtered on hardware_model scan the table
+    _LIST_INDEXES[HARDWARE_MODEL_INDEX] = ('hardware_model', 'firmware_version_key')
 
 
 class AccessoryData(DynamodbEntity):
+    _schema_name = 'accessory_data'
     _dynamodb_table_name = Config.get('DYNAMODB_ACCESSORY_TABLE_NAME')
 
     def __init__(self, accessory_id):
@@ -12,4 +29,42 @@ class AccessoryData(DynamodbEntity):
 
     @property
     def id(self):
-        return self.primary_key['id']
\ No newline at end of file
+        return self.primary_key['id']
+
+    @classmethod
+    def get_page(cls, list_query):
+        """
+        :param ListQuery list_query:
+        :return: (list[dict], str) one page of AccessoryData, and the continuation token for the next page
+        """
+        return get_list_page(cls._get_dynamodb_resource(), list_query, _LIST_INDEXES)
+
+    @staticmethod
+    def get_continuation_token(list_query, item):
+        """
+        :param ListQuery list_query:
+        :param dict item: an AccessoryData from a page of the listing, with at least the fields in `LIST_KEY_FIELDS`
+        :return: str the continuation token for a page which ends with this item
+        """
+        return get_continuation_token(list_query, _LIST_INDEXES, ['id'], item)
+
+    def upsert(self, body, defaults=None):
+        # Keep the firmware version index up to date
+        body = dict(body, **get_firmware_version_key_update(body))
+        if defaults is not None:
+            # Only if there is a key, as a null couldn't be the key of a secondary index
+            defaults = dict(defaults, **{k: v for k, v in get_firmware_version_key_update(defaults).items() if v})
+        return super().upsert(body, defaults)
+
+    def get_clock_drift_update(self, true_time, local_time):
+        """
+        Add a sync to the accessory's clock drift model
+        :param true_time: the true time at the sync, in ms
+        :param local_time: the accessory's clock at the sync, in ms
+        :return: dict the fields to update
+        """
+        try:
+            model = self.get()
+        except NoSuchEntityException:
+            model = {}
+        return update_clock_drift_model(model, true_time, local_time)
@@ -1,29 +1,37 @@
 from abc import abstractmethod
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
-from decimal import Decimal
 from functools import reduce
 from operator import iand
 import json
+import os
+import time
 
+from awsclients import get_resource, get_table
 from dynamodbupdate import DynamodbUpdate
-from fathomapi.utils.exceptions import InvalidSchemaException, NoSuchEntityException, DuplicateEntityException
+from fathomapi.utils.exceptions import ApplicationException, InvalidSchemaException, NoSuchEntityException, \
+    DuplicateEntityException, NoUpdatesException
+from schemaregistry import compile_schema, get_schema
+from unitofwork import get_unit_of_work
+
+BATCH_GET_MAX_KEYS = 100
+BATCH_GET_MAX_ATTEMPTS = 5
+BATCH_GET_BACKOFF_SECONDS = 0.05
+BATCH_WRITE_MAX_ITEMS = 25
+# DynamoDB only creates one secondary index per table in each stack update, so a table's second new index only exists
+# once the stack has been updated again with SecondaryIndexStage 2 (see cloudformation/hardware-environment.yaml)
+SECONDARY_INDEX_STAGE = int(os.environ.get('SECONDARY_INDEX_STAGE', 2))
 
 
 class Entity:
+    _schema_name = None
 
     def __init__(self, primary_key):
         self._primary_key = primary_key
 
         self._primary_key_fields = list(primary_key.keys())
-        self._fields = {}
-        schema = self.schema()
-        for field, config in schema['properties'].items():
-            self._fields[field] = {
-                'immutable': config.get('readonly', False),
-                'required': field in schema['required'],
-                'primary_key': field in self._primary_key_fields
-            }
+        self._schema = compile_schema(self._schema_name, self._primary_key_fields)
+        self._fields = self._schema.fields
 
         self._exists = None
 
@@ -31,53 +39,18 @@ class Entity:
     def primary_key(self):
         return self._primary_key
 
-    @staticmethod
-    @abstractmethod
-    def schema():
-        raise NotImplementedError
+    @classmethod
+    def schema(cls):
+        return get_schema(cls._schema_name)
 
     def get_fields(self, *, immutable=None, required=None, primary_key=None):
-        return [
-            k for k, v in self._fields.items()
-            if (immutable is None or v['immutable'] == immutable)
-            and (required is None or v['required'] == required)
-            and (primary_key is None or v['primary_key'] == primary_key)
-        ]
+        return self._schema.get_fields(immutable, required, primary_key)
 
     def cast(self, field, value):
-        schema = self.schema()
-        if field not in schema['properties']:
-            raise KeyError(field)
-
-        field_type = schema['properties'][field]['type']
-        if isinstance(field_type, dict) and '$ref' in field_type:
-            field_type = field_type['$ref']
-
-        if field_type == 'string':
-            return str(value)
-        elif field_type == 'number':
-            return Decimal(str(value))
-        elif field_type == "types.json/definitions/macaddress":
-            return str(value).upper()
-        else:
-            raise NotImplementedError("field_type '{}' cannot be cast".format(field_type))
+        return self._schema.cast(field, value)
 
     def validate(self, operation, body):
-        # Primary key must be complete
-        if None in self.primary_key.values():
-            raise InvalidSchemaException('Incomplete primary key')
-
-        if operation == 'PATCH':
-            # Not allowed to modify readonly attributes for PATCH
-            for key in self.get_fields(immutable=True, primary_key=False):
-                if key in body:
-                    raise InvalidSchemaException('Cannot modify value of immutable parameter: {}'.format(key))
-
-        else:
-            # Required fields must be present for PUT
-            for key in self.get_fields(required=True, primary_key=False):
-                if key not in body and key not in self.primary_key.keys():
-                    raise InvalidSchemaException('Missing required parameter: {}'.format(key))
+        self._schema.validate(operation, body, self.primary_key)
 
     def exists(self):
         if self._exists is None:
@@ -88,8 +61,34 @@ class Entity:
                 self._exists = False
         return self._exists
 
-    @abstractmethod
     def get(self):
+        unit_of_work = get_unit_of_work()
+        if unit_of_work is None:
+            return self._get()
+        # Only load the entity once per request
+        return unit_of_work.load(self, self._get)
+
+    def _is_unchanged(self, field, value, stored_value):
+        if value == stored_value:
+            return True
+        try:
+            # Eg a float in a request body and the Decimal it was stored as
+            return value is not None and self.cast(field, value) == stored_value
+        except (ArithmeticError, NotImplementedError, ValueError):
+            return False
+
+    def _remember(self, state):
+        unit_of_work = get_unit_of_work()
+        if unit_of_work is not None:
+            unit_of_work.remember(self, state)
+
+    def _forget(self):
+        unit_of_work = get_unit_of_work()
+        if unit_of_work is not None:
+            unit_of_work.forget(self)
+
+    @abstractmethod
+    def _get(self):
         raise NotImplementedError()
 
     @abstractmethod
@@ -102,15 +101,16 @@ class Entity:
 
 
 class DynamodbEntity(Entity):
+    _dynamodb_table_name = None
 
-    def get(self):
+    def _get(self):
         # And together all the elements of the primary key
         kcx = reduce(iand, [Key(k).eq(v) for k, v in self.primary_key.items()])
-        res = self._query_dynamodb(kcx)
+        item = next(self._iterate_dynamodb(kcx, limit=1), None)
 
-        if len(res) == 0:
+        if item is None:
             raise NoSuchEntityException()
-        return res[0]
+        return item
 
     def patch(self, body, create=False):
         if create:
@@ -122,48 +122,313 @@ class DynamodbEntity(Entity):
             upsert = DynamodbUpdate()
             for key in self.get_fields(immutable=None if create else False, primary_key=False):
                 if key in body:
-                    if self.schema()['properties'][key]['type'] in ['list', 'object']:
+                    if key in self._schema.collection_fields:
                         upsert.add(key, set(body[key]))
+                    elif body[key] is None:
+                        # As in a merge patch, null removes the field
+                        upsert.remove(key)
                     else:
                         upsert.set(key, body[key])
 
-            self._get_dynamodb_resource().update_item(
+            if upsert.is_empty:
+                raise NoUpdatesException()
+
+            kwargs = upsert.kwargs
+            if not create:
+                # Creating overwrites any existing entity, but patching needs one to patch
+                kwargs['ConditionExpression'] = reduce(iand, [Attr(k).exists() for k in self.primary_key.keys()])
+
+            res = self._get_dynamodb_resource().update_item(
                 Key=self.primary_key,
-                UpdateExpression=upsert.update_expression,
-                ExpressionAttributeValues=upsert.parameters,
+                ReturnValues='ALL_NEW',
+                **kwargs
             )
-
-            return self.get()
+            self._exists = True
+            self._remember(res['Attributes'])
+            return res['Attributes']
 
         except ClientError as e:
             if 'ConditionalCheckFailed' in str(e):
                 raise DuplicateEntityException()
             else:
-                print(json.dumps({'exception': e}))
+                print(json.dumps({'exception': str(e)}))
                 raise
 
     def create(self, body):
         return self.patch(body, True)
 
-    @abstractmethod
-    def _get_dynamodb_resource(self):
-        raise NotImplementedError
-
-    def _query_dynamodb(self, key_condition_expression, exclusive_start_key=None):
-        if exclusive_start_key is not None:
-            ret = self._get_dynamodb_resource().query(
-                Select='ALL_ATTRIBUTES',
-                KeyConditionExpression=key_condition_expression,
-                ExclusiveStartKey=exclusive_start_key,
-            )
-        else:
-            ret = self._get_dynamodb_resource().query(
-                Select='ALL_ATTRIBUTES',
-                KeyConditionExpression=key_condition_expression,
+    def upsert(self, body, defaults=None):
+        """
+        Create the entity if it does not exist, or patch it if it does, in a single round trip.  Immutable fields
+        may be supplied, but only if the entity is new or they match the stored value.  Within a unit of work, the
+        write is buffered until the end of the request.
+        :param dict body: the fields to write
+        :param dict defaults: values for fields which are only written if they are not already set, eg created_date
+        :return: dict the entity after the write
+        """
+        if None in self.primary_key.values():
+            raise InvalidSchemaException('Incomplete primary key')
+        defaults = defaults or {}
+
+        unit_of_work = get_unit_of_work()
+        if unit_of_work is None:
+            return self._upsert(body, defaults)
+
+        fields = [key for key in self.get_fields(primary_key=False) if key in body or key in defaults]
+        if len(fields) == 0:
+            raise NoUpdatesException()
+
+        try:
+            state = self.get()
+            exists = True
+        except NoSuchEntityException:
+            state = dict(self.primary_key)
+            exists = False
+
+        # Only write the fields which have actually changed
+        changes = {}
+        for key in fields:
+            if key in body:
+                if key in self._schema.collection_fields:
+                    value = set(state.get(key, set())) | set(body[key])
+                    if value != state.get(key):
+                        changes[key] = body[key]
+                        state[key] = value
+                elif not self._is_unchanged(key, body[key], state.get(key)):
+                    changes[key] = body[key]
+                    state[key] = body[key]
+        missing_defaults = [key for key in fields if key not in body and key not in state]
+        if exists and len(changes) == 0 and len(missing_defaults) == 0:
+            return state
+        for key in missing_defaults:
+            state[key] = defaults[key]
+
+        unit_of_work.write(self, changes, self._upsert, state, defaults)
+        self._exists = True
+        return state
+
+    def _upsert(self, body, defaults):
+        upsert = DynamodbUpdate()
+        conditions = []
+        for key in self.get_fields(primary_key=False):
+            if key in body:
+                if key in self._schema.collection_fields:
+                    upsert.add(key, set(body[key]))
+                elif self._fields[key]['immutable']:
+                    upsert.set_if_not_exists(key, body[key])
+                    conditions.append(Attr(key).not_exists() | Attr(key).eq(body[key]))
+                elif body[key] is None:
+                    # Rather than storing a null, which couldn't be the key of a secondary index
+                    upsert.remove(key)
+                else:
+                    upsert.set(key, body[key])
+            elif key in defaults:
+                upsert.set_if_not_exists(key, defaults[key])
+
+        if upsert.is_empty:
+            raise NoUpdatesException()
+
+        # If we haven't got enough fields to create the entity then it must already exist
+        missing_fields = [
+            key for key in self.get_fields(required=True, primary_key=False)
+            if key not in body and key not in defaults
+        ]
+        if len(missing_fields) > 0:
+            conditions.extend(Attr(k).exists() for k in self.primary_key.keys())
+
+        kwargs = {}
+        if len(conditions) > 0:
+            kwargs['ConditionExpression'] = reduce(iand, conditions)
+
+        try:
+            res = self._get_dynamodb_resource().update_item(
+                Key=self.primary_key,
+                ReturnValues='ALL_NEW',
+                **upsert.kwargs,
+                **kwargs
             )
-        if 'LastEvaluatedKey' in ret:
-            # There are more records to be scanned
-            return ret['Items'] + self._query_dynamodb(key_condition_expression, ret['LastEvaluatedKey'])
-        else:
+            self._exists = True
+            self._remember(res['Attributes'])
+            return res['Attributes']
+
+        except ClientError as e:
+            if 'ConditionalCheckFailed' in str(e):
+                reasons = []
+                if len(missing_fields) > 0:
+                    reasons.append('Missing required parameter: {}'.format(missing_fields[0]))
+                immutable_fields = [k for k in self.get_fields(immutable=True, primary_key=False) if k in body]
+                if len(immutable_fields) > 0:
+                    reasons.append('Cannot modify value of immutable parameter: {}'.format(', '.join(immutable_fields)))
+                raise InvalidSchemaException(' or '.join(reasons))
+            else:
+                print(json.dumps({'exception': str(e)}))
+                raise
+
+    @classmethod
+    def get_many(cls, keys, consistent_read=False):
+        """
+        Get several entities in as few round trips as possible, using BatchGetItem
+        :param list[dict] keys: the primary keys of the entities to get
+        :param bool consistent_read: True to read every write which has already succeeded, at twice the cost
+        :return: dict mapping the primary key (the value of a single-attribute key, or a tuple of values for a
+            composite key) of each entity which exists to its item
+        """
+        if len(keys) == 0:
+            return {}
+        primary_key_fields = list(keys[0].keys())
+
+        # BatchGetItem rejects requests containing duplicate keys
+        unique_keys = list({_key_of(key, primary_key_fields): key for key in keys}.values())
+
+        ret = {}
+        table_name = cls._dynamodb_table_name
+        for i in range(0, len(unique_keys), BATCH_GET_MAX_KEYS):
+            request_items = {
+                table_name: {'Keys': unique_keys[i:i + BATCH_GET_MAX_KEYS], 'ConsistentRead': consistent_read}
+            }
+            for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+                if attempt > 0:
+                    time.sleep(BATCH_GET_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+                res = get_resource('dynamodb').batch_get_item(RequestItems=request_items)
+                for item in res['Responses'].get(table_name, []):
+                    ret[_key_of(item, primary_key_fields)] = item
+
+                request_items = res.get('UnprocessedKeys', {})
+                if len(request_items) == 0:
+                    break
+            else:
+                raise ApplicationException(503, 'ServiceUnavailable', 'Could not retrieve all requested items')
+
+        return ret
+
+    @classmethod
+    def put_many(cls, items):
+        """
+        Write several whole items in as few round trips as possible, using BatchWriteItem
+        :param list[dict] items: the items to write, which must all have different primary keys
+        """
+        table_name = cls._dynamodb_table_name
+        for i in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+            request_items = {table_name: [{'PutRequest': {'Item': item}} for item in items[i:i + BATCH_WRITE_MAX_ITEMS]]}
+            for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+                if attempt > 0:
+                    time.sleep(BATCH_GET_BACKOFF_SECONDS * 2 ** (attempt - 1))
+
+                res = get_resource('dynamodb').batch_write_item(RequestItems=request_items)
+                request_items = res.get('UnprocessedItems', {})
+                if len(request_items) == 0:
+                    break
+            else:
+                raise ApplicationException(503, 'ServiceUnavailable', 'Could not write all items')
+
+    @classmethod
+    def _get_dynamodb_resource(cls):
+        return get_table(cls._dynamodb_table_name)
+
+    @classmethod
+    def _iterate_dynamodb(cls, key_condition_expression, **kwargs):
+        return iterate_query(cls._get_dynamodb_resource(), key_condition_expression, **kwargs)
+
+    def _query_dynamodb(self, key_condition_expression, **kwargs):
+        return list(self._iterate_dynamodb(key_condition_expression, **kwargs))
+
+
+def _key_of(item, primary_key_fields):
+    if len(primary_key_fields) == 1:
+        return item[primary_key_fields[0]]
+    return tuple(item[k] for k in primary_key_fields)
+
+
+def iterate_query(table, key_condition_expression, *, index_name=None, projection=None, filter_expression=None,
+                  page_size=None, limit=None, scan_index_forward=True, consistent_read=False):
+    """
+    Lazily iterate over the items matching a query, fetching further pages only as they are consumed
+    :param table: a DynamoDB Table resource
+    :param key_condition_expression:
+    :param str index_name: the secondary index to query, if any
+    :param list[str] projection: the attributes to retrieve, or None for all attributes
+    :param filter_expression:
+    :param int page_size: the maximum number of items to evaluate per request
+    :param int limit: the maximum number of items to return in total
+    :param bool scan_index_forward: False to return items in descending order of range key
+    :param bool consistent_read:
+    :return: generator
+    """
+    kwargs = {
+        'KeyConditionExpression': key_condition_expression,
+        'ScanIndexForward': scan_index_forward,
+        'ConsistentRead': consistent_read,
+    }
+    kwargs.update(_get_read_kwargs(index_name, projection, filter_expression))
+
+    returned = 0
+    while True:
+        if limit is not None:
+            # Don't ask for (and pay for) more items than we are going to return
+            kwargs['Limit'] = min(page_size or limit, limit - returned)
+        elif page_size is not None:
+            kwargs['Limit'] = page_size
+
+        ret = table.query(**kwargs)
+        for item in ret['Items']:
+            yield item
+            returned += 1
+            if limit is not None and returned >= limit:
+                return
+
+        if 'LastEvaluatedKey' not in ret:
             # No more items
-            return ret['Items']
+            return
+        kwargs['ExclusiveStartKey'] = ret['LastEvaluatedKey']
+
+
+def get_page(table, key_condition_expression=None, *, index_name=None, projection=None, filter_expression=None,
+             page_size, start_key=None, deadline=None):
+    """
+    Get one page of the items matching a query or, if there is no key condition, of a scan of the whole table.
+    DynamoDB filters items after limiting how many it reads, so further requests are made until the page is full, there
+    are no more items, or the deadline has passed.
+    :param table: a DynamoDB Table resource
+    :param key_condition_expression:
+    :param str index_name: the secondary index to read, if any
+    :param list[str] projection: the attributes to retrieve, or None for all attributes
+    :param filter_expression:
+    :param int page_size: the maximum number of items to return
+    :param dict start_key: the key returned with the previous page
+    :param float deadline: the `time.monotonic()` value after which to return a short page rather than read any further
+    :return: (list, dict) the items, and the key to start the next page from, or None if there are no more items
+    """
+    kwargs = _get_read_kwargs(index_name, projection, filter_expression)
+    if key_condition_expression is not None:
+        kwargs['KeyConditionExpression'] = key_condition_expression
+
+    items = []
+    while True:
+        # Never read past the end of the page, so that the next page can start exactly where this one ended
+        kwargs['Limit'] = page_size - len(items)
+        if start_key is not None:
+            kwargs['ExclusiveStartKey'] = start_key
+
+        ret = table.query(**kwargs) if key_condition_expression is not None else table.scan(**kwargs)
+        items.extend(ret['Items'])
+        start_key = ret.get('LastEvaluatedKey')
+        if start_key is None or len(items) >= page_size:
+            return items, start_key
+        if deadline is not None and time.monotonic() >= deadline:
+            return items, start_key
+
+
+def _get_read_kwargs(index_name, projection, filter_expression):
+    kwargs = {}
+    if index_name is not None:
+        kwargs['IndexName'] = index_name
+    if projection is not None:
+        # Placeholders for every attribute, so that we don't have to worry about reserved words
+        kwargs['ProjectionExpression'] = ', '.join('#p{}'.format(i) for i in range(len(projection)))
+        kwargs['ExpressionAttributeNames'] = {'#p{}'.format(i): name for i, name in enumerate(projection)}
+    else:
+        kwargs['Select'] = 'ALL_ATTRIBUTES'
+    if filter_expression is not None:
+        kwargs['FilterExpression'] = filter_expression
+    return kwargs
@@ -1,14 +1,115 @@
 from boto3.dynamodb.conditions import Key
-from semver import VersionInfo
-import boto3
-import json
 import os
+import threading
+import time
 
-from models.entity import DynamodbEntity
+from firmwareversion import get_version_key, parse_version
+from models.entity import DynamodbEntity, SECONDARY_INDEX_STAGE
 from fathomapi.utils.exceptions import NoSuchEntityException
 
 
+VERSION_KEY_INDEX = 'device_type-version_key'
+RELEASE_VERSION_KEY_INDEX = 'device_type-release_version_key'
+
+
+def get_version_keys(version):
+    """
+    The index attributes for a firmware record.  `release_version_key` is only set for releases, so that the index
+    on it is sparse.
+    :param str version:
+    :return: dict
+    """
+    ret = {'version_key': get_version_key(version)}
+    if parse_version(version).prerelease is None:
+        ret['release_version_key'] = ret['version_key']
+    return ret
+
+
+def get_firmware_version_key_update(body):
+    """
+    The index attribute `firmware_version_key` of a device (accessory or sensor) record, for a write to the record
+    :param dict body: the fields being written
+    :return: dict `firmware_version_key`, if `firmware_version` is being written
+    """
+    if 'firmware_version' not in body:
+        return {}
+    try:
+        return {'firmware_version_key': get_version_key(body['firmware_version'])}
+    except (TypeError, ValueError):
+        # Not a semantic version (or being removed), so it can't be compared with others
+        return {'firmware_version_key': None}
+
+
+class LatestFirmwareCache:
+    """
+    Remembers the latest firmware release for each (device type, include prereleases) pair.  Entries are fresh for
+    `ttl` seconds; for a further `stale_ttl` seconds the stale entry is still returned while a background thread
+    fetches a new one.
+    """
+    def __init__(self, ttl, stale_ttl):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        :param tuple key: (device_type, include_prerelease)
+        :param callable loader: called with the key to fetch the latest release, returning None if there is none
+        :return: dict|None
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            item, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                return item
+            elif age < self.ttl + self.stale_ttl:
+                self._refresh_in_background(key, loader)
+                return item
+        return self._refresh(key, loader)
+
+    def invalidate(self, device_type=None):
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if device_type is None or key[0] == device_type:
+                    del self._entries[key]
+
+    def _refresh(self, key, loader):
+        item = loader(*key)
+        with self._lock:
+            self._entries[key] = (item, time.monotonic())
+        return item
+
+    def _refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def _run():
+            try:
+                self._refresh(key, loader)
+            except Exception as e:
+                # Keep serving the stale entry; we'll try again on the next request
+                print(e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=_run, daemon=True).start()
+
+
+_latest_cache = LatestFirmwareCache(
+    ttl=float(os.environ.get('FIRMWARE_CACHE_TTL', 300)),
+    stale_ttl=float(os.environ.get('FIRMWARE_CACHE_STALE_TTL', 3600)),
+)
+
+
 class Firmware(DynamodbEntity):
+    _schema_name = 'firmware'
+    _dynamodb_table_name = os.environ.get('DYNAMODB_FIRMWARE_TABLE_NAME')
 
     def __init__(self, device_type, version, updated_date=None):
         super().__init__({'device_type': device_type, 'version': version})
@@ -22,26 +123,61 @@ class Firmware(DynamodbEntity):
     def version(self):
         return self.primary_key['version']
 
-    def _get_dynamodb_resource(self):
-        return boto3.resource('dynamodb').Table(os.environ['DYNAMODB_FIRMWARE_TABLE_NAME'])
-
-    @staticmethod
-    def schema():
-        with open('schemas/firmware.json', 'r') as f:
-            return json.load(f)
-
-    def get(self):
+    def get(self, include_prerelease=True):
         if self.version.upper() == 'LATEST':
-            res = self._query_dynamodb(Key('device_type').eq(self.device_type))
+            res = _latest_cache.get((self.device_type, include_prerelease), self._get_latest)
+            if res is not None:
+                # Don't let callers modify the cached copy
+                res = dict(res)
         else:
-            res = self._query_dynamodb(Key('device_type').eq(self.device_type) & Key('version').eq(self.version))
+            kcx = Key('device_type').eq(self.device_type) & Key('version').eq(self.version)
+            res = next(self._iterate_dynamodb(kcx, limit=1), None)
 
-        if len(res) == 0:
+        if res is None:
             raise NoSuchEntityException()
-        elif len(res) == 1:
-            return res[0]
+        return res
+
+    @classmethod
+    def _get_latest(cls, device_type, include_prerelease):
+        if include_prerelease or SECONDARY_INDEX_STAGE >= 2:
+            # Only releases have a release_version_key, so that index skips prereleases
+            index_name = VERSION_KEY_INDEX if include_prerelease else RELEASE_VERSION_KEY_INDEX
+            latest = next(cls._iterate_dynamodb(
+                Key('device_type').eq(device_type),
+                index_name=index_name,
+                scan_index_forward=False,
+                limit=1,
+            ), None)
         else:
-            return max(res, key=lambda x: VersionInfo.parse(x['version']))
+            # Before the release_version_key index exists, read newest first past any newer prereleases
+            latest = next((
+                item for item in cls._iterate_dynamodb(
+                    Key('device_type').eq(device_type),
+                    index_name=VERSION_KEY_INDEX,
+                    scan_index_forward=False,
+                )
+                if parse_version(item['version']).prerelease is None
+            ), None)
+        if latest is not None:
+            return latest
+
+        # Releases which predate the version key indexes, and haven't been backfilled
+        # (see scripts/backfill_firmware_version_keys.py)
+        versions = [
+            item for item in cls._iterate_dynamodb(Key('device_type').eq(device_type))
+            if include_prerelease or parse_version(item['version']).prerelease is None
+        ]
+        return max(versions, key=lambda x: parse_version(x['version']), default=None)
+
+    @staticmethod
+    def invalidate_latest(device_type=None):
+        _latest_cache.invalidate(device_type)
+
+    def create(self, body):
+        body.update(get_version_keys(self.version))
+        ret = super().patch(body, True)
+        self.invalidate_latest(self.device_type)
+        return ret
 
     def patch(self, body, upsert=True):
         if upsert:
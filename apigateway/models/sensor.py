@@ -1,13 +1,26 @@
-import boto3
+from collections import OrderedDict
 
 from fathomapi.api.config import Config
-from fathomapi.models.dynamodb_entity import DynamodbEntity
+from fathomapi.utils.exceptions import InvalidSchemaException
+from listing import ListQuery, get_list_page
+from models.entity import DynamodbEntity
+from models.firmware import get_firmware_version_key_update
+
+
+def normalise_mac_address(mac_address):
+    # Some sensors report only the first four groups of their address
+    if len(mac_address.split(":")) == 4:
+        mac_address += ":00:00"
+    return mac_address.upper()
+
+
+# Sparse: only sensors with a semantic firmware version, and a hardware model
+HARDWARE_MODEL_INDEX = 'hardware_model-firmware_version_key'
 
 
 class Sensor(DynamodbEntity):
+    _schema_name = 'sensor'
     _dynamodb_table_name = Config.get('DYNAMODB_SENSOR_TABLE_NAME')
-    # def _get_dynamodb_resource(self):
-    #     return boto3.resource('dynamodb').Table(Config.get('DYNAMODB_SENSOR_TABLE_NAME'))
 
     def __init__(self, mac_address):
         super().__init__({'mac_address': mac_address.upper()})
@@ -15,3 +28,94 @@ class Sensor(DynamodbEntity):
     @property
     def mac_address(self):
         return self.primary_key['mac_address']
+
+    @classmethod
+    def get_page(cls, args):
+        """
+        One page of a listing of sensors, which may be filtered (see listing.py)
+        :param args: the query string
+        :return: (list[dict], str) the sensors, and the continuation token for the next page
+        """
+        fields = [field for field in cls.schema()['properties'] if field != 'firmware_version_key']
+        indexes = OrderedDict([(HARDWARE_MODEL_INDEX, ('hardware_model', 'firmware_version_key'))])
+        return get_list_page(cls._get_dynamodb_resource(), ListQuery(args, fields), indexes)
+
+    def patch(self, body, create=False):
+        # Keep the firmware version index up to date
+        return super().patch(dict(body, **get_firmware_version_key_update(body)), create)
+
+    def upsert(self, body, defaults=None):
+        return super().upsert(dict(body, **get_firmware_version_key_update(body)), defaults)
+
+    @classmethod
+    def upsert_many(cls, bodies, defaults=None, on_change=None, merge_patch=False):
+        """
+        Record the state of several sensors with one batch read and at most one batch write.  Each sensor's state is
+        compared against what is stored, and only sensors whose state has changed are written.
+
+        The batch write replaces whole items, and can't be conditional, so this doesn't protect against lost updates:
+        a change written to one of the sensors by a concurrent request, between the read and the write, is
+        overwritten.  The read is strongly consistent, so at least every write which finished beforehand (including
+        the creation of a sensor, and its created_date) is preserved.  Use `upsert()` for writes which mustn't be lost.
+        :param list[dict] bodies: the state of each sensor, including its mac_address
+        :param dict defaults: values for fields which are only written if the sensor doesn't have them, eg created_date
+        :param dict on_change: values for fields to write whenever a sensor is written, eg updated_date
+        :param bool merge_patch: True to treat each body as a merge patch from a client: a null removes the field, and
+            if any sensor can't be written (because a required field is missing, or an immutable one would change) an
+            InvalidSchemaException is raised and nothing is written.  Otherwise nulls are ignored, and such sensors are
+            skipped.
+        :return: list[dict] the state of each sensor after the write, whether or not it needed writing
+        """
+        defaults = defaults or {}
+        on_change = on_change or {}
+
+        # If a sensor appears more than once, the last state wins
+        sensors = OrderedDict((normalise_mac_address(body['mac_address']), body) for body in bodies)
+        stored_sensors = cls.get_many([{'mac_address': mac_address} for mac_address in sensors], consistent_read=True)
+
+        ret = []
+        items = []
+        for mac_address, body in sensors.items():
+            sensor = cls(mac_address)
+            stored = stored_sensors.get(mac_address)
+            if merge_patch and stored is not None:
+                immutable_fields = [
+                    key for key in sensor.get_fields(immutable=True, primary_key=False)
+                    if body.get(key) is not None and key in stored and stored[key] != sensor.cast(key, body[key])
+                ]
+                if len(immutable_fields) > 0:
+                    raise InvalidSchemaException(
+                        'Cannot modify value of immutable parameter: {}'.format(', '.join(immutable_fields))
+                    )
+
+            fields = sensor.get_fields(immutable=None if stored is None or merge_patch else False, primary_key=False)
+            changes = {
+                key: None if body[key] is None else sensor.cast(key, body[key]) for key in fields
+                if key in body and (body[key] is not None or merge_patch) and key not in on_change
+            }
+            if stored is not None:
+                changes = {key: value for key, value in changes.items() if stored.get(key) != value}
+                if len(changes) == 0:
+                    ret.append(stored)
+                    continue
+
+            item = dict(stored or sensor.primary_key)
+            for key, value in defaults.items():
+                item.setdefault(key, value)
+            item.update(changes)
+            item.update(on_change)
+            item.update(get_firmware_version_key_update(changes))
+            # As in a merge patch, null removes the field; nor could a null be the key of a secondary index
+            item = {key: value for key, value in item.items() if value is not None}
+
+            missing_fields = [key for key in sensor.get_fields(required=True) if key not in item]
+            if len(missing_fields) > 0:
+                if merge_patch:
+                    raise InvalidSchemaException('Missing required parameter: {}'.format(missing_fields[0]))
+                print('Not creating sensor {}: missing {}'.format(mac_address, ', '.join(missing_fields)))
+                continue
+            items.append(item)
+            ret.append(item)
+
+        cls.put_many(items)
+        return ret
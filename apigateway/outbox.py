@@ -0,0 +1,199 @@
+"""
+A durable outbox for side effects of requests, such as calls to other services.
+
+Requests record a message describing each side effect, and a separate worker performs them.  Within a unit of work the
+messages are sent once the request's writes have been flushed, so a side effect is only recorded if the write it
+belongs to succeeded.  Messages go to the SQS queue named by OUTBOX_QUEUE_URL or, when that isn't set (eg when running
+locally), to a SQLite database.  Each message carries an idempotency key, and a message whose key has already been
+processed is skipped, so redelivered messages only take effect once.
+"""
+from botocore.exceptions import ClientError
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from awsclients import get_client, get_table
+from concurrency import check_cancelled
+from unitofwork import get_unit_of_work
+
+OUTBOX_SEND_BATCH_SIZE = 10  # The most SQS allows
+OUTBOX_IDEMPOTENCY_TTL = int(os.environ.get('OUTBOX_IDEMPOTENCY_TTL', 7 * 24 * 3600))
+
+_handlers = {}
+
+
+class UnknownMessageTypeException(Exception):
+    pass
+
+
+def handles(message_type):
+    """
+    Register a function to perform the side effects described by a type of message.  It is called with the message's
+    payload as keyword arguments.
+    :param str message_type:
+    """
+    def decorator(func):
+        _handlers[message_type] = func
+        return func
+    return decorator
+
+
+def enqueue(message_type, payload, idempotency_key):
+    """
+    Record a side effect to be performed by the worker
+    :param str message_type:
+    :param dict payload: must be JSON-serialisable
+    :param str idempotency_key: identifies the side effect, so that it is only performed once however many times it is
+        enqueued or delivered
+    """
+    message = {'id': str(uuid.uuid4()), 'type': message_type, 'payload': payload, 'idempotency_key': idempotency_key}
+    unit_of_work = get_unit_of_work()
+    if unit_of_work is None:
+        check_cancelled()
+        _get_queue().send([message])
+    else:
+        unit_of_work.defer('outbox', lambda messages: _get_queue().send(messages), message)
+
+
+def process(messages):
+    """
+    Perform the side effects described by a batch of messages
+    :param list[dict] messages:
+    :return: list[str] the ids of the messages which could not be processed, and should be retried
+    """
+    failed = []
+    idempotency_store = _get_idempotency_store()
+    for message in messages:
+        key = '{}:{}'.format(message['type'], message['idempotency_key'])
+        try:
+            if idempotency_store.is_processed(key):
+                print(json.dumps({'skipped_duplicate': key}))
+                continue
+            if message['type'] not in _handlers:
+                raise UnknownMessageTypeException(message['type'])
+            _handlers[message['type']](**message['payload'])
+            idempotency_store.mark_processed(key)
+        except Exception as e:
+            print(json.dumps({'message_id': message['id'], 'exception': str(e)}))
+            failed.append(message['id'])
+    return failed
+
+
+class SqsQueue:
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+
+    def send(self, messages):
+        for i in range(0, len(messages), OUTBOX_SEND_BATCH_SIZE):
+            batch = messages[i:i + OUTBOX_SEND_BATCH_SIZE]
+            res = get_client('sqs').send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(n), 'MessageBody': json.dumps(message)} for n, message in enumerate(batch)],
+            )
+            if len(res.get('Failed', [])) > 0:
+                raise Exception('Could not enqueue {} messages: {}'.format(len(res['Failed']), res['Failed'][0]))
+
+
+class SqliteQueue:
+    """
+    A stand-in for the queue and idempotency store when running locally
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, body TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS processed (key TEXT PRIMARY KEY, expiry_date INTEGER)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def send(self, messages):
+        with self._lock, self._connect() as connection:
+            connection.executemany(
+                'INSERT INTO messages (id, body) VALUES (?, ?)',
+                [(message['id'], json.dumps(message)) for message in messages]
+            )
+
+    def receive(self, max_messages=OUTBOX_SEND_BATCH_SIZE):
+        with self._lock, self._connect() as connection:
+            rows = connection.execute('SELECT body FROM messages ORDER BY rowid LIMIT ?', (max_messages,)).fetchall()
+        return [json.loads(body) for body, in rows]
+
+    def delete(self, message_ids):
+        with self._lock, self._connect() as connection:
+            connection.executemany('DELETE FROM messages WHERE id = ?', [(message_id,) for message_id in message_ids])
+
+    def is_processed(self, key):
+        with self._lock, self._connect() as connection:
+            row = connection.execute(
+                'SELECT 1 FROM processed WHERE key = ? AND expiry_date > ?', (key, int(time.time()))
+            ).fetchone()
+        return row is not None
+
+    def mark_processed(self, key):
+        with self._lock, self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO processed (key, expiry_date) VALUES (?, ?)',
+                (key, int(time.time()) + OUTBOX_IDEMPOTENCY_TTL)
+            )
+
+
+class DynamodbIdempotencyStore:
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def is_processed(self, key):
+        res = get_table(self.table_name).get_item(Key={'id': key}, ConsistentRead=True)
+        # DynamoDB only deletes expired items eventually
+        return 'Item' in res and res['Item']['expiry_date'] > int(time.time())
+
+    def mark_processed(self, key):
+        try:
+            get_table(self.table_name).put_item(
+                Item={'id': key, 'expiry_date': int(time.time()) + OUTBOX_IDEMPOTENCY_TTL},
+            )
+        except ClientError as e:
+            # The side effect has happened; at worst a redelivery will repeat it
+            print(json.dumps({'exception': str(e)}))
+
+
+_local_queue = None
+
+
+def _get_local_queue():
+    global _local_queue
+    if _local_queue is None:
+        _local_queue = SqliteQueue(os.environ.get('OUTBOX_SQLITE_PATH', '/tmp/outbox.sqlite'))
+    return _local_queue
+
+
+def _get_queue():
+    if 'OUTBOX_QUEUE_URL' in os.environ:
+        return SqsQueue(os.environ['OUTBOX_QUEUE_URL'])
+    return _get_local_queue()
+
+
+def _get_idempotency_store():
+    if 'DYNAMODB_IDEMPOTENCY_TABLE_NAME' in os.environ:
+        return DynamodbIdempotencyStore(os.environ['DYNAMODB_IDEMPOTENCY_TABLE_NAME'])
+    return _get_local_queue()
+
+
+def drain_local_queue():
+    """
+    Process everything in the local stand-in queue
+    """
+    queue = _get_local_queue()
+    while True:
+        messages = queue.receive()
+        if len(messages) == 0:
+            return
+        failed = process(messages)
+        queue.delete([message['id'] for message in messages if message['id'] not in failed])
+        if len(failed) == len(messages):
+            # Nothing is succeeding; leave the rest for next time
+            return
@@ -1,13 +1,13 @@
-import boto3
 import json
 import os
 
 from aws_xray_sdk.core import xray_recorder
+from awsclients import get_client
 
 
 @xray_recorder.capture('querypostgres.query_postgres')
 def query_postgres(query, parameters):
-    lambda_client = boto3.client('lambda', region_name=os.environ['AWS_REGION'])
+    lambda_client = get_client('lambda', region_name=os.environ['AWS_REGION'])
     res = json.loads(lambda_client.invoke(
         FunctionName='arn:aws:lambda:{AWS_REGION}:{AWS_ACCOUNT_ID}:function:infrastructure-{ENVIRONMENT}-querypostgres'.format(**os.environ),
         Payload=json.dumps({
@@ -1,23 +1,47 @@
 from datetime import datetime, timedelta
 from flask import request, Blueprint
-import boto3
 from boto3.dynamodb.conditions import Key
+from functools import partial
 import os
+import time
 
+from awsclients import get_table
+from clockdrift import CLOCK_DRIFT_MIN_INTERVAL
+from concurrency import TaskGraph, get_request_deadline
 from fathomapi.api.config import Config
 from fathomapi.comms.service import Service
 from fathomapi.utils.decorators import require
-from fathomapi.utils.exceptions import InvalidSchemaException, NoSuchEntityException, DuplicateEntityException
+from fathomapi.utils.exceptions import ApplicationException, InvalidSchemaException, NoSuchEntityException
 from fathomapi.utils.xray import xray_recorder
 from fathomapi.utils.formatters import format_datetime, parse_datetime
+from idempotency import idempotent
 from models.accessory import Accessory
 from models.firmware import Firmware
 from models.sensor import Sensor
 from models.accessory_data import AccessoryData
+from models.entity import iterate_query
+from synclog import encode_sync_record
+import outbox
+from unitofwork import unit_of_work
 
 app = Blueprint('accessory', __name__)
 PREPROCESSING_API_VERSION = '2_0'
-USERS_API_VERSION = '2_4'
+SYNC_FIRMWARE_TYPES = ['accessory', 'ankle', 'hip']  # , 'sensor']
+SYNC_FIRMWARE_TIMEOUT = float(os.environ.get('SYNC_FIRMWARE_TIMEOUT', 2))
+SYNC_SERVICE_TIMEOUT = float(os.environ.get('SYNC_SERVICE_TIMEOUT', 10))
+SYNC_BATCH_MAX_SYNCS = int(os.environ.get('SYNC_BATCH_MAX_SYNCS', 100))
+CHECK_SYNC_MAX_WAIT = float(os.environ.get('CHECK_SYNC_MAX_WAIT', 20))
+CHECK_SYNC_POLL_INTERVAL = float(os.environ.get('CHECK_SYNC_POLL_INTERVAL', 1))
+BATCH_GET_MAX_ACCESSORIES = int(os.environ.get('BATCH_GET_MAX_ACCESSORIES', 500))
+
+
+@app.route('/', methods=['GET'])
+@require.authenticated.any
+@xray_recorder.capture('routes.accessory.list')
+@unit_of_work
+def handle_accessory_list():
+    accessories, continuation_token = Accessory.get_page(request.args)
+    return {'accessories': accessories, 'continuation_token': continuation_token}
 
 
 @app.route('/<mac_address>/register', methods=['POST'])
@@ -25,11 +49,8 @@ USERS_API_VERSION = '2_4'
 def handle_accessory_register(mac_address):
     xray_recorder.current_subsegment().put_annotation('accessory_id', mac_address)
     accessory = Accessory(mac_address)
+    # Also creates the accessory's AccessoryData
     accessory.create(request.json)
-    try:
-        AccessoryData(mac_address).create(request.json)
-    except DuplicateEntityException as e:  #if there's one already do nothing
-        print(e)
 
     return {"status": "success"}, 201
 
@@ -37,6 +58,7 @@ def handle_accessory_register(mac_address):
 @app.route('/<mac_address>', methods=['GET'])
 @require.authenticated.any
 @xray_recorder.capture('routes.accessory.get')
+@unit_of_work
 def handle_accessory_get(mac_address):
     xray_recorder.current_subsegment().put_annotation('accessory_id', mac_address)
     accessory = Accessory(mac_address).get()
@@ -52,9 +74,40 @@ def handle_accessory_get(mac_address):
     return res
 
 
+@app.route('/batch_get', methods=['POST'])
+@require.authenticated.any
+@require.body({'mac_addresses': list})
+@xray_recorder.capture('routes.accessory.batch_get')
+@unit_of_work
+def handle_accessory_batch_get():
+    mac_addresses = request.json['mac_addresses']
+    if len(mac_addresses) > BATCH_GET_MAX_ACCESSORIES:
+        raise InvalidSchemaException(f'mac_addresses must contain at most {BATCH_GET_MAX_ACCESSORIES} elements')
+    if not all(isinstance(mac_address, str) for mac_address in mac_addresses):
+        raise InvalidSchemaException('mac_addresses must be a list of strings')
+
+    res = {'accessories': {}}
+    for mac_address, accessory in Accessory.get_many(mac_addresses).items():
+        if isinstance(accessory, Exception):
+            res['accessories'][mac_address] = {'error': _format_error(accessory)}
+        else:
+            res['accessories'][mac_address] = {'accessory': accessory}
+    # The same for every accessory, so only looked up once
+    res['latest_firmware'] = {'accessory_version': _get_latest_firmware_version('accessory')}
+    return res
+
+
+def _format_error(exception):
+    if isinstance(exception, ApplicationException):
+        return {'status': exception.status_code, 'code': exception.status_code_text, 'message': exception.message}
+    return {'status': 500, 'code': 'ServerError', 'message': str(exception)}
+
+
 @app.route('/<mac_address>', methods=['PATCH'])
 @require.authenticated.any
 @xray_recorder.capture('routes.accessory.patch')
+@idempotent
+@unit_of_work
 def handle_accessory_patch(mac_address):
     xray_recorder.current_subsegment().put_annotation('accessory_id', mac_address)
     accessory = Accessory(mac_address)
@@ -84,6 +137,8 @@ def handle_accessory_login(mac_address):
 @require.authenticated.any
 @require.body({'event_date': str, 'accessory': str, 'sensors': list})
 @xray_recorder.capture('routes.accessory.sync')
+@idempotent
+@unit_of_work
 def handle_accessory_sync(mac_address):
     xray_recorder.current_subsegment().put_annotation('accessory_id', mac_address)
     res = {}
@@ -102,51 +157,179 @@ def handle_accessory_sync(mac_address):
         request.json['accessory']['local_time'] = res['time']['local']
     if 'true' in res['time']:
         request.json['accessory']['true_time'] = res['time']['true']
-    res['accessory'] = accessory.patch(request.json['accessory'])
-    if 'true_time' in res['accessory']:
-        del res['accessory']['true_time']
-    if 'local_time' in res['accessory']:
-        del res['accessory']['local_time']
-
-    
-    res['sensors'] = []
-    for sensor in request.json['sensors']:
-        # TODO work out how we're actually persisting this data
-        res['sensors'].append(sensor)
+
+    res['sensors'] = list(request.json['sensors'])
 
     res['wifi'] = request.json.get('wifi', {})
 
+    graph = _get_sync_graph(accessory, event_date, request.json['accessory'], res['sensors'])
     # Save the data in a time-rolling ddb log table
-    _save_sync_record(mac_address, event_date, res)
+    graph.add(
+        'sync_record',
+        lambda patched_accessory: _save_sync_record(accessory, event_date, dict(res, accessory=patched_accessory)),
+        depends_on=['patched_accessory'],
+    )
+    return _run_sync_graph(graph)
 
-    result = {}
-    result['latest_firmware'] = {}
-    for firmware_type in ['accessory', 'ankle', 'hip']:  #, 'sensor']:
-        try:
-            result['latest_firmware'][f'{firmware_type}_version'] = Firmware(firmware_type, 'latest').get()['version']
-        except NoSuchEntityException:
-            result['latest_firmware'][f'{firmware_type}_version'] = None
 
-    user_id = res['accessory']['owner_id']
-    if user_id is not None:
-        if 'battery_level' in res['accessory'] and res['accessory']['battery_level'] < .3:
-            try:
-                notify_user_of_low_battery(user_id)
-            except:
-                print('Error in notifying user')
+@app.route('/<mac_address>/sync/batch', methods=['POST'])
+@require.authenticated.any
+@require.body({'syncs': list})
+@xray_recorder.capture('routes.accessory.sync_batch')
+@idempotent
+@unit_of_work
+def handle_accessory_sync_batch(mac_address):
+    xray_recorder.current_subsegment().put_annotation('accessory_id', mac_address)
+    syncs = request.json['syncs']
+    if len(syncs) == 0 or len(syncs) > SYNC_BATCH_MAX_SYNCS:
+        raise InvalidSchemaException(f'syncs must contain between 1 and {SYNC_BATCH_MAX_SYNCS} elements')
+    for sync in syncs:
+        if not isinstance(sync, dict) or not isinstance(sync.get('accessory'), dict) \
+                or not isinstance(sync.get('sensors'), list):
+            raise InvalidSchemaException('Each sync must have an accessory and a list of sensors')
         try:
-            result['last_session'] = get_last_session(user_id)
+            parse_datetime(sync['event_date'])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidSchemaException("event_date parameter must be in '%Y-%m-%dT%H:%M:%SZ' format")
+    syncs = sorted(syncs, key=lambda sync: sync['event_date'])
 
-            if result['last_session'] is not None:
-                result['last_session'] = correct_clock_drift(result['last_session'], mac_address)
-        except Exception:
-            result['last_session'] = None
-            return result, 503
-    else:
-        result['last_session'] = None
+    event_date = format_datetime(datetime.utcfromtimestamp(Config.get('REQUEST_TIME') / 1000))
+    accessory = Accessory(mac_address)
+
+    # Every sync contributes to the clock drift model, but only the newest state is written to the accessory
+    for sync in syncs[:-1]:
+        _record_clock_sync(accessory, sync.get('time', {}))
+    newest = syncs[-1]
+    accessory_body = dict(newest['accessory'], last_sync_date=event_date)
+    if 'local' in newest.get('time', {}):
+        accessory_body['local_time'] = newest['time']['local']
+    if 'true' in newest.get('time', {}):
+        accessory_body['true_time'] = newest['time']['true']
+
+    graph = _get_sync_graph(accessory, event_date, accessory_body, newest['sensors'])
+    # The log records what the accessory reported at each sync, when it happened.  This only waits for the patch so
+    # that the two don't update AccessoryData at the same time.
+    graph.add(
+        'sync_record',
+        lambda patched_accessory: _save_sync_records(accessory, [
+            (sync['event_date'], {
+                'accessory': sync['accessory'],
+                'sensors': sync['sensors'],
+                'wifi': sync.get('wifi', {}),
+                'time': sync.get('time', {}),
+            })
+            for sync in syncs
+        ], start_with_keyframe=True),
+        depends_on=['patched_accessory'],
+    )
+    return _run_sync_graph(graph)
+
+
+def _record_clock_sync(accessory, sync_time):
+    if sync_time.get('true') is not None and sync_time.get('local') is not None:
+        accessory_data = AccessoryData(accessory.primary_key['mac_address'])
+        body = accessory_data.get_clock_drift_update(sync_time['true'], sync_time['local'])
+        body['true_time'] = sync_time['true']
+        body['local_time'] = sync_time['local']
+        accessory_data.upsert(body)
+
+
+def _get_sync_graph(accessory, event_date, accessory_body, sensors):
+    """
+    Most of the work for a sync is independent, so do it concurrently; only the patched accessory is needed by other
+    steps.  Anything which the device can do without is allowed to fail or time out.
+    """
+    graph = TaskGraph()
+    graph.add('patched_accessory', partial(_patch_accessory, accessory, accessory_body))
+    graph.add(
+        'sensor_states',
+        lambda patched_accessory: _save_sensor_states(sensors, patched_accessory['owner_id'], event_date),
+        depends_on=['patched_accessory'],
+        fallback=None,
+    )
+    for firmware_type in SYNC_FIRMWARE_TYPES:
+        graph.add(
+            f'{firmware_type}_version',
+            partial(_get_latest_firmware_version, firmware_type),
+            timeout=SYNC_FIRMWARE_TIMEOUT,
+            fallback=None,
+        )
+    graph.add(
+        'low_battery_notification',
+        lambda patched_accessory: _notify_if_battery_low(patched_accessory, event_date),
+        depends_on=['patched_accessory'],
+        fallback=None,
+    )
+    graph.add(
+        'last_session',
+        lambda patched_accessory: _get_corrected_last_session(
+            patched_accessory['owner_id'], accessory.primary_key['mac_address']
+        ),
+        depends_on=['patched_accessory'],
+        timeout=SYNC_SERVICE_TIMEOUT,
+        fallback=None,
+    )
+    return graph
+
+
+def _run_sync_graph(graph):
+    steps = graph.run()
+
+    result = {}
+    result['latest_firmware'] = {
+        f'{firmware_type}_version': steps[f'{firmware_type}_version'] for firmware_type in SYNC_FIRMWARE_TYPES
+    }
+    result['last_session'] = steps['last_session']
+    if 'last_session' in graph.failures:
+        return result, 503
     return result
 
 
+def _patch_accessory(accessory, body):
+    patched_accessory = accessory.patch(body)
+    if 'true_time' in patched_accessory:
+        del patched_accessory['true_time']
+    if 'local_time' in patched_accessory:
+        del patched_accessory['local_time']
+    return patched_accessory
+
+
+@xray_recorder.capture('routes.accessory._save_sensor_states')
+def _save_sensor_states(sensors, owner_id, event_date):
+    on_change = {'updated_date': event_date}
+    if owner_id is not None:
+        on_change['last_user_id'] = owner_id
+    # Copies, as the sync record step normalises the sensors' mac addresses in place
+    return Sensor.upsert_many(
+        [dict(sensor) for sensor in sensors if 'mac_address' in sensor],
+        defaults={'created_date': event_date},
+        on_change=on_change,
+    )
+
+
+def _get_latest_firmware_version(firmware_type):
+    try:
+        return Firmware(firmware_type, 'latest').get()['version']
+    except NoSuchEntityException:
+        return None
+
+
+def _notify_if_battery_low(patched_accessory, event_date):
+    user_id = patched_accessory['owner_id']
+    if user_id is not None:
+        if 'battery_level' in patched_accessory and patched_accessory['battery_level'] < .3:
+            outbox.enqueue('notify_low_battery', {'user_id': user_id}, idempotency_key=f'{user_id}:{event_date}')
+
+
+def _get_corrected_last_session(user_id, mac_address):
+    if user_id is None:
+        return None
+    last_session = get_last_session(user_id)
+    if last_session is not None:
+        last_session = correct_clock_drift(last_session, mac_address)
+    return last_session
+
+
 @app.route('/<mac_address>/check_sync', methods=['POST'])
 @require.authenticated.any
 @xray_recorder.capture('routes.accessory.check_sync')
@@ -156,20 +339,75 @@ def handle_accessory_check_sync(mac_address):
     end_time = datetime.utcfromtimestamp(Config.get('REQUEST_TIME') / 1000) + timedelta(seconds=10)
     start_time = end_time - timedelta(seconds=seconds_elapsed + 20)
     start_date_time = format_datetime(start_time)
-    end_date_time = format_datetime(end_time)
-    if sync_in_range(mac_address.upper(), start_date_time, end_date_time):
-        return {'sync_found': True}
-    else:
-        return {'sync_found': False}
+
+    # Optionally hold the request open until a sync arrives, rather than have the client keep polling
+    wait = request.json.get('wait', 0)
+    if not isinstance(wait, (int, float)) or wait < 0:
+        raise InvalidSchemaException('wait must be a non-negative number of seconds')
+    wait_until = time.monotonic() + min(wait, CHECK_SYNC_MAX_WAIT)
+    deadline = get_request_deadline()
+    if deadline is not None:
+        wait_until = min(wait_until, deadline - CHECK_SYNC_POLL_INTERVAL)
+
+    while True:
+        # Syncs are only ever in the past, so there has been one in range if the latest one is recent enough
+        last_sync_date = _get_last_sync_date(mac_address)
+        if last_sync_date is not None and last_sync_date >= start_date_time:
+            return {'sync_found': True}
+        if time.monotonic() + CHECK_SYNC_POLL_INTERVAL > wait_until:
+            return {'sync_found': False}
+        time.sleep(CHECK_SYNC_POLL_INTERVAL)
+
+
+def _get_last_sync_date(mac_address):
+    # Strongly consistent, so that a sync which has just been written is seen by the next poll
+    item = AccessoryData.get_many([{'id': mac_address.upper()}], consistent_read=True).get(mac_address.upper())
+    return None if item is None else item.get('last_sync_date')
 
 
 @xray_recorder.capture('routes.accessory._save_sync_record')
-def _save_sync_record(mac_address, event_date, body):
+def _save_sync_record(accessory, event_date, body):
+    _save_sync_records(accessory, [(event_date, body)])
+
+
+@xray_recorder.capture('routes.accessory._save_sync_records')
+def _save_sync_records(accessory, syncs, start_with_keyframe=False):
+    """
+    :param Accessory accessory:
+    :param list syncs: (event_date, body) for each sync, in chronological order
+    :param bool start_with_keyframe: whether to record the first sync in full, rather than as changes from the last
+        sync in the log, eg because the syncs happened before it
+    """
+    accessory_data = AccessoryData(accessory.primary_key['mac_address'])
+    try:
+        state = None if start_with_keyframe else accessory_data.get().get('sync_log_state')
+    except NoSuchEntityException:
+        state = None
+
+    items = []
+    for event_date, body in syncs:
+        item, state = encode_sync_record(_get_sync_record(accessory, event_date, body), state)
+        items.append(item)
+
+    dynamodb_resource = get_table(os.environ['DYNAMODB_ACCESSORYSYNCLOG_TABLE_NAME'])
+    if len(items) == 1:
+        dynamodb_resource.put_item(Item=items[0])
+    else:
+        # A batch can't contain the same key twice, so if two syncs have the same event_date the later one wins
+        with dynamodb_resource.batch_writer(overwrite_by_pkeys=['accessory_mac_address', 'event_date']) as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+    # The next record is encoded against this one
+    accessory_data.upsert({'sync_log_state': state})
+
+
+def _get_sync_record(accessory, event_date, body):
     item = {
-        'accessory_mac_address': mac_address.upper(),
+        'accessory_mac_address': accessory.primary_key['mac_address'],
         'event_date': event_date,
     }
-    accessory_fields = Accessory(mac_address).get_fields(immutable=False, primary_key=False)
+    accessory_fields = accessory.get_fields(immutable=False, primary_key=False)
     for k in accessory_fields:
         if k in body['accessory'] and body['accessory'][k] is not None:
             item['accessory_{}'.format(k)] = body['accessory'][k]
@@ -200,8 +438,7 @@ def _save_sync_record(mac_address, event_date, body):
     if 'true' in body['time']:
         item['true_time'] = body['time']['true']
 
-    dynamodb_resource = boto3.resource('dynamodb').Table(os.environ['DYNAMODB_ACCESSORYSYNCLOG_TABLE_NAME'])
-    dynamodb_resource.put_item(Item=item)
+    return item
 
 
 def get_last_session(user_id):
@@ -222,12 +459,36 @@ def correct_clock_drift(last_session, accessory_id):
                                                                       last_true_time)
             last_session['event_date'] = event_date
             session_id = last_session['id']
-            # TODO: preprocessing does not have async queue
-            patch_session(session_id, offset_applied)
+            outbox.enqueue(
+                'patch_session',
+                {'session_id': session_id, 'offset_applied': offset_applied},
+                idempotency_key=f'{session_id}:{offset_applied}',
+            )
     return last_session
 
 
 def apply_clock_drift_correction(accessory_id, event_date, true_time_sync_before_session):
+    try:
+        clock_drift_rate = AccessoryData(accessory_id.upper()).get().get('clock_drift_rate')
+    except NoSuchEntityException:
+        clock_drift_rate = None
+    if clock_drift_rate is None:
+        # No syncs in the model yet
+        return apply_clock_drift_correction_from_next_sync(accessory_id, event_date, true_time_sync_before_session)
+
+    offset_applied = 0
+    event_date *= 1000  # convert to ms resolution
+    time_elapsed_since_last_sync = event_date - true_time_sync_before_session
+    if time_elapsed_since_last_sync > CLOCK_DRIFT_MIN_INTERVAL:  # make sure enough time has passed
+        offset_applied = round(time_elapsed_since_last_sync * float(clock_drift_rate), 0)
+        event_date += offset_applied
+    else:
+        print("recently synced, do not need to update")
+    event_date = int(event_date / 1000)  # revert back to s resolution
+    return event_date, offset_applied
+
+
+def apply_clock_drift_correction_from_next_sync(accessory_id, event_date, true_time_sync_before_session):
     next_sync = get_next_sync(accessory_id, event_date)
     offset_applied = 0
     try:
@@ -241,7 +502,7 @@ def apply_clock_drift_correction(accessory_id, event_date, true_time_sync_before
             # get time difference between events
             time_elapsed_since_last_sync = event_date - true_time_sync_before_session
             time_between_syncs = true_time_sync_after_session - true_time_sync_before_session
-            min_time = 8 * 3600 * 1000
+            min_time = CLOCK_DRIFT_MIN_INTERVAL
             if time_between_syncs > min_time and time_elapsed_since_last_sync > min_time:  # make sure enouth time has passed
                 offset_applied = round(time_elapsed_since_last_sync / time_between_syncs * error, 0)
                 event_date += offset_applied
@@ -255,13 +516,12 @@ def apply_clock_drift_correction(accessory_id, event_date, true_time_sync_before
 
 def get_next_sync(accessory_id, event_date):
     try:
-        dynamodb_resource = boto3.resource('dynamodb').Table(os.environ['DYNAMODB_ACCESSORYSYNCLOG_TABLE_NAME'])
+        dynamodb_resource = get_table(os.environ['DYNAMODB_ACCESSORYSYNCLOG_TABLE_NAME'])
         event_date_string = datetime.utcfromtimestamp(event_date).strftime("%Y-%m-%dT%H:%M:%SZ")
-        result = dynamodb_resource.query(KeyConditionExpression=Key('accessory_mac_address').eq(accessory_id.upper()) &\
-                                                                Key('event_date').gt(event_date_string))['Items']
-        if len(result) > 0:
-            result = sorted(result, key=lambda k: k['event_date'])
-            next_sync = result[0]
+        kcx = Key('accessory_mac_address').eq(accessory_id.upper()) & Key('event_date').gt(event_date_string)
+        # Items come back in event_date order, so the first one is the next sync
+        next_sync = next(iterate_query(dynamodb_resource, kcx, projection=['true_time', 'local_time'], limit=1), None)
+        if next_sync is not None:
             try:
                 return {
                     'true_time': float(next_sync.get('true_time')),
@@ -272,38 +532,3 @@ def get_next_sync(accessory_id, event_date):
     except Exception as e:  # catch all exceptions
         print(e)
     return None
-
-
-def patch_session(session_id, offset_applied):
-    try:
-        endpoint = f"session/{session_id}"
-        preprocessing_service = Service('preprocessing', PREPROCESSING_API_VERSION)
-        preprocessing_service.call_apigateway_sync(method='PATCH',
-                                                    endpoint=endpoint,
-                                                    body={'start_time_adjustment': offset_applied}
-                                                    )
-    except Exception as e:
-        print(e)
-
-
-def sync_in_range(accessory_id, start_date_time, end_date_time):
-    try:
-        dynamodb_resource = boto3.resource('dynamodb').Table(os.environ['DYNAMODB_ACCESSORYSYNCLOG_TABLE_NAME'])
-        kcx = Key('accessory_mac_address').eq(accessory_id.upper()) & \
-              Key('event_date').between(start_date_time, end_date_time)
-        result = dynamodb_resource.query(KeyConditionExpression=kcx)['Items']
-        if len(result) > 0:
-            return True
-    except Exception as e:  # catch all exceptions
-        print(e)
-    return False
-
-
-def notify_user_of_low_battery(user_id):
-    users_service = Service('users', USERS_API_VERSION)
-    body = {"message": "Your Fathom PRO kit battery is low.\nYou'll need to plug your kit in to charge soon. Use your micro-USB cable to charge your PRO Kit. Full-recharge takes 3 hours.",
-            "call_to_action": "VIEW_PLAN",
-            "expire_in": 2 * 60 * 60}  # expire in 2 hours
-    users_service.call_apigateway_async(method='POST',
-                                        endpoint=f'/user/{user_id}/notify',
-                                        body=body)
@@ -1,45 +1,213 @@
 from botocore.exceptions import ClientError
-from flask import Blueprint
+from flask import request, Blueprint
 from semver import VersionInfo
 import base64
-import boto3
 import os
+import re
+import time
 
+from awsclients import get_client, get_resource
+from binarycache import BinaryCache
+from concurrency import get_request_deadline
+from firmwaredelta import DeltaTimeoutException, create_delta, read_header
 from fathomapi.utils.decorators import require
 from fathomapi.utils.exceptions import ApplicationException, InvalidSchemaException, DuplicateEntityException
 from fathomapi.utils.xray import xray_recorder
 from models.firmware import Firmware
 
 app = Blueprint('firmware', __name__)
+FIRMWARE_CHUNK_SIZE = int(os.environ.get('FIRMWARE_CHUNK_SIZE', 256 * 1024))
+FIRMWARE_PRESIGNED_URL_EXPIRY = int(os.environ.get('FIRMWARE_PRESIGNED_URL_EXPIRY', 15 * 60))
+# Generating a delta can take a long time for a large binary, so give up after this many seconds, or this many seconds
+# before the request times out, and serve the full binary instead
+FIRMWARE_DELTA_TIMEOUT = float(os.environ.get('FIRMWARE_DELTA_TIMEOUT', 10))
+FIRMWARE_DELTA_DEADLINE_MARGIN = float(os.environ.get('FIRMWARE_DELTA_DEADLINE_MARGIN', 5))
+
+# Firmware binaries and deltas which this container has already served
+_binary_cache = BinaryCache(
+    memory_budget=int(os.environ.get('FIRMWARE_CACHE_MEMORY_BYTES', 32 * 1024 * 1024)),
+    directory=os.environ.get('FIRMWARE_CACHE_DIRECTORY', '/tmp/firmware-cache'),
+    disk_budget=int(os.environ.get('FIRMWARE_CACHE_DISK_BYTES', 256 * 1024 * 1024)),
+)
+# The deltas which this container has already run out of time generating, so as not to keep trying
+_delta_timeouts = set()
 
 
 @app.route('/<device_type>/<semver:version>', methods=['GET'])
 @xray_recorder.capture('routes.firmware.get')
 def handle_firmware_get(device_type, version):
-    return {'firmware': Firmware(device_type, version).get()}
+    include_prerelease = request.args.get('include_prerelease', 'true').lower() != 'false'
+    return {'firmware': Firmware(device_type, version).get(include_prerelease=include_prerelease)}
 
 
 @app.route('/<device_type>/<semver:version>/download', methods=['GET'])
 @xray_recorder.capture('routes.firmware.download')
 def handle_firmware_download(device_type, version):
     firmware = Firmware(device_type, version).get()
-    try:
-        s3_object = boto3.resource('s3').Object(
-            os.environ['S3_FIRMWARE_BUCKET_NAME'],
-            'firmware/{}/{}'.format(firmware['device_type'], firmware['version'])
+    s3_key = None
+    if 'from' in request.args:
+        # A delta from the version the device already has
+        base_firmware = Firmware(device_type, request.args['from']).get()
+        if base_firmware['version'] == firmware['version']:
+            raise InvalidSchemaException('Cannot generate a delta from a version to itself')
+        s3_key = _get_delta_s3_key(firmware['device_type'], base_firmware['version'], firmware['version'])
+        filename = '{}.delta'.format(firmware['device_type'])
+    if s3_key is None:
+        # Including when the delta couldn't be generated in time
+        s3_key = _get_binary_s3_key(firmware['device_type'], firmware['version'])
+        filename = '{}.bin'.format(firmware['device_type'])
+
+    if request.args.get('redirect', 'false').lower() == 'true':
+        # Let the client fetch the binary straight from S3
+        url = get_client('s3').generate_presigned_url(
+            'get_object',
+            Params={
+                'Bucket': os.environ['S3_FIRMWARE_BUCKET_NAME'],
+                'Key': s3_key,
+                'ResponseContentDisposition': 'attachment; filename={}'.format(filename),
+            },
+            ExpiresIn=FIRMWARE_PRESIGNED_URL_EXPIRY,
         )
-        body = s3_object.get()['Body'].read()
+        return '', 307, {'Location': url}
+
+    return _serve_s3_object(s3_key, filename)
+
+
+def _get_binary_s3_key(device_type, version):
+    return 'firmware/{}/{}'.format(device_type, version)
+
+
+@xray_recorder.capture('routes.firmware._get_delta_s3_key')
+def _get_delta_s3_key(device_type, from_version, to_version):
+    """
+    Get the S3 key of the delta between two versions, generating it on first request
+    :return: str, or None if the delta couldn't be generated in time
+    """
+    s3_key = 'firmware/{}/{}.from-{}.delta'.format(device_type, to_version, from_version)
+    if s3_key in _binary_cache:
+        return s3_key
+    if s3_key in _delta_timeouts:
+        return None
+
+    bucket = get_resource('s3').Bucket(os.environ['S3_FIRMWARE_BUCKET_NAME'])
+    try:
+        get_client('s3').head_object(Bucket=bucket.name, Key=s3_key)
     except ClientError as e:
-        if 'NoSuchKey' in str(e):
-            raise ApplicationException(500, 'ServerError', 'Could not locate firmware binary')
-        else:
+        if not _is_missing_object_error(e):
+            raise e
+        deadline = time.monotonic() + FIRMWARE_DELTA_TIMEOUT
+        request_deadline = get_request_deadline()
+        if request_deadline is not None:
+            deadline = min(deadline, request_deadline - FIRMWARE_DELTA_DEADLINE_MARGIN)
+        base = _read_cached(_get_cached_s3_object(_get_binary_s3_key(device_type, from_version)))
+        target = _read_cached(_get_cached_s3_object(_get_binary_s3_key(device_type, to_version)))
+        try:
+            delta = create_delta(base, target, deadline)
+        except DeltaTimeoutException as e:
+            print(e)
+            _delta_timeouts.add(s3_key)
+            return None
+        header = read_header(delta)
+        bucket.put_object(
+            Key=s3_key,
+            Body=delta,
+            ContentType='application/octet-stream',
+            Metadata={'base-sha256': header['base_checksum'], 'result-sha256': header['target_checksum']},
+        )
+    return s3_key
+
+
+def _get_cached_s3_object(s3_key):
+    """
+    Get an object from the firmware bucket via the local cache.  Firmware objects are never overwritten, so a cached
+    copy never needs revalidating against S3.
+    :param str s3_key:
+    :return: CachedObject
+    """
+    cached = _binary_cache.get(s3_key)
+    if cached is None:
+        try:
+            res = get_resource('s3').Object(os.environ['S3_FIRMWARE_BUCKET_NAME'], s3_key).get()
+        except ClientError as e:
+            if _is_missing_object_error(e):
+                raise ApplicationException(500, 'ServerError', 'Could not locate firmware binary')
             raise e
+        cached = _binary_cache.put(s3_key, res['ETag'], res['Body'].iter_chunks(FIRMWARE_CHUNK_SIZE), res.get('Metadata', {}))
+    xray_recorder.current_subsegment().put_metadata('firmware_cache', dict(_binary_cache.metrics))
+    return cached
+
+
+def _is_missing_object_error(e):
+    # HeadObject has no body, so reports a missing object with just its status code
+    return e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey')
+
+
+def _read_cached(cached, start=0, end=None):
+    try:
+        return _binary_cache.read(cached, start, end)
+    except IOError as e:
+        # Evicted from disk by another request, or corrupt; fetch it again
+        print(e)
+        _binary_cache.invalidate(cached.name)
+        return _binary_cache.read(_get_cached_s3_object(cached.name), start, end)
+
 
+def _serve_s3_object(s3_key, filename):
     headers = {
-        'Content-Disposition': 'attachment; filename={}.bin'.format(firmware['device_type']),
-        'Content-Type': 'application/octet-stream'
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': 'attachment; filename={}'.format(filename),
+        'Content-Type': 'application/octet-stream',
     }
-    return base64.encodebytes(body).decode('utf-8'), 200, headers
+    cached = _get_cached_s3_object(s3_key)
+    headers['ETag'] = cached.etag
+    if 'base-sha256' in cached.metadata:
+        headers['X-Base-Checksum'] = 'sha256={}'.format(cached.metadata['base-sha256'])
+        headers['X-Result-Checksum'] = 'sha256={}'.format(cached.metadata['result-sha256'])
+
+    byte_range = _parse_range_header(request.headers.get('Range'))
+    if byte_range is not None and 'If-Range' in request.headers and request.headers['If-Range'] != cached.etag:
+        # The object has changed since the client started downloading it, so they need to start again
+        byte_range = None
+
+    if byte_range is None:
+        body = _read_cached(cached)
+        status = 200
+    else:
+        start, end = byte_range
+        if start is None:
+            # A suffix range (the last `end` bytes)
+            start = max(cached.size - end, 0)
+            end = None
+        if start >= cached.size:
+            headers['Content-Range'] = 'bytes */{}'.format(cached.size)
+            return '', 416, headers
+        # Serve at most one chunk per request; the client can ask for the next chunk with another range
+        end = start + FIRMWARE_CHUNK_SIZE - 1 if end is None else min(end, start + FIRMWARE_CHUNK_SIZE - 1)
+        end = min(end, cached.size - 1)
+        body = _read_cached(cached, start, end)
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, cached.size)
+        status = 206
+
+    return base64.encodebytes(body).decode('utf-8'), status, headers
+
+
+def _parse_range_header(header):
+    """
+    Parse a single-range `Range` header
+    :param str header: eg `bytes=0-1023`, `bytes=1024-` or `bytes=-512`
+    :return: (start, end) tuple, where either may be None, or None if the header is absent or not understood
+    """
+    if header is None:
+        return None
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        # Malformed, or multiple ranges, which we don't support; serve the whole object
+        return None
+    start = int(match.group(1)) if match.group(1) != '' else None
+    end = int(match.group(2)) if match.group(2) != '' else None
+    if start is not None and end is not None and end < start:
+        return None
+    return start, end
 
 
 @app.route('/<device_type>/<semver:version>', methods=['POST'])
@@ -50,7 +218,7 @@ def handle_firmware_upload(device_type, version):
     if firmware.exists():
         raise DuplicateEntityException()
 
-    # TODO
+    # TODO: store the binary and call `firmware.create()`, which invalidates this container's latest firmware cache
     raise ApplicationException(501, 'Not Implemented', 'Firmware upload not implemented yet')
 
 
@@ -2,13 +2,22 @@ from flask import request, Blueprint
 import datetime
 
 from fathomapi.utils.decorators import require
+from fathomapi.utils.exceptions import InvalidSchemaException
 from fathomapi.utils.xray import xray_recorder
 
-from models.sensor import Sensor
+from models.sensor import Sensor, normalise_mac_address
 
 app = Blueprint('sensor', __name__)
 
 
+@app.route('/', methods=['GET'])
+@require.authenticated.any
+@xray_recorder.capture('routes.sensor.list')
+def handle_sensor_list():
+    sensors, continuation_token = Sensor.get_page(request.args)
+    return {'sensors': sensors, 'continuation_token': continuation_token}
+
+
 @app.route('/<mac_address>', methods=['PATCH', 'PUT'])
 @require.authenticated.any
 @xray_recorder.capture('routes.sensor.patch')
@@ -23,18 +32,23 @@ def handle_sensor_patch(mac_address):
 @require.body({'sensors': list})
 @xray_recorder.capture('routes.sensor.multipatch')
 def handle_sensor_multipatch():
-    ret = [_patch_sensor(s['mac_address'], s) for s in request.json['sensors']]
+    sensors = request.json['sensors']
+    if not all(isinstance(sensor, dict) and isinstance(sensor.get('mac_address'), str) for sensor in sensors):
+        raise InvalidSchemaException('Each sensor must have a mac_address')
+    # One batch read, and one batch write of the sensors which have changed
+    created_date = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+    ret = Sensor.upsert_many(sensors, defaults={'created_date': created_date}, merge_patch=True)
     return {'sensors': ret}
 
 
 @xray_recorder.capture('routes.sensor._patch_sensor')
 def _patch_sensor(mac_address, body):
-    if len(mac_address.split(":")) == 4:
-        mac_address += ":00:00"
-    sensor = Sensor(mac_address)
-    if not sensor.exists() or request.method == 'PUT':
-        body['created_date'] = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+    sensor = Sensor(normalise_mac_address(mac_address))
+    created_date = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+    if request.method == 'PUT':
+        body['created_date'] = created_date
         ret = sensor.create(body)
     else:
-        ret = sensor.patch(body)
+        # Creates the sensor if it doesn't exist yet, in the same round trip
+        ret = sensor.upsert(body, defaults={'created_date': created_date})
     return ret
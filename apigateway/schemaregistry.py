@@ -0,0 +1,148 @@
+from decimal import Decimal
+import json
+import os
+
+from fathomapi.utils.exceptions import InvalidSchemaException
+
+_SCHEMA_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'schemas')
+
+# Casters for `$ref` types which need more than the cast of their underlying primitive type
+_REF_CASTERS = {
+    'types.json/definitions/macaddress': lambda value: str(value).upper(),
+}
+
+_PRIMITIVE_CASTERS = {
+    'string': str,
+    'number': lambda value: Decimal(str(value)),
+}
+
+
+def _load_schemas(directory):
+    schemas = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.json'):
+            with open(os.path.join(directory, filename), 'r') as f:
+                schemas[filename] = json.load(f)
+    return schemas
+
+
+# Loaded once, at cold start
+_schemas = _load_schemas(_SCHEMA_DIRECTORY)
+_compiled = {}
+
+
+def get_schema(name):
+    """
+    Get the raw JSON schema document with the given name
+    :param str name: the name of the schema, eg `accessory` for `schemas/accessory.json`
+    :return: dict
+    """
+    return _schemas['{}.json'.format(name)]
+
+
+def resolve_ref(ref):
+    """
+    Resolve a reference of the form `types.json/definitions/macaddress` to the definition it points to
+    :param str ref:
+    :return: dict
+    """
+    filename, *path = ref.split('/')
+    if filename not in _schemas:
+        raise KeyError(ref)
+    node = _schemas[filename]
+    for part in path:
+        node = node[part]
+    return node
+
+
+def compile_schema(name, primary_key_fields):
+    """
+    Get the compiled form of a schema, for a given set of primary key fields.  Compiled schemas are cached
+    for the lifetime of the container.
+    :param str name:
+    :param tuple primary_key_fields:
+    :return: CompiledSchema
+    """
+    cache_key = (name, tuple(primary_key_fields))
+    if cache_key not in _compiled:
+        _compiled[cache_key] = CompiledSchema(get_schema(name), primary_key_fields)
+    return _compiled[cache_key]
+
+
+def _get_caster(field_type):
+    if isinstance(field_type, dict) and '$ref' in field_type:
+        ref = field_type['$ref']
+        if ref in _REF_CASTERS:
+            return _REF_CASTERS[ref]
+        return _get_caster(resolve_ref(ref).get('type'))
+    elif isinstance(field_type, dict) and 'enum' in field_type:
+        return str
+    elif field_type in _PRIMITIVE_CASTERS:
+        return _PRIMITIVE_CASTERS[field_type]
+    else:
+        def _cannot_cast(_):
+            raise NotImplementedError("field_type '{}' cannot be cast".format(field_type))
+        return _cannot_cast
+
+
+class CompiledSchema:
+    def __init__(self, schema, primary_key_fields):
+        self.schema = schema
+        self.properties = schema['properties']
+        self.primary_key_fields = list(primary_key_fields)
+
+        self.fields = {}
+        self._casters = {}
+        for field, config in self.properties.items():
+            self.fields[field] = {
+                'immutable': config.get('readonly', False),
+                'required': field in schema['required'],
+                'primary_key': field in self.primary_key_fields,
+            }
+            self._casters[field] = _get_caster(config['type'])
+
+        # Every combination of filters that `get_fields()` can be called with
+        self._field_lists = {}
+        for immutable in [None, True, False]:
+            for required in [None, True, False]:
+                for primary_key in [None, True, False]:
+                    # Tuples, as they are shared by every caller
+                    self._field_lists[(immutable, required, primary_key)] = tuple(
+                        k for k, v in self.fields.items()
+                        if (immutable is None or v['immutable'] == immutable)
+                        and (required is None or v['required'] == required)
+                        and (primary_key is None or v['primary_key'] == primary_key)
+                    )
+
+        self.defaults = {field: config.get('default', None) for field, config in self.properties.items()}
+        self.collection_fields = frozenset(
+            field for field, config in self.properties.items() if config['type'] in ['list', 'object']
+        )
+        self._patch_forbidden = self._field_lists[(True, None, False)]
+        self._put_required = self._field_lists[(None, True, False)]
+
+    def get_fields(self, immutable=None, required=None, primary_key=None):
+        """
+        :return: tuple[str] the names of the fields which match all of the given filters
+        """
+        return self._field_lists[(immutable, required, primary_key)]
+
+    def cast(self, field, value):
+        return self._casters[field](value)
+
+    def validate(self, operation, body, primary_key):
+        # Primary key must be complete
+        if None in primary_key.values():
+            raise InvalidSchemaException('Incomplete primary key')
+
+        if operation == 'PATCH':
+            # Not allowed to modify readonly attributes for PATCH
+            for key in self._patch_forbidden:
+                if key in body:
+                    raise InvalidSchemaException('Cannot modify value of immutable parameter: {}'.format(key))
+
+        else:
+            # Required fields must be present for PUT
+            for key in self._put_required:
+                if key not in body and key not in primary_key:
+                    raise InvalidSchemaException('Missing required parameter: {}'.format(key))
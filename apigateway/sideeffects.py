@@ -0,0 +1,51 @@
+"""
+Side effects of requests which are performed asynchronously by the outbox worker, rather than while the device waits
+"""
+import json
+
+from fathomapi.comms.service import Service
+import outbox
+
+PREPROCESSING_API_VERSION = '2_0'
+USERS_API_VERSION = '2_4'
+
+
+@outbox.handles('patch_session')
+def patch_session(session_id, offset_applied):
+    endpoint = f"session/{session_id}"
+    preprocessing_service = Service('preprocessing', PREPROCESSING_API_VERSION)
+    preprocessing_service.call_apigateway_sync(method='PATCH',
+                                               endpoint=endpoint,
+                                               body={'start_time_adjustment': offset_applied}
+                                               )
+
+
+@outbox.handles('notify_low_battery')
+def notify_user_of_low_battery(user_id):
+    users_service = Service('users', USERS_API_VERSION)
+    body = {"message": "Your Fathom PRO kit battery is low.\nYou'll need to plug your kit in to charge soon. Use your micro-USB cable to charge your PRO Kit. Full-recharge takes 3 hours.",
+            "call_to_action": "VIEW_PLAN",
+            "expire_in": 2 * 60 * 60}  # expire in 2 hours
+    users_service.call_apigateway_async(method='POST',
+                                        endpoint=f'/user/{user_id}/notify',
+                                        body=body)
+
+
+def handler(event, context):
+    """
+    Process a batch of messages from the outbox queue, reporting the ones which failed so that only they are retried
+    """
+    print(json.dumps(event))
+    record_ids = {}
+    messages = []
+    for record in event['Records']:
+        message = json.loads(record['body'])
+        record_ids[message['id']] = record['messageId']
+        messages.append(message)
+
+    failed = outbox.process(messages)
+    return {'batchItemFailures': [{'itemIdentifier': record_ids[message_id]} for message_id in failed]}
+
+
+if __name__ == '__main__':
+    outbox.drain_local_queue()
@@ -0,0 +1,152 @@
+"""
+Encoding of records in the accessory sync log.
+
+v1 records are flat, with `accessory_{field}`, `sensor{n}_{field}`, `wifi_{field}`, `local_time` and `true_time`
+attributes.
+
+v2 records (with `format_version` 2) keep the accessory and time attributes as they are, but pack the sensors into a
+list of maps and the wifi counters into a map.  Sensor and wifi fields whose value is the same as at the previous sync
+are omitted, and a field which is no longer reported is recorded as null.  `base_event_date` is the event_date of the
+record which a v2 record is relative to.  Every SYNC_LOG_KEYFRAME_INTERVAL records, or whenever the previous state is
+unknown, a keyframe (with `keyframe` true) records every field.
+
+`decode_sync_records()` turns a chronological sequence of records in either format into v1 records.  It is also used
+by scripts/get_accessory_sync_log.py, so this module mustn't depend on anything outside the standard library.
+"""
+import json
+import os
+import re
+
+FORMAT_VERSION = 2
+SYNC_LOG_KEYFRAME_INTERVAL = int(os.environ.get('SYNC_LOG_KEYFRAME_INTERVAL', 24))
+
+_SENSOR_ATTRIBUTE = re.compile(r'^sensor(\d+)_(.+)$')
+_V2_ATTRIBUTES = {'format_version', 'keyframe', 'base_event_date', 'sensors', 'wifi'}
+
+
+def encode_sync_record(item, previous_state):
+    """
+    :param dict item: a v1 record
+    :param str previous_state: the state returned when encoding the previous record for the same accessory, or None
+    :return: (dict, str) the v2 record, and the state to pass when encoding the next record
+    """
+    ret = {}
+    sensors = []
+    wifi = {}
+    for key, value in item.items():
+        match = _SENSOR_ATTRIBUTE.match(key)
+        if match is not None:
+            index = int(match.group(1)) - 1
+            while len(sensors) <= index:
+                sensors.append({})
+            sensors[index][match.group(2)] = value
+        elif key.startswith('wifi_'):
+            wifi[key[len('wifi_'):]] = value
+        else:
+            ret[key] = value
+
+    previous = _parse_state(previous_state)
+    keyframe = previous is None or previous['frames'] + 1 >= SYNC_LOG_KEYFRAME_INTERVAL
+
+    ret['format_version'] = FORMAT_VERSION
+    if keyframe:
+        ret['keyframe'] = True
+        ret['sensors'] = sensors
+        ret['wifi'] = wifi
+    else:
+        ret['base_event_date'] = previous['event_date']
+        ret['sensors'] = [
+            # The state holds canonical values
+            _diff(sensor, _get_previous_sensor(previous['sensors'], i, _canonical(sensor.get('mac_address'))))
+            for i, sensor in enumerate(sensors)
+        ]
+        ret['wifi'] = _diff(wifi, previous['wifi'])
+
+    state = {
+        'event_date': item['event_date'],
+        'frames': 0 if keyframe else previous['frames'] + 1,
+        'sensors': [{k: _canonical(v) for k, v in sensor.items()} for sensor in sensors],
+        'wifi': {k: _canonical(v) for k, v in wifi.items()},
+    }
+    return ret, json.dumps(state, sort_keys=True, separators=(',', ':'))
+
+
+def decode_sync_records(items):
+    """
+    :param items: an iterable of records for one accessory, of either format, in chronological order.  To decode a v2
+        record fully, the sequence must start at or before the keyframe it depends on.
+    :return: generator of v1 records
+    """
+    previous = None
+    for item in items:
+        if item.get('format_version', 1) < FORMAT_VERSION:
+            previous = None
+            yield item
+            continue
+
+        if item.get('keyframe', False) or previous is None or previous['event_date'] != item.get('base_event_date'):
+            # A keyframe, or a record whose base we haven't seen, in which case only the changed fields are known
+            previous = {'sensors': [], 'wifi': {}}
+
+        sensors = [
+            _apply(_get_previous_sensor(previous['sensors'], i, delta.get('mac_address')), delta)
+            for i, delta in enumerate(item.get('sensors', []))
+        ]
+        wifi = _apply(previous['wifi'], item.get('wifi', {}))
+        previous = {'event_date': item['event_date'], 'sensors': sensors, 'wifi': wifi}
+
+        ret = {k: v for k, v in item.items() if k not in _V2_ATTRIBUTES}
+        for i, sensor in enumerate(sensors):
+            for k, v in sensor.items():
+                ret['sensor{}_{}'.format(i + 1, k)] = v
+        for k, v in wifi.items():
+            ret['wifi_{}'.format(k)] = v
+        yield ret
+
+
+def _parse_state(state):
+    """
+    :param str state: as returned by `encode_sync_record()`, or None
+    :return: dict, or None if there is no state or it can't be used, so that the next record is a keyframe
+    """
+    if state is None:
+        return None
+    try:
+        ret = json.loads(state)
+        valid = isinstance(ret, dict) \
+            and isinstance(ret.get('frames'), int) and isinstance(ret.get('event_date'), str) \
+            and isinstance(ret.get('sensors'), list) and all(isinstance(s, dict) for s in ret['sensors']) \
+            and isinstance(ret.get('wifi'), dict)
+    except (TypeError, ValueError):
+        valid = False
+    if not valid:
+        print('Ignoring invalid sync log state: {!r}'.format(state))
+        return None
+    return ret
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def _get_previous_sensor(previous_sensors, index, mac_address):
+    # Sensors are matched by position, as in v1 records, but only if the same sensor is in that position
+    if index < len(previous_sensors) and previous_sensors[index].get('mac_address') == mac_address:
+        return previous_sensors[index]
+    return {}
+
+
+def _diff(current, previous):
+    ret = {k: v for k, v in current.items() if k == 'mac_address' or previous.get(k) != _canonical(v)}
+    ret.update({k: None for k in previous if k not in current})
+    return ret
+
+
+def _apply(previous, delta):
+    ret = dict(previous)
+    for k, v in delta.items():
+        if v is None:
+            ret.pop(k, None)
+        else:
+            ret[k] = v
+    return ret
@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from copy import deepcopy
+from functools import wraps
+import threading
+
+from concurrency import check_cancelled, propagate_thread_state, run_concurrently
+from fathomapi.utils.exceptions import NoSuchEntityException, NoUpdatesException
+
+_local = threading.local()
+
+
+class UnitOfWork:
+    """
+    A request-scoped identity map.  Each entity is loaded from its backing store at most once per request, and writes
+    to it are buffered, merged, and flushed once at the end of the request.
+    """
+    def __init__(self):
+        # Tasks on the thread pool share the unit of work of the request which started them
+        self._lock = threading.Lock()
+        self._states = {}
+        self._pending = OrderedDict()
+        self._deferred = OrderedDict()
+        # Set once the buffered writes have started to be performed, after which nothing more is buffered
+        self._flushed = False
+
+    def load(self, entity, loader):
+        """
+        :param Entity entity:
+        :param callable loader: fetches the entity from its backing store, if it hasn't already been loaded
+        :return: dict
+        """
+        key = _get_identity(entity)
+        with self._lock:
+            loaded = key in self._states
+        if not loaded:
+            # Not holding the lock, which would serialise every load.  Two tasks might both load the same entity, in
+            # which case the first to finish wins.
+            try:
+                state = loader()
+            except NoSuchEntityException:
+                state = None
+            with self._lock:
+                self._states.setdefault(key, state)
+        with self._lock:
+            if self._states[key] is None:
+                raise NoSuchEntityException()
+            return deepcopy(self._states[key])
+
+    def remember(self, entity, state):
+        """
+        Record the state of an entity which has just been read or written outside the unit of work
+        """
+        with self._lock:
+            self._states[_get_identity(entity)] = deepcopy(state)
+
+    def forget(self, entity):
+        with self._lock:
+            self._states.pop(_get_identity(entity), None)
+
+    def write(self, entity, body, writer, state, defaults=None):
+        """
+        Buffer a write to an entity
+        :param Entity entity:
+        :param dict body: the changes to write.  These are merged with any other changes buffered for the same entity.
+        :param callable writer: called with the merged changes and the merged defaults to perform the write, returning
+            the new state
+        :param dict state: the state of the entity once the write has been performed
+        :param dict defaults: values for fields which are only written if they are not already set.  These are merged
+            with any other defaults buffered for the same entity, the earliest taking precedence.
+        """
+        check_cancelled()
+        key = _get_identity(entity)
+        with self._lock:
+            flushed = self._flushed
+            if not flushed:
+                if key in self._pending:
+                    _, pending_body, pending_defaults = self._pending[key]
+                    pending_body.update(body)
+                    for field, value in (defaults or {}).items():
+                        pending_defaults.setdefault(field, value)
+                else:
+                    self._pending[key] = (writer, dict(body), dict(defaults or {}))
+                self._states[key] = deepcopy(state)
+        if flushed:
+            # Eg from a task which is still running after the request returned: write it now, rather than lose it
+            written_state = _make_write(writer, body, defaults or {})()
+            with self._lock:
+                self._states[key] = deepcopy(state) if written_state is None else written_state
+
+    def defer(self, name, sender, item):
+        """
+        Buffer something, such as a message, which must only be sent once all the writes have succeeded
+        :param str name: identifies the batch which the item belongs to
+        :param callable sender: called with the list of items in the batch
+        :param item:
+        """
+        check_cancelled()
+        with self._lock:
+            flushed = self._flushed
+            if not flushed:
+                self._deferred.setdefault(name, (sender, []))[1].append(item)
+        if flushed:
+            sender([item])
+
+    def flush(self):
+        """
+        Perform all buffered writes, and then send everything which was deferred until they had been performed.  Writes
+        to different entities are independent, so they happen concurrently.
+        """
+        with self._lock:
+            self._flushed = True
+            pending, self._pending = self._pending, OrderedDict()
+        tasks = {key: _make_write(writer, body, defaults) for key, (writer, body, defaults) in pending.items()}
+        for key, state in run_concurrently(tasks).items():
+            if state is not None:
+                with self._lock:
+                    self._states[key] = state
+
+        with self._lock:
+            deferred, self._deferred = self._deferred, OrderedDict()
+        for sender, items in deferred.values():
+            sender(items)
+
+
+def _make_write(writer, body, defaults):
+    def _write():
+        try:
+            return writer(body, defaults)
+        except NoUpdatesException:
+            return None
+    return _write
+
+
+def _get_identity(entity):
+    return type(entity).__name__, tuple(sorted(entity.primary_key.items()))
+
+
+def get_unit_of_work():
+    """
+    :return: UnitOfWork the unit of work for the current request, or None if there isn't one
+    """
+    return getattr(_local, 'unit_of_work', None)
+
+
+def _set_unit_of_work(unit_of_work):
+    _local.unit_of_work = unit_of_work
+
+
+# Entities loaded and written by concurrent tasks belong to the request which started them
+propagate_thread_state(get_unit_of_work, _set_unit_of_work)
+
+
+def unit_of_work(func):
+    """
+    Decorate a route so that the entities it uses are loaded at most once, and written once when it returns
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        unit_of_work = UnitOfWork()
+        _set_unit_of_work(unit_of_work)
+        try:
+            ret = func(*args, **kwargs)
+            unit_of_work.flush()
+            return ret
+        finally:
+            _set_unit_of_work(None)
+    return wrapper
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# Rebuilds the clock drift model on each accessory's record from its history in the accessory sync log.  Syncs which
+# happen while this is running may be lost from the model, so run it when the accessories are quiet.
+#
+import argparse
+import os
+import sys
+
+try:
+    import boto3
+    from boto3.dynamodb.conditions import Key
+    from colorama import Fore, Style
+except ImportError:
+    raise ImportError('You must install the `boto3` and `colorama` pip packages to use this script')
+
+# The model must be built exactly as the API updates it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'apigateway'))
+from clockdrift import update_clock_drift_model
+
+
+def cprint(*pargs, **kwargs):
+    if 'colour' in kwargs:
+        print(kwargs['colour'], end="")
+        del kwargs['colour']
+
+        end = kwargs.get('end', '\n')
+        kwargs['end'] = ''
+        print(*pargs, **kwargs)
+
+        print(Style.RESET_ALL, end=end)
+
+    else:
+        print(*pargs, **kwargs)
+
+
+def scan_table(ddb_table, **kwargs):
+    while True:
+        ret = ddb_table.scan(**kwargs)
+        yield from ret['Items']
+        if 'LastEvaluatedKey' not in ret:
+            return
+        kwargs['ExclusiveStartKey'] = ret['LastEvaluatedKey']
+
+
+def query_table(ddb_table, **kwargs):
+    while True:
+        ret = ddb_table.query(**kwargs)
+        yield from ret['Items']
+        if 'LastEvaluatedKey' not in ret:
+            return
+        kwargs['ExclusiveStartKey'] = ret['LastEvaluatedKey']
+
+
+def get_syncs(sync_log_table, accessory_id):
+    """
+    :return: generator of (true_time, local_time) for each sync, in order
+    """
+    for sync in query_table(
+            sync_log_table,
+            KeyConditionExpression=Key('accessory_mac_address').eq(accessory_id),
+            ProjectionExpression='true_time, local_time',
+    ):
+        if sync.get('true_time') is not None and sync.get('local_time') is not None:
+            yield sync['true_time'], sync['local_time']
+
+
+def build_model(syncs):
+    model = {}
+    for true_time, local_time in syncs:
+        model.update(update_clock_drift_model(model, true_time, local_time))
+        model['true_time'] = true_time
+    return model
+
+
+def main():
+    dynamodb_resource = boto3.resource('dynamodb', region_name=args.region)
+    accessory_table = dynamodb_resource.Table(f'hardware-{args.environment}-accessory')
+    sync_log_table = dynamodb_resource.Table(f'hardware-{args.environment}-accessorysynclog')
+
+    if args.accessory is not None:
+        accessory_ids = [args.accessory.upper()]
+    else:
+        accessory_ids = (item['id'] for item in scan_table(accessory_table, ProjectionExpression='id'))
+
+    for accessory_id in accessory_ids:
+        model = build_model(get_syncs(sync_log_table, accessory_id))
+        if model.get('clock_drift_samples', 0) == 0:
+            cprint(f"Skipping {accessory_id}, which has no syncs far enough apart to model", colour=Fore.YELLOW)
+            continue
+
+        if args.dry_run:
+            cprint(f"Would set clock_drift_rate of {accessory_id} to {model['clock_drift_rate']:.3e} from {model['clock_drift_samples']} syncs")
+        else:
+            accessory_table.update_item(
+                Key={'id': accessory_id},
+                UpdateExpression='SET clock_drift_rate = :rate, clock_drift_samples = :samples, '
+                                 'clock_drift_sum_error_interval = :sum_error_interval, '
+                                 'clock_drift_sum_interval_squared = :sum_interval_squared',
+                ExpressionAttributeValues={
+                    ':rate': model['clock_drift_rate'],
+                    ':samples': model['clock_drift_samples'],
+                    ':sum_error_interval': model['clock_drift_sum_error_interval'],
+                    ':sum_interval_squared': model['clock_drift_sum_interval_squared'],
+                },
+            )
+            cprint(f"Set clock_drift_rate of {accessory_id} to {model['clock_drift_rate']:.3e} from {model['clock_drift_samples']} syncs", colour=Fore.GREEN)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the clock drift model of accessories from the sync log')
+    parser.add_argument('--region', '-r',
+                        type=str,
+                        help='AWS Region',
+                        choices=['us-west-2'],
+                        default='us-west-2')
+    parser.add_argument('--environment',
+                        type=str,
+                        help='Environment',
+                        choices=['dev', 'test', 'production'],
+                        default='dev')
+    parser.add_argument('--accessory',
+                        type=str,
+                        help='Only rebuild the model of this accessory',
+                        default=None)
+    parser.add_argument('--dry-run',
+                        help='Print the changes without making them',
+                        action='store_true',
+                        default=False,
+                        dest='dry_run')
+
+    args = parser.parse_args()
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        exit(0)
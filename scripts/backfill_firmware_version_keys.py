@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+# Populates the `version_key` and `release_version_key` attributes on firmware records which were released before
+# the version key indexes existed, or (with `--table accessory` or `--table sensor`) the `firmware_version_key`
+# attribute on device records which were last updated before the firmware version indexes existed.
+#
+import argparse
+import os
+import sys
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+    from colorama import Fore, Style
+except ImportError:
+    raise ImportError('You must install the `boto3`, `colorama` and `semver` pip packages to use this script')
+
+# The version keys must sort in the same order as the ones the API writes, so use the same encoding
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'apigateway'))
+from firmwareversion import get_version_key, parse_version
+
+
+def cprint(*pargs, **kwargs):
+    if 'colour' in kwargs:
+        print(kwargs['colour'], end="")
+        del kwargs['colour']
+
+        end = kwargs.get('end', '\n')
+        kwargs['end'] = ''
+        print(*pargs, **kwargs)
+
+        print(Style.RESET_ALL, end=end)
+
+    else:
+        print(*pargs, **kwargs)
+
+
+def scan_table(ddb_table):
+    kwargs = {}
+    while True:
+        ret = ddb_table.scan(**kwargs)
+        yield from ret['Items']
+        if 'LastEvaluatedKey' not in ret:
+            return
+        kwargs['ExclusiveStartKey'] = ret['LastEvaluatedKey']
+
+
+def backfill_devices():
+    ddb_table = boto3.resource('dynamodb', region_name=args.region).Table(f'hardware-{args.environment}-{args.table}')
+    key_name = 'id' if args.table == 'accessory' else 'mac_address'
+
+    for device in scan_table(ddb_table):
+        if device.get('firmware_version') is None:
+            continue
+        try:
+            version = parse_version(device['firmware_version'])
+        except ValueError:
+            cprint(f"Skipping {args.table} {device[key_name]} with firmware '{device['firmware_version']}', which is not a valid semantic version", colour=Fore.YELLOW)
+            continue
+
+        version_key = get_version_key(str(version))
+        if device.get('firmware_version_key') == version_key:
+            continue
+
+        if args.dry_run:
+            cprint(f"Would set firmware_version_key of {args.table} {device[key_name]} to {version_key}")
+        else:
+            try:
+                ddb_table.update_item(
+                    Key={key_name: device[key_name]},
+                    UpdateExpression='SET firmware_version_key = :version_key',
+                    # Unless the device has been updated since it was read, in which case the API set the key
+                    ConditionExpression='firmware_version = :firmware_version',
+                    ExpressionAttributeValues={':version_key': version_key, ':firmware_version': device['firmware_version']},
+                )
+            except ClientError as e:
+                if 'ConditionalCheckFailed' in str(e):
+                    cprint(f"Skipping {args.table} {device[key_name]}, which has been updated since", colour=Fore.YELLOW)
+                    continue
+                raise
+            cprint(f"Set firmware_version_key of {args.table} {device[key_name]} to {version_key}", colour=Fore.GREEN)
+
+
+def main():
+    if args.table != 'firmware':
+        backfill_devices()
+        return
+
+    ddb_table = boto3.resource('dynamodb', region_name=args.region).Table(f'hardware-{args.environment}-firmware')
+
+    for firmware in scan_table(ddb_table):
+        try:
+            version = parse_version(firmware['version'])
+        except ValueError:
+            cprint(f"Skipping {firmware['device_type']} release '{firmware['version']}', which is not a valid semantic version", colour=Fore.YELLOW)
+            continue
+
+        version_key = get_version_key(str(version))
+        if firmware.get('version_key') == version_key:
+            continue
+
+        update_expression = 'SET version_key = :version_key'
+        values = {':version_key': version_key}
+        if version.prerelease is None:
+            update_expression += ', release_version_key = :version_key'
+
+        if args.dry_run:
+            cprint(f"Would set version_key of {firmware['device_type']} {firmware['version']} to {version_key}")
+        else:
+            ddb_table.update_item(
+                Key={'device_type': firmware['device_type'], 'version': firmware['version']},
+                UpdateExpression=update_expression,
+                ExpressionAttributeValues=values,
+            )
+            cprint(f"Set version_key of {firmware['device_type']} {firmware['version']} to {version_key}", colour=Fore.GREEN)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill version keys on firmware records')
+    parser.add_argument('--region', '-r',
+                        type=str,
+                        help='AWS Region',
+                        choices=['us-west-2'],
+                        default='us-west-2')
+    parser.add_argument('--environment',
+                        type=str,
+                        help='Environment',
+                        choices=['dev', 'test', 'production'],
+                        default='dev')
+    parser.add_argument('--table',
+                        type=str,
+                        help='The table to backfill',
+                        choices=['firmware', 'accessory', 'sensor'],
+                        default='firmware')
+    parser.add_argument('--dry-run',
+                        help='Print the changes without making them',
+                        action='store_true',
+                        default=False,
+                        dest='dry_run')
+
+    args = parser.parse_args()
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        exit(0)
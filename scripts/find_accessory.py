@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import argparse
 import boto3
+from boto3.dynamodb.conditions import Key
 
 
 parser = argparse.ArgumentParser(description='Find an accessory')
@@ -21,29 +22,27 @@ parser.add_argument('--owner_id',
 
 args = parser.parse_args()
 
-cognito_client = boto3.client('cognito-idp', region_name=args.region)
+accessory_table = boto3.resource('dynamodb', region_name=args.region).Table(
+    'hardware-{}-accessory'.format(args.environment)
+)
 
 
-def get_cognito_user_pool_id():
-    res = cognito_client.list_user_pools(MaxResults=60)
-    pools = {pool['Name']: pool['Id'] for pool in res['UserPools']}
-    pool_name = 'hardware-{}-accessories'.format(args.environment)
-    return pools.get(pool_name, None)
-
-
-def get_accessories(pool_id):
-    res = cognito_client.list_users(
-        UserPoolId=pool_id,
-    )
-    return [get_accessory_from_record(record) for record in res['Users']]
+def get_accessories(owner_id):
+    """
+    Find the accessories with an owner from the table's owner_id index.  Accessories whose owner hasn't been mirrored
+    from Cognito yet won't be found; see scripts/reconcile_accessory_attributes.py
+    """
+    kwargs = {'IndexName': 'owner_id', 'KeyConditionExpression': Key('owner_id').eq(owner_id)}
+    while True:
+        res = accessory_table.query(**kwargs)
+        yield from (get_accessory_from_record(record) for record in res['Items'])
+        if 'LastEvaluatedKey' not in res:
+            return
+        kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
 
 
 def get_accessory_from_record(record):
-    ret = {'id': record['Username'], 'owner_id': None}
-    for attribute in record['Attributes']:
-        if attribute['Name'] == 'custom:owner_id':
-            ret['owner_id'] = attribute['Value']
-    return ret
+    return {'id': record['id'], 'owner_id': record.get('owner_id')}
 
 
 def print_accessory(accessory):
@@ -55,11 +54,11 @@ Accessory:
 
 
 def main():
-    accessories = get_accessories(get_cognito_user_pool_id())
+    accessories = list(get_accessories(args.owner_id))
     for accessory in accessories:
-        if accessory['owner_id'] == args.owner_id:
-            print_accessory(accessory)
-            exit(0)
+        print_accessory(accessory)
+    if len(accessories) > 0:
+        exit(0)
     print('No accessory with that owner id')
     exit(1)
 
@@ -4,6 +4,12 @@ import boto3
 import pandas as pd
 from boto3.dynamodb.conditions import Key
 from datetime import datetime
+import os
+import sys
+
+# Records are decoded exactly as the API does it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'apigateway'))
+from synclog import FORMAT_VERSION as SYNC_LOG_FORMAT_VERSION, decode_sync_records
 
 pd.set_option('display.height', 1000)
 pd.set_option('display.max_rows', 500)
@@ -37,28 +43,33 @@ args = parser.parse_args()
 dynamodb_table = boto3.resource('dynamodb', region_name=args.region).Table('hardware-{}-accessorysynclog'.format(args.environment))
 
 
-def query_dynamodb(key_condition_expression, limit=10000, scan_index_forward=True, exclusive_start_key=None):
-    if exclusive_start_key is not None:
-        ret = dynamodb_table.query(
-            Select='ALL_ATTRIBUTES',
-            Limit=limit,
-            KeyConditionExpression=key_condition_expression,
-            ExclusiveStartKey=exclusive_start_key,
-            ScanIndexForward=scan_index_forward,
-        )
-    else:
-        ret = dynamodb_table.query(
-            Select='ALL_ATTRIBUTES',
-            Limit=limit,
-            KeyConditionExpression=key_condition_expression,
-            ScanIndexForward=scan_index_forward,
-        )
-    if 'LastEvaluatedKey' in ret:
-        # There are more records to be scanned
-        return ret['Items'] + query_dynamodb(key_condition_expression, limit, scan_index_forward, ret['LastEvaluatedKey'])
-    else:
-        # No more items
-        return ret['Items']
+def query_dynamodb(key_condition_expression, limit=10000, scan_index_forward=True):
+    kwargs = {
+        'Select': 'ALL_ATTRIBUTES',
+        'Limit': limit,
+        'KeyConditionExpression': key_condition_expression,
+        'ScanIndexForward': scan_index_forward,
+    }
+    while True:
+        ret = dynamodb_table.query(**kwargs)
+        yield from ret['Items']
+        if 'LastEvaluatedKey' not in ret:
+            # No more items
+            return
+        kwargs['ExclusiveStartKey'] = ret['LastEvaluatedKey']
+
+
+def get_preceding_records(accessory_id, start):
+    """
+    The records before `start` back to the last keyframe (or v1 record), which v2 records after `start` may depend on
+    """
+    ret = []
+    for item in query_dynamodb(Key('accessory_mac_address').eq(accessory_id) & Key('event_date').lt(start),
+                               limit=100, scan_index_forward=False):
+        ret.insert(0, item)
+        if item.get('format_version', 1) < SYNC_LOG_FORMAT_VERSION or item.get('keyframe', False):
+            break
+    return ret
 
 
 state_map = {
@@ -84,9 +95,14 @@ def print_table(log_entries):
 
 
 def main():
-    res = query_dynamodb(
+    res = list(query_dynamodb(
         Key('accessory_mac_address').eq(args.accessory_id) & Key('event_date').between(args.start, args.end)
-    )
+    ))
+    if len(res) > 0 and res[0].get('format_version', 1) >= SYNC_LOG_FORMAT_VERSION and not res[0].get('keyframe', False):
+        preceding = get_preceding_records(args.accessory_id, args.start)
+        res = list(decode_sync_records(preceding + res))[len(preceding):]
+    else:
+        res = list(decode_sync_records(res))
     print_table(res)
 
 
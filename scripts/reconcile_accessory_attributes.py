@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Repairs drift between the accessory attributes stored in Cognito and the copy of them in the accessory table, which
+# is where the API reads them from.  Accessories whose attributes have not been mirrored yet are copied from Cognito;
+# otherwise the accessory table is taken to be correct and Cognito is updated to match, unless `--source cognito` is
+# given.
+#
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import argparse
+
+try:
+    import boto3
+    from colorama import Fore, Style
+except ImportError:
+    raise ImportError('You must install the `boto3` and `colorama` pip packages to use this script')
+
+# The custom attributes of an accessory.  This must match the properties of apigateway/schemas/accessory.json
+ATTRIBUTES = ['state', 'battery_level', 'memory_level', 'firmware_version', 'bluetooth_name', 'hardware_model',
+              'settings_key', 'owner_id']
+NUMBER_ATTRIBUTES = ['battery_level', 'memory_level']
+
+
+def cprint(*pargs, **kwargs):
+    if 'colour' in kwargs:
+        print(kwargs['colour'], end="")
+        del kwargs['colour']
+
+        end = kwargs.get('end', '\n')
+        kwargs['end'] = ''
+        print(*pargs, **kwargs)
+
+        print(Style.RESET_ALL, end=end)
+
+    else:
+        print(*pargs, **kwargs)
+
+
+def get_cognito_user_pool_id(cognito_client):
+    res = cognito_client.list_user_pools(MaxResults=60)
+    pools = {pool['Name']: pool['Id'] for pool in res['UserPools']}
+    return pools[f'hardware-{args.environment}-accessories']
+
+
+def iterate_cognito_accessories(cognito_client, pool_id):
+    """
+    :return: generator of (accessory_id, attributes)
+    """
+    if args.accessory is not None:
+        res = cognito_client.admin_get_user(UserPoolId=pool_id, Username=args.accessory.upper())
+        yield res['Username'], get_attributes(res['UserAttributes'])
+        return
+
+    for page in cognito_client.get_paginator('list_users').paginate(UserPoolId=pool_id):
+        for user in page['Users']:
+            yield user['Username'], get_attributes(user['Attributes'])
+
+
+def get_attributes(cognito_attributes):
+    attributes = {prop['Name'].split(':')[-1]: prop['Value'] for prop in cognito_attributes}
+    return {key: cast(key, attributes[key]) for key in ATTRIBUTES if attributes.get(key) is not None}
+
+
+def cast(key, value):
+    if key in NUMBER_ATTRIBUTES:
+        try:
+            return Decimal(str(value))
+        except InvalidOperation:
+            return None
+    return str(value)
+
+
+def get_differences(cognito_attributes, item):
+    return [key for key in ATTRIBUTES if cognito_attributes.get(key) != item.get(key)]
+
+
+def mirror_to_accessory_table(accessory_table, accessory_id, attributes):
+    """
+    Copy the attributes from Cognito into the accessory table.  This doesn't set `firmware_version_key`, so afterwards
+    run scripts/backfill_firmware_version_keys.py with `--table accessory`
+    """
+    values = {':mirrored_date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+    names = {}
+    set_expressions = ['attributes_mirrored_date = if_not_exists(attributes_mirrored_date, :mirrored_date)']
+    remove_expressions = []
+    for i, key in enumerate(ATTRIBUTES):
+        names[f'#a{i}'] = key
+        if attributes.get(key) is None:
+            remove_expressions.append(f'#a{i}')
+        else:
+            set_expressions.append(f'#a{i} = :a{i}')
+            values[f':a{i}'] = attributes[key]
+
+    update_expression = 'SET ' + ', '.join(set_expressions)
+    if len(remove_expressions) > 0:
+        update_expression += ' REMOVE ' + ', '.join(remove_expressions)
+    accessory_table.update_item(
+        Key={'id': accessory_id},
+        UpdateExpression=update_expression,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+    )
+
+
+def mirror_to_cognito(cognito_client, pool_id, accessory_id, item, keys):
+    """
+    Copy some of the attributes from the accessory table into Cognito
+    """
+    attributes_to_update = [
+        {'Name': f'custom:{key}', 'Value': str(item[key])} for key in keys if item.get(key) is not None
+    ]
+    attributes_to_delete = [f'custom:{key}' for key in keys if item.get(key) is None]
+    if len(attributes_to_update) > 0:
+        cognito_client.admin_update_user_attributes(
+            UserPoolId=pool_id,
+            Username=accessory_id,
+            UserAttributes=attributes_to_update,
+        )
+    if len(attributes_to_delete) > 0:
+        cognito_client.admin_delete_user_attributes(
+            UserPoolId=pool_id,
+            Username=accessory_id,
+            UserAttributeNames=attributes_to_delete,
+        )
+
+
+def main():
+    cognito_client = boto3.client('cognito-idp', region_name=args.region)
+    accessory_table = boto3.resource('dynamodb', region_name=args.region).Table(f'hardware-{args.environment}-accessory')
+    pool_id = get_cognito_user_pool_id(cognito_client)
+
+    counts = {'consistent': 0, 'mirrored': 0, 'repaired': 0}
+    for accessory_id, cognito_attributes in iterate_cognito_accessories(cognito_client, pool_id):
+        item = accessory_table.get_item(Key={'id': accessory_id}, ConsistentRead=True).get('Item', {})
+
+        if item.get('attributes_mirrored_date') is None or args.source == 'cognito':
+            differences = get_differences(cognito_attributes, item)
+            if len(differences) == 0 and item.get('attributes_mirrored_date') is not None:
+                counts['consistent'] += 1
+                continue
+            if args.dry_run:
+                cprint(f"Would copy {', '.join(differences) or 'nothing'} for {accessory_id} from Cognito to the accessory table")
+            else:
+                mirror_to_accessory_table(accessory_table, accessory_id, cognito_attributes)
+                cprint(f"Copied {', '.join(differences) or 'nothing'} for {accessory_id} from Cognito to the accessory table", colour=Fore.GREEN)
+            counts['mirrored'] += 1
+
+        else:
+            differences = get_differences(cognito_attributes, item)
+            if len(differences) == 0:
+                counts['consistent'] += 1
+                continue
+            if args.dry_run:
+                cprint(f"Would copy {', '.join(differences)} for {accessory_id} from the accessory table to Cognito")
+            else:
+                mirror_to_cognito(cognito_client, pool_id, accessory_id, item, differences)
+                cprint(f"Copied {', '.join(differences)} for {accessory_id} from the accessory table to Cognito", colour=Fore.GREEN)
+            counts['repaired'] += 1
+
+    cprint(f"{counts['consistent']} consistent, {counts['mirrored']} mirrored from Cognito, {counts['repaired']} repaired in Cognito", colour=Fore.CYAN)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconcile the accessory attributes in Cognito and the accessory table')
+    parser.add_argument('--region', '-r',
+                        type=str,
+                        help='AWS Region',
+                        choices=['us-west-2'],
+                        default='us-west-2')
+    parser.add_argument('--environment',
+                        type=str,
+                        help='Environment',
+                        choices=['dev', 'test', 'production'],
+                        default='dev')
+    parser.add_argument('--accessory',
+                        type=str,
+                        help='Only reconcile this accessory',
+                        default=None)
+    parser.add_argument('--source',
+                        type=str,
+                        help='Which store to take as correct for accessories which have already been mirrored',
+                        choices=['dynamodb', 'cognito'],
+                        default='dynamodb')
+    parser.add_argument('--dry-run',
+                        help='Print the changes without making them',
+                        action='store_true',
+                        default=False,
+                        dest='dry_run')
+
+    args = parser.parse_args()
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        exit(0)
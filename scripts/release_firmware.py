@@ -15,6 +15,7 @@ import argparse
 import datetime
 import re
 import os
+import sys
 
 try:
     import boto3
@@ -24,6 +25,10 @@ try:
 except ImportError:
     raise ImportError('You must install the `boto3`, `colorama` and `semver` pip packages to use this script')
 
+# The version keys must sort in the same order as the ones the API writes, so use the same encoding
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'apigateway'))
+from firmwareversion import get_version_key
+
 
 class ApplicationException(Exception):
     pass
@@ -166,6 +171,9 @@ def main():
     # Create the DDB record
     insert = DynamodbUpdate()
     insert.set('created_date', datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"))
+    insert.set('version_key', get_version_key(str(version)))
+    if version.prerelease is None:
+        insert.set('release_version_key', get_version_key(str(version)))
 
     if args.notes:
         insert.set('notes', args.notes)
@@ -177,6 +185,8 @@ def main():
         ExpressionAttributeValues=insert.parameters,
     )
     cprint('Created DynamoDB record', colour=Fore.GREEN)
+    cprint('The API caches the latest firmware version, so devices will be offered this release within '
+           'FIRMWARE_CACHE_TTL seconds (5 minutes by default)', colour=Fore.YELLOW)
 
 
 if __name__ == '__main__':
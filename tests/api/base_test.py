@@ -2,6 +2,9 @@ import os
 import requests
 import unittest
 
+# A valid Authorization header, for the endpoints which require one
+TEST_AUTHORIZATION = os.environ.get('HARDWARE_API_TEST_AUTHORIZATION')
+
 
 class BaseTest(unittest.TestCase):
     host = 'https://apis.dev.fathomai.com/hardware'
@@ -9,6 +12,8 @@ class BaseTest(unittest.TestCase):
     method = None
     body = None
     authorization = None
+    headers = None
+    allow_redirects = True
     expected_status = None
 
     longMessage = True
@@ -20,6 +25,8 @@ class BaseTest(unittest.TestCase):
         }
         if self.authorization is not None:
             headers['Authorization'] = self.authorization
+        if self.headers is not None:
+            headers.update(self.headers)
         return headers
 
     def validate_response(self, body, headers, status):
@@ -41,15 +48,21 @@ class BaseTest(unittest.TestCase):
         self.validate_aws_pre()
 
         if self.method == 'GET':
-            res = requests.get(endpoint, headers=self._get_headers())
+            res = requests.get(endpoint, headers=self._get_headers(), allow_redirects=self.allow_redirects)
         elif self.method == 'POST':
-            res = requests.post(endpoint, json=self.body, headers=self._get_headers())
+            res = requests.post(
+                endpoint, json=self.body, headers=self._get_headers(), allow_redirects=self.allow_redirects
+            )
         else:
             self.fail('Unsupported method')
 
-        self.assertEqual(self.expected_status, res.status_code, msg=res.json().get('message', ''))
+        # Firmware downloads and redirects don't have a JSON body
+        is_json = res.headers.get('Content-Type', '').startswith('application/json')
+        body = res.json() if is_json else res.text
+
+        self.assertEqual(self.expected_status, res.status_code, msg=body.get('message', '') if is_json else body)
 
-        if 200 <= res.status_code < 300:
-            self.validate_response(res.json(), res.headers, res.status_code)
+        if 200 <= res.status_code < 400:
+            self.validate_response(body, res.headers, res.status_code)
 
         self.validate_aws_post()
@@ -0,0 +1,60 @@
+from base_test import BaseTest, TEST_AUTHORIZATION
+
+
+class TestAccessoryBatchGetUnauthenticated(BaseTest):
+    endpoint = 'accessory/batch_get'
+    method = 'POST'
+    body = {'mac_addresses': ['01:02:03:04:05:06']}
+    expected_status = 401
+
+
+class TestAccessoryBatchGetNoBody(BaseTest):
+    endpoint = 'accessory/batch_get'
+    method = 'POST'
+    body = {}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 400
+
+
+class TestAccessoryBatchGetTooMany(BaseTest):
+    endpoint = 'accessory/batch_get'
+    method = 'POST'
+    body = {'mac_addresses': ['01:02:03:04:{:02X}:{:02X}'.format(i // 256, i % 256) for i in range(501)]}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 400
+
+
+class TestAccessoryBatchGetInvalidMacAddress(BaseTest):
+    endpoint = 'accessory/batch_get'
+    method = 'POST'
+    body = {'mac_addresses': ['01:02:03:04:05:06', 42]}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 400
+
+
+class TestAccessoryBatchGetEmpty(BaseTest):
+    endpoint = 'accessory/batch_get'
+    method = 'POST'
+    body = {'mac_addresses': []}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 200
+
+    def validate_response(self, body, headers, status):
+        self.assertEqual({}, body['accessories'])
+        self.assertIn('accessory_version', body['latest_firmware'])
+
+
+class TestAccessoryBatchGetUnregistered(BaseTest):
+    endpoint = 'accessory/batch_get'
+    method = 'POST'
+    body = {'mac_addresses': ['0a:0b:0c:0d:0e:0f', '0A:0B:0C:0D:0E:10']}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 200
+
+    def validate_response(self, body, headers, status):
+        # The request succeeds, with an error for each accessory which could not be retrieved
+        self.assertEqual({'0A:0B:0C:0D:0E:0F', '0A:0B:0C:0D:0E:10'}, set(body['accessories'].keys()))
+        for result in body['accessories'].values():
+            self.assertNotIn('accessory', result)
+            self.assertEqual(404, result['error']['status'])
+            self.assertEqual('NoSuchEntity', result['error']['code'])
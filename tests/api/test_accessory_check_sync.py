@@ -0,0 +1,60 @@
+from base_test import BaseTest, TEST_AUTHORIZATION
+import time
+
+
+class TestAccessoryCheckSyncUnauthenticated(BaseTest):
+    endpoint = 'accessory/01:02:03:04:05:06/check_sync'
+    method = 'POST'
+    body = {'seconds_elapsed': 60}
+    expected_status = 401
+
+
+class TestAccessoryCheckSyncInvalidWait(BaseTest):
+    endpoint = 'accessory/01:02:03:04:05:06/check_sync'
+    method = 'POST'
+    body = {'seconds_elapsed': 60, 'wait': -1}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 400
+
+
+class TestAccessoryCheckSyncNoWait(BaseTest):
+    endpoint = 'accessory/01:02:03:04:05:06/check_sync'
+    method = 'POST'
+    body = {'seconds_elapsed': 60}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 200
+
+    def validate_response(self, body, headers, status):
+        # Not a registered accessory, so it has never synced
+        self.assertEqual({'sync_found': False}, body)
+
+
+class TestAccessoryCheckSyncWait(BaseTest):
+    endpoint = 'accessory/01:02:03:04:05:06/check_sync'
+    method = 'POST'
+    body = {'seconds_elapsed': 60, 'wait': 3}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 200
+
+    def validate_aws_pre(self):
+        self.start_time = time.monotonic()
+
+    def validate_response(self, body, headers, status):
+        self.assertEqual({'sync_found': False}, body)
+        # The request was held open until shortly before the wait ran out
+        self.assertGreaterEqual(time.monotonic() - self.start_time, 2)
+
+
+class TestAccessoryCheckSyncWaitCapped(BaseTest):
+    endpoint = 'accessory/01:02:03:04:05:06/check_sync'
+    method = 'POST'
+    body = {'seconds_elapsed': 60, 'wait': 3600}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 200
+
+    def validate_aws_pre(self):
+        self.start_time = time.monotonic()
+
+    def validate_response(self, body, headers, status):
+        self.assertEqual({'sync_found': False}, body)
+        self.assertLess(time.monotonic() - self.start_time, 30)
@@ -0,0 +1,96 @@
+from base_test import BaseTest, TEST_AUTHORIZATION
+import boto3
+import os
+import requests
+
+
+MAC_ADDRESS = '01:02:03:04:05:07'
+
+cognito_client = boto3.client('cognito-idp', region_name='us-west-2')
+cognito_user_pool_id = None
+for up in cognito_client.list_user_pools(MaxResults=60)['UserPools']:
+    if up['Name'] == 'hardware-dev-accessories':
+        cognito_user_pool_id = up['Id']
+accessory_table = boto3.resource('dynamodb', region_name='us-west-2').Table('hardware-dev-accessory')
+
+
+def make_sync(event_date, battery_level):
+    return {
+        'event_date': event_date,
+        'accessory': {'state': '0x01', 'battery_level': battery_level, 'firmware_version': '1.2'},
+        'sensors': [],
+        'time': {'local': 1000, 'true': 1002},
+    }
+
+
+class TestAccessorySyncBatchUnauthenticated(BaseTest):
+    endpoint = f'accessory/{MAC_ADDRESS}/sync/batch'
+    method = 'POST'
+    body = {'syncs': [make_sync('2026-01-01T00:00:00Z', 0.5)]}
+    expected_status = 401
+
+
+class TestAccessorySyncBatchEmpty(BaseTest):
+    endpoint = f'accessory/{MAC_ADDRESS}/sync/batch'
+    method = 'POST'
+    body = {'syncs': []}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 400
+
+
+class TestAccessorySyncBatchTooMany(BaseTest):
+    endpoint = f'accessory/{MAC_ADDRESS}/sync/batch'
+    method = 'POST'
+    body = {'syncs': [make_sync('2026-01-01T00:00:00Z', 0.5)] * 101}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 400
+
+
+class TestAccessorySyncBatchInvalidEventDate(BaseTest):
+    endpoint = f'accessory/{MAC_ADDRESS}/sync/batch'
+    method = 'POST'
+    body = {'syncs': [make_sync('yesterday', 0.5)]}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 400
+
+
+class TestAccessorySyncBatchNoSensors(BaseTest):
+    endpoint = f'accessory/{MAC_ADDRESS}/sync/batch'
+    method = 'POST'
+    body = {'syncs': [{'event_date': '2026-01-01T00:00:00Z', 'accessory': {}}]}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 400
+
+
+class TestAccessorySyncBatch(BaseTest):
+    endpoint = f'accessory/{MAC_ADDRESS}/sync/batch'
+    method = 'POST'
+    # Out of order, to check that the newest state is the one applied
+    body = {'syncs': [
+        make_sync('2026-01-01T00:02:00Z', 0.7),
+        make_sync('2026-01-01T00:00:00Z', 0.9),
+        make_sync('2026-01-01T00:01:00Z', 0.8),
+    ]}
+    authorization = TEST_AUTHORIZATION
+    expected_status = 200
+
+    def setUp(self):
+        res = requests.post(
+            os.path.join(self.host, f'accessory/{MAC_ADDRESS}/register'),
+            json={'password': 'abcdefgh', 'hardware_model': '2.1', 'firmware_version': '1.0', 'settings_key': '1234'},
+            headers=self._get_headers(),
+        )
+        self.assertEqual(201, res.status_code)
+
+    def validate_response(self, body, headers, status):
+        self.assertIn('accessory_version', body['latest_firmware'])
+        self.assertIn('last_session', body)
+
+    def validate_aws_post(self):
+        item = accessory_table.get_item(Key={'id': MAC_ADDRESS}, ConsistentRead=True)['Item']
+        self.assertEqual(0.7, float(item['battery_level']))
+        self.assertEqual('1.2', item['firmware_version'])
+
+    def tearDown(self):
+        cognito_client.admin_delete_user(UserPoolId=cognito_user_pool_id, Username=MAC_ADDRESS)
+        accessory_table.delete_item(Key={'id': MAC_ADDRESS})
@@ -0,0 +1,98 @@
+from base_test import BaseTest
+import base64
+import re
+
+
+class TestFirmwareDownloadInvalidVersion(BaseTest):
+    endpoint = 'firmware/accessory/fourtytwo/download'
+    method = 'GET'
+    expected_status = 404
+
+
+class TestFirmwareDownload(BaseTest):
+    endpoint = 'firmware/accessory/latest/download'
+    method = 'GET'
+    expected_status = 200
+
+    def validate_response(self, body, headers, status):
+        self.assertEqual('bytes', headers['Accept-Ranges'])
+        self.assertIn('ETag', headers)
+        self.assertIn('filename=accessory.bin', headers['Content-Disposition'])
+        self.assertGreater(len(base64.b64decode(body)), 0)
+
+
+class TestFirmwareDownloadRange(BaseTest):
+    endpoint = 'firmware/accessory/latest/download'
+    method = 'GET'
+    headers = {'Range': 'bytes=0-15'}
+    expected_status = 206
+
+    def validate_response(self, body, headers, status):
+        self.assertRegex(headers['Content-Range'], r'^bytes 0-15/\d+$')
+        self.assertEqual(16, len(base64.b64decode(body)))
+
+
+class TestFirmwareDownloadSuffixRange(BaseTest):
+    endpoint = 'firmware/accessory/latest/download'
+    method = 'GET'
+    headers = {'Range': 'bytes=-16'}
+    expected_status = 206
+
+    def validate_response(self, body, headers, status):
+        start, end, size = map(int, re.match(r'^bytes (\d+)-(\d+)/(\d+)$', headers['Content-Range']).groups())
+        self.assertEqual(size - 16, start)
+        self.assertEqual(size - 1, end)
+        self.assertEqual(16, len(base64.b64decode(body)))
+
+
+class TestFirmwareDownloadUnsatisfiableRange(BaseTest):
+    endpoint = 'firmware/accessory/latest/download'
+    method = 'GET'
+    headers = {'Range': 'bytes=1000000000-'}
+    expected_status = 416
+
+
+class TestFirmwareDownloadStaleIfRange(BaseTest):
+    endpoint = 'firmware/accessory/latest/download'
+    method = 'GET'
+    # The object has changed since the client started downloading it, so the whole object is served
+    headers = {'Range': 'bytes=0-15', 'If-Range': '"notthecurrentetag"'}
+    expected_status = 200
+
+    def validate_response(self, body, headers, status):
+        self.assertNotIn('Content-Range', headers)
+
+
+class TestFirmwareDownloadRedirect(BaseTest):
+    endpoint = 'firmware/accessory/latest/download?redirect=true'
+    method = 'GET'
+    allow_redirects = False
+    expected_status = 307
+
+    def validate_response(self, body, headers, status):
+        self.assertIn('Location', headers)
+        self.assertIn('response-content-disposition=attachment', headers['Location'])
+
+
+class TestFirmwareDownloadDelta(BaseTest):
+    endpoint = 'firmware/accessory/latest/download?from=1.0'
+    method = 'GET'
+    expected_status = 200
+
+    def validate_response(self, body, headers, status):
+        self.assertIn('filename=accessory.delta', headers['Content-Disposition'])
+        self.assertRegex(headers['X-Base-Checksum'], r'^sha256=[0-9a-f]{64}$')
+        self.assertRegex(headers['X-Result-Checksum'], r'^sha256=[0-9a-f]{64}$')
+        self.assertGreater(len(base64.b64decode(body)), 0)
+
+
+class TestFirmwareDownloadDeltaToItself(BaseTest):
+    endpoint = 'firmware/accessory/1.0/download?from=1.0'
+    method = 'GET'
+    expected_status = 400
+
+
+class TestFirmwareDownloadDeltaInvalidBase(BaseTest):
+    endpoint = 'firmware/accessory/latest/download?from=fourtytwo'
+    method = 'GET'
+    expected_status = 404
@@ -0,0 +1,137 @@
+from base_test import BaseTest, TEST_AUTHORIZATION
+import os
+import requests
+
+
+class ListingTest(BaseTest):
+    method = 'GET'
+    authorization = TEST_AUTHORIZATION
+    expected_status = 200
+
+    def get_next_page(self, continuation_token):
+        # The same query string, with the token appended
+        res = requests.get(
+            os.path.join(self.host, self.endpoint),
+            params={'continuation_token': continuation_token},
+            headers=self._get_headers(),
+        )
+        self.assertEqual(200, res.status_code, msg=res.json().get('message', ''))
+        return res.json()
+
+
+class TestAccessoryListUnauthenticated(BaseTest):
+    endpoint = 'accessory/'
+    method = 'GET'
+    expected_status = 401
+
+
+class TestAccessoryListInvalidPageSize(ListingTest):
+    endpoint = 'accessory/?page_size=0'
+    expected_status = 400
+
+
+class TestAccessoryListPageSizeTooLarge(ListingTest):
+    endpoint = 'accessory/?page_size=501'
+    expected_status = 400
+
+
+class TestAccessoryListNonNumericPageSize(ListingTest):
+    endpoint = 'accessory/?page_size=lots'
+    expected_status = 400
+
+
+class TestAccessoryListUnknownField(ListingTest):
+    endpoint = 'accessory/?fields=mac_address,password'
+    expected_status = 400
+
+
+class TestAccessoryListInvalidFirmwareVersion(ListingTest):
+    endpoint = 'accessory/?firmware_version_lt=fourtytwo'
+    expected_status = 400
+
+
+class TestAccessoryListInvalidBatteryLevel(ListingTest):
+    endpoint = 'accessory/?battery_level_lt=low'
+    expected_status = 400
+
+
+class TestAccessoryListInvalidContinuationToken(ListingTest):
+    endpoint = 'accessory/?continuation_token=notatoken'
+    expected_status = 400
+
+
+class TestAccessoryList(ListingTest):
+    endpoint = 'accessory/?page_size=5&fields=mac_address,firmware_version,battery_level'
+
+    def validate_response(self, body, headers, status):
+        self.assertIn('continuation_token', body)
+        self.assertLessEqual(len(body['accessories']), 5)
+        for accessory in body['accessories']:
+            self.assertEqual({'mac_address', 'firmware_version', 'battery_level'}, set(accessory.keys()))
+
+
+class TestAccessoryListPages(ListingTest):
+    endpoint = 'accessory/?page_size=2&hardware_model=2.1&fields=mac_address,hardware_model'
+
+    def validate_response(self, body, headers, status):
+        # Follow the listing to the end; no accessory is listed twice
+        seen = set()
+        for _ in range(20):
+            for accessory in body['accessories']:
+                self.assertEqual('2.1', accessory['hardware_model'])
+                self.assertNotIn(accessory['mac_address'], seen)
+                seen.add(accessory['mac_address'])
+            if body['continuation_token'] is None:
+                return
+            body = self.get_next_page(body['continuation_token'])
+
+
+class TestAccessoryListMismatchedContinuationToken(ListingTest):
+    endpoint = 'accessory/?page_size=1&hardware_model=2.1'
+
+    def validate_response(self, body, headers, status):
+        if body['continuation_token'] is None:
+            self.skipTest('Only one accessory with this hardware model')
+        # A token from an index listing isn't valid for a scan
+        res = requests.get(
+            os.path.join(self.host, 'accessory/'),
+            params={'continuation_token': body['continuation_token']},
+            headers=self._get_headers(),
+        )
+        self.assertEqual(400, res.status_code)
+
+
+class TestAccessoryListFirmwareVersionRange(ListingTest):
+    endpoint = 'accessory/?hardware_model=2.1&firmware_version_gte=1.0.0&firmware_version_lt=2.0.0' \
+               '&fields=firmware_version'
+
+    def validate_response(self, body, headers, status):
+        for accessory in body['accessories']:
+            self.assertRegex(accessory['firmware_version'], r'^1\.')
+
+
+class TestSensorListUnauthenticated(BaseTest):
+    endpoint = 'sensor/'
+    method = 'GET'
+    expected_status = 401
+
+
+class TestSensorListInvalidPageSize(ListingTest):
+    endpoint = 'sensor/?page_size=0'
+    expected_status = 400
+
+
+class TestSensorListOwnerIdNotSupported(ListingTest):
+    endpoint = 'sensor/?fields=owner_id'
+    expected_status = 400
+
+
+class TestSensorList(ListingTest):
+    endpoint = 'sensor/?page_size=5&fields=mac_address,battery_level&battery_level_lt=0.5'
+
+    def validate_response(self, body, headers, status):
+        self.assertIn('continuation_token', body)
+        self.assertLessEqual(len(body['sensors']), 5)
+        for sensor in body['sensors']:
+            self.assertEqual({'mac_address', 'battery_level'}, set(sensor.keys()))
+            self.assertLess(sensor['battery_level'], 0.5)
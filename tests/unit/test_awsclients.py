@@ -0,0 +1,28 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'apigateway'))
+from botocore.config import Config as BotocoreConfig
+import awsclients
+
+
+class TestBotocoreConfig(unittest.TestCase):
+    def test_build(self):
+        # Raises TypeError if given an option which the installed botocore doesn't have
+        config = awsclients._get_botocore_config()
+        self.assertIsInstance(config, BotocoreConfig)
+        self.assertEqual(25, config.max_pool_connections)
+        self.assertEqual(2, config.connect_timeout)
+        self.assertEqual(10, config.read_timeout)
+
+    def test_supports_tcp_keepalive(self):
+        self.assertFalse(awsclients._supports_tcp_keepalive('1.26.10'))
+        self.assertTrue(awsclients._supports_tcp_keepalive('1.27.0'))
+        self.assertTrue(awsclients._supports_tcp_keepalive('1.31.2'))
+        self.assertTrue(awsclients._supports_tcp_keepalive('2.0.0'))
+        self.assertFalse(awsclients._supports_tcp_keepalive('dev'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'apigateway'))
+import binarycache
+from binarycache import BinaryCache
+
+
+class TestBinaryCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = bytes(range(256)) * 40
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_cache(self, memory_budget):
+        return BinaryCache(memory_budget=memory_budget, directory=self.directory, disk_budget=1024 * 1024)
+
+    def put(self, cache, name='firmware/accessory/1.0.0'):
+        return cache.put(name, '"etag"', [self.data[i:i + 1000] for i in range(0, len(self.data), 1000)])
+
+    def corrupt(self, cached):
+        with open(cached.path, 'r+b') as f:
+            f.seek(5000)
+            f.write(b'\x00\x01\x02')
+
+    def test_read(self):
+        for memory_budget in [0, 1024 * 1024]:
+            cache = self.make_cache(memory_budget)
+            cached = self.put(cache)
+            self.assertIs(cached, cache.get(cached.name))
+            self.assertEqual(len(self.data), cached.size)
+            self.assertEqual(self.data, cache.read(cached))
+            self.assertEqual(self.data[1000:2001], cache.read(cached, 1000, 2000))
+            self.assertEqual(self.data[-10:], cache.read(cached, len(self.data) - 10, len(self.data) + 100))
+
+    def test_read_in_chunks(self):
+        # Ranges which span the chunks which large objects are read from disk in
+        chunk_size = binarycache._READ_CHUNK_SIZE
+        binarycache._READ_CHUNK_SIZE = 1000
+        try:
+            cache = self.make_cache(0)
+            cached = self.put(cache)
+            for start, end in [(0, 999), (999, 1000), (500, 3500), (2000, 2000), (0, None)]:
+                expected = self.data[start:None if end is None else end + 1]
+                self.assertEqual(expected, cache.read(cached, start, end))
+        finally:
+            binarycache._READ_CHUNK_SIZE = chunk_size
+
+    def test_corrupt(self):
+        for memory_budget in [0, 1024 * 1024]:
+            cache = self.make_cache(memory_budget)
+            cached = self.put(cache)
+            self.corrupt(cached)
+            with self.assertRaises(IOError):
+                cache.read(cached, 0, 99)
+            self.assertEqual(1, cache.metrics['checksum_failures'])
+            # So that it is fetched again
+            self.assertIsNone(cache.get(cached.name))
+            self.assertFalse(os.path.exists(cached.path))
+
+    def test_invalidate(self):
+        cache = self.make_cache(1024 * 1024)
+        cached = self.put(cache)
+        cache.read(cached)
+        cache.invalidate(cached.name)
+        self.assertNotIn(cached.name, cache)
+        self.assertIsNone(cache.get(cached.name))
+
+
+if __name__ == '__main__':
+    unittest.main()
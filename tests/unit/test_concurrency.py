@@ -0,0 +1,83 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'apigateway'))
+from concurrency import CancelledException, ConcurrentTimeoutException, TaskGraph, check_cancelled
+
+
+class TestTaskGraph(unittest.TestCase):
+    def test_dependencies(self):
+        graph = TaskGraph()
+        graph.add('a', lambda: 1)
+        graph.add('b', lambda: 2)
+        graph.add('c', lambda a, b: a + b, depends_on=('a', 'b'))
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, graph.run())
+        self.assertEqual({}, graph.failures)
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(ValueError):
+            TaskGraph().add('a', lambda b: b, depends_on=('b',))
+
+    def test_failure_falls_back(self):
+        def fail():
+            raise RuntimeError('Backend unavailable')
+        graph = TaskGraph()
+        graph.add('a', fail, fallback='fallback')
+        graph.add('b', lambda a: a, depends_on=('a',))
+        self.assertEqual({'a': 'fallback', 'b': 'fallback'}, graph.run())
+        self.assertIsInstance(graph.failures['a'], RuntimeError)
+
+    def test_failure_without_fallback_fails_graph(self):
+        def fail():
+            raise RuntimeError('Backend unavailable')
+        graph = TaskGraph().add('a', fail)
+        with self.assertRaises(RuntimeError):
+            graph.run()
+
+    def test_step_timeout_falls_back(self):
+        graph = TaskGraph()
+        graph.add('slow', lambda: time.sleep(1), timeout=0.1, fallback='fallback')
+        graph.add('fast', lambda: 'fast')
+        start = time.monotonic()
+        self.assertEqual({'slow': 'fallback', 'fast': 'fast'}, graph.run())
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertIsInstance(graph.failures['slow'], ConcurrentTimeoutException)
+
+    def test_deadline(self):
+        graph = TaskGraph(deadline=time.monotonic() + 0.1)
+        graph.add('slow', lambda: time.sleep(1), fallback=None)
+        start = time.monotonic()
+        self.assertEqual({'slow': None}, graph.run())
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_deadline_without_fallback_fails_graph(self):
+        graph = TaskGraph(deadline=time.monotonic() + 0.1)
+        graph.add('slow', lambda: time.sleep(1))
+        with self.assertRaises(ConcurrentTimeoutException):
+            graph.run()
+
+    def test_abandoned_step_is_cancelled(self):
+        outcome = []
+        finished = threading.Event()
+
+        def slow():
+            time.sleep(0.3)
+            try:
+                check_cancelled()
+                outcome.append('side effect')
+            except CancelledException:
+                outcome.append('cancelled')
+            finished.set()
+
+        graph = TaskGraph(deadline=time.monotonic() + 0.1)
+        graph.add('slow', slow, fallback=None)
+        graph.run()
+        self.assertTrue(finished.wait(2))
+        self.assertEqual(['cancelled'], outcome)
+
+
+if __name__ == '__main__':
+    unittest.main()
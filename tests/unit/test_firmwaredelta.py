@@ -0,0 +1,70 @@
+import os
+import random
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'apigateway'))
+from firmwaredelta import DeltaTimeoutException, InvalidDeltaException, apply_delta, create_delta, read_header
+
+
+class TestFirmwareDelta(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        self.base = bytes(rng.getrandbits(8) for _ in range(64 * 1024))
+        # A typical new version: a patched region, an insertion and a deletion
+        target = bytearray(self.base)
+        target[1000:1100] = bytes(rng.getrandbits(8) for _ in range(100))
+        target[30000:30000] = b'new code' * 50
+        del target[50000:52000]
+        self.target = bytes(target)
+
+    def assertRoundTrips(self, base, target):
+        delta = create_delta(base, target)
+        self.assertEqual(target, apply_delta(base, delta))
+        return delta
+
+    def test_round_trip(self):
+        delta = self.assertRoundTrips(self.base, self.target)
+        self.assertLess(len(delta), len(self.target) / 10)
+
+    def test_round_trip_identical(self):
+        self.assertRoundTrips(self.base, self.base)
+
+    def test_round_trip_unrelated(self):
+        self.assertRoundTrips(self.base, bytes(reversed(self.base)))
+
+    def test_round_trip_empty(self):
+        self.assertRoundTrips(b'', self.target)
+        self.assertRoundTrips(self.base, b'')
+        self.assertRoundTrips(b'', b'')
+
+    def test_round_trip_short(self):
+        # Shorter than a block, so there is nothing to copy
+        self.assertRoundTrips(b'abc', b'abcd')
+
+    def test_header(self):
+        header = read_header(create_delta(self.base, self.target))
+        self.assertEqual(len(self.base), header['base_size'])
+        self.assertEqual(len(self.target), header['target_size'])
+
+    def test_deadline(self):
+        with self.assertRaises(DeltaTimeoutException):
+            create_delta(self.base, self.target, time.monotonic() - 1)
+        delta = create_delta(self.base, self.target, time.monotonic() + 60)
+        self.assertEqual(self.target, apply_delta(self.base, delta))
+
+    def test_wrong_base(self):
+        delta = create_delta(self.base, self.target)
+        with self.assertRaises(InvalidDeltaException):
+            apply_delta(self.base[:-1] + bytes([self.base[-1] ^ 1]), delta)
+
+    def test_not_a_delta(self):
+        with self.assertRaises(InvalidDeltaException):
+            apply_delta(self.base, self.target)
+        with self.assertRaises(InvalidDeltaException):
+            read_header(b'FWD1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'apigateway'))
+from firmwareversion import get_version_key, parse_version
+
+
+class TestGetVersionKey(unittest.TestCase):
+    # In ascending order of precedence, as in https://semver.org/#spec-item-11
+    versions = [
+        '0.9.0',
+        '1.0.0-alpha',
+        '1.0.0-alpha.1',
+        '1.0.0-alpha.beta',
+        '1.0.0-beta',
+        '1.0.0-beta.2',
+        '1.0.0-beta.11',
+        '1.0.0-rc.1',
+        '1.0.0',
+        '1.0.1',
+        '1.2.0',
+        '1.10.0',
+        '2.0.0-1',
+        '2.0.0-1.1',
+        '2.0.0-a',
+        '2.0.0',
+        '10.0.0',
+    ]
+
+    def test_sorts_in_precedence_order(self):
+        keys = [get_version_key(version) for version in self.versions]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), len(set(keys)))
+
+    def test_matches_semver_comparison(self):
+        for a in self.versions:
+            for b in self.versions:
+                self.assertEqual(
+                    parse_version(a).compare(parse_version(b)) < 0,
+                    get_version_key(a) < get_version_key(b),
+                    msg='{} vs {}'.format(a, b),
+                )
+
+    def test_major_minor_is_patch_zero(self):
+        self.assertEqual(get_version_key('1.2.0'), get_version_key('1.2'))
+
+    def test_invalid_version(self):
+        with self.assertRaises(ValueError):
+            get_version_key('fourtytwo')
+
+
+if __name__ == '__main__':
+    unittest.main()
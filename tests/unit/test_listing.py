@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import base64
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'apigateway'))
+from fathomapi.utils.exceptions import InvalidSchemaException
+from listing import ListQuery, _decode_continuation_token, _encode_continuation_token, get_continuation_token
+
+INDEXES = OrderedDict([
+    ('owner_id', ('owner_id', None)),
+    ('hardware_model', ('hardware_model', 'firmware_version_key')),
+])
+FIELDS = ['id', 'owner_id', 'hardware_model', 'firmware_version', 'battery_level']
+
+
+class TestContinuationToken(unittest.TestCase):
+    def test_round_trip(self):
+        key = {'id': 'AA:BB:CC:DD:EE:FF', 'hardware_model': 'A2', 'firmware_version_key': '0000000001.0000000002'}
+        for index_name in [None, 'hardware_model']:
+            token = _encode_continuation_token(key, index_name)
+            self.assertEqual(key, _decode_continuation_token(token, index_name))
+
+    def test_last_page(self):
+        self.assertIsNone(_encode_continuation_token(None, 'owner_id'))
+        self.assertIsNone(_decode_continuation_token(None, 'owner_id'))
+
+    def test_different_index(self):
+        token = _encode_continuation_token({'id': 'AA:BB:CC:DD:EE:FF', 'owner_id': 'x'}, 'owner_id')
+        with self.assertRaises(InvalidSchemaException):
+            _decode_continuation_token(token, None)
+        with self.assertRaises(InvalidSchemaException):
+            _decode_continuation_token(token, 'hardware_model')
+
+    def test_invalid(self):
+        for token in ['', 'not a token', '!!!!', base64.urlsafe_b64encode(b'[1, 2]').decode('ascii'),
+                      base64.urlsafe_b64encode(b'{"index": null, "key": 1}').decode('ascii'),
+                      base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii')]:
+            with self.assertRaises(InvalidSchemaException, msg=token):
+                _decode_continuation_token(token, None)
+
+    def test_get_continuation_token_scan(self):
+        list_query = ListQuery({}, FIELDS)
+        item = {'id': 'AA:BB:CC:DD:EE:FF', 'owner_id': 'x', 'battery_level': 1}
+        token = get_continuation_token(list_query, INDEXES, ['id'], item)
+        self.assertEqual({'id': 'AA:BB:CC:DD:EE:FF'}, _decode_continuation_token(token, None))
+
+    def test_get_continuation_token_index(self):
+        list_query = ListQuery({'hardware_model': 'A2', 'firmware_version_gte': '1.0.0'}, FIELDS)
+        item = {'id': 'AA:BB:CC:DD:EE:FF', 'owner_id': 'x', 'hardware_model': 'A2', 'firmware_version_key': 'k'}
+        token = get_continuation_token(list_query, INDEXES, ['id'], item)
+        self.assertEqual(
+            {'id': 'AA:BB:CC:DD:EE:FF', 'hardware_model': 'A2', 'firmware_version_key': 'k'},
+            _decode_continuation_token(token, 'hardware_model')
+        )
+
+        # The owner id index is preferred
+        list_query = ListQuery({'owner_id': 'x', 'hardware_model': 'A2'}, FIELDS)
+        token = get_continuation_token(list_query, INDEXES, ['id'], item)
+        self.assertEqual({'id': 'AA:BB:CC:DD:EE:FF', 'owner_id': 'x'}, _decode_continuation_token(token, 'owner_id'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'apigateway'))
+import synclog
+from synclog import decode_sync_records, encode_sync_record
+
+
+def make_record(n, **kwargs):
+    ret = {
+        'accessory_mac_address': 'AA:BB:CC:DD:EE:FF',
+        'event_date': '2026-01-01T00:{:02d}:00Z'.format(n),
+        'accessory_state': '0x01',
+        'accessory_battery_level': 0.9,
+        'sensor1_mac_address': '11:11:11:11:11:11',
+        'sensor1_battery_level': 0.5,
+        'sensor1_memory_level': 0.1,
+        'sensor2_mac_address': '22:22:22:22:22:22',
+        'sensor2_battery_level': 0.6,
+        'wifi_tasks': 3,
+        'wifi_weak': 0,
+    }
+    ret.update(kwargs)
+    return {k: v for k, v in ret.items() if v is not None}
+
+
+def encode_all(records):
+    ret = []
+    state = None
+    for record in records:
+        encoded, state = encode_sync_record(record, state)
+        ret.append(encoded)
+    return ret
+
+
+class TestSyncLog(unittest.TestCase):
+    def setUp(self):
+        self.records = [
+            make_record(0),
+            make_record(1),
+            make_record(2, sensor1_battery_level=0.4, wifi_weak=1),
+            # A field which is no longer reported
+            make_record(3, sensor1_memory_level=None),
+            # The sensors have swapped places
+            make_record(
+                4,
+                sensor1_mac_address='22:22:22:22:22:22', sensor1_battery_level=0.6, sensor1_memory_level=None,
+                sensor2_mac_address='11:11:11:11:11:11', sensor2_battery_level=0.4,
+            ),
+            # A sensor has gone
+            make_record(5, sensor2_mac_address=None, sensor2_battery_level=None),
+        ]
+
+    def test_round_trip(self):
+        self.assertEqual(self.records, list(decode_sync_records(encode_all(self.records))))
+
+    def test_deltas_omit_unchanged_fields(self):
+        encoded = encode_all(self.records)
+        self.assertTrue(encoded[0]['keyframe'])
+        self.assertNotIn('keyframe', encoded[1])
+        self.assertEqual(encoded[0]['event_date'], encoded[1]['base_event_date'])
+        self.assertEqual(
+            [{'mac_address': '11:11:11:11:11:11'}, {'mac_address': '22:22:22:22:22:22'}],
+            encoded[1]['sensors']
+        )
+        self.assertEqual({}, encoded[1]['wifi'])
+        self.assertEqual({'weak': 1}, encoded[2]['wifi'])
+        self.assertEqual(None, encoded[3]['sensors'][0]['memory_level'])
+
+    def test_keyframe_interval(self):
+        interval = synclog.SYNC_LOG_KEYFRAME_INTERVAL
+        records = [make_record(n % 60, accessory_battery_level=n) for n in range(2 * interval + 1)]
+        encoded = encode_all(records)
+        keyframes = [n for n, record in enumerate(encoded) if record.get('keyframe', False)]
+        self.assertEqual([0, interval, 2 * interval], keyframes)
+        self.assertEqual(records, list(decode_sync_records(encoded)))
+
+    def test_decode_from_keyframe(self):
+        interval = synclog.SYNC_LOG_KEYFRAME_INTERVAL
+        records = [make_record(n % 60, accessory_battery_level=n) for n in range(interval + 2)]
+        encoded = encode_all(records)
+        self.assertEqual(records[interval:], list(decode_sync_records(encoded[interval:])))
+
+    def test_decode_without_base(self):
+        # Only the fields which changed since the missing base record are known
+        encoded = encode_all(self.records)
+        decoded = list(decode_sync_records(encoded[2:3]))[0]
+        self.assertEqual(0.4, decoded['sensor1_battery_level'])
+        self.assertNotIn('sensor1_memory_level', decoded)
+        self.assertEqual(self.records[2]['accessory_battery_level'], decoded['accessory_battery_level'])
+
+    def test_invalid_state(self):
+        # eg if it has been overwritten; the next record is a keyframe instead
+        states = [
+            '', 'not json', '[]', '{"frames": 1}',
+            '{"event_date": "x", "frames": "1", "sensors": [], "wifi": {}}',
+        ]
+        for state in states:
+            encoded, next_state = encode_sync_record(self.records[1], state)
+            self.assertTrue(encoded['keyframe'], msg=state)
+            self.assertEqual([self.records[1]], list(decode_sync_records([encoded])))
+            encoded, _ = encode_sync_record(self.records[2], next_state)
+            self.assertNotIn('keyframe', encoded)
+
+    def test_v1_records(self):
+        encoded = encode_all(self.records[2:])
+        mixed = self.records[:2] + encoded
+        self.assertEqual(self.records, list(decode_sync_records(mixed)))
+
+
+if __name__ == '__main__':
+    unittest.main()
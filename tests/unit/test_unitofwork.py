@@ -0,0 +1,100 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'apigateway'))
+from fathomapi.utils.exceptions import NoSuchEntityException, NoUpdatesException
+from unitofwork import UnitOfWork
+
+
+class FakeEntity:
+    def __init__(self, id):
+        self.primary_key = {'id': id}
+
+
+class TestUnitOfWork(unittest.TestCase):
+    def setUp(self):
+        self.unit_of_work = UnitOfWork()
+        self.writes = []
+
+    def _writer(self, body, defaults):
+        self.writes.append((body, defaults))
+        return dict(defaults, **body)
+
+    def test_load_once(self):
+        loads = []
+        loader = lambda: loads.append(1) or {'id': 1, 'a': 1}
+        self.assertEqual({'id': 1, 'a': 1}, self.unit_of_work.load(FakeEntity(1), loader))
+        self.assertEqual({'id': 1, 'a': 1}, self.unit_of_work.load(FakeEntity(1), loader))
+        self.assertEqual(1, len(loads))
+
+    def test_load_returns_a_copy(self):
+        self.unit_of_work.load(FakeEntity(1), lambda: {'id': 1, 'a': [1]})['a'].append(2)
+        self.assertEqual({'id': 1, 'a': [1]}, self.unit_of_work.load(FakeEntity(1), lambda: None))
+
+    def test_load_missing(self):
+        def loader():
+            raise NoSuchEntityException()
+        with self.assertRaises(NoSuchEntityException):
+            self.unit_of_work.load(FakeEntity(1), loader)
+        with self.assertRaises(NoSuchEntityException):
+            self.unit_of_work.load(FakeEntity(1), lambda: self.fail('Loaded twice'))
+
+    def test_writes_merged(self):
+        self.unit_of_work.write(FakeEntity(1), {'a': 1, 'b': 1}, self._writer, {'id': 1, 'a': 1, 'b': 1})
+        self.unit_of_work.write(FakeEntity(1), {'b': 2}, self._writer, {'id': 1, 'a': 1, 'b': 2})
+        self.unit_of_work.write(FakeEntity(2), {'a': 3}, self._writer, {'id': 2, 'a': 3})
+        self.assertEqual([], self.writes)
+        # Reads see the buffered state
+        self.assertEqual({'id': 1, 'a': 1, 'b': 2}, self.unit_of_work.load(FakeEntity(1), lambda: self.fail()))
+
+        self.unit_of_work.flush()
+        self.assertCountEqual([({'a': 1, 'b': 2}, {}), ({'a': 3}, {})], self.writes)
+
+    def test_defaults_merged(self):
+        self.unit_of_work.write(FakeEntity(1), {'a': 1}, self._writer, {}, {'created_date': 'first'})
+        self.unit_of_work.write(FakeEntity(1), {'b': 2}, self._writer, {}, {'created_date': 'second', 'c': 3})
+        self.unit_of_work.flush()
+        self.assertEqual([({'a': 1, 'b': 2}, {'created_date': 'first', 'c': 3})], self.writes)
+
+    def test_no_updates(self):
+        def writer(body, defaults):
+            raise NoUpdatesException()
+        self.unit_of_work.write(FakeEntity(1), {'a': 1}, writer, {'id': 1, 'a': 1})
+        self.unit_of_work.flush()
+        self.assertEqual({'id': 1, 'a': 1}, self.unit_of_work.load(FakeEntity(1), lambda: self.fail()))
+
+    def test_deferred_after_writes(self):
+        events = []
+        self.unit_of_work.defer('outbox', lambda items: events.append(('send', items)), 'm1')
+        self.unit_of_work.write(FakeEntity(1), {'a': 1}, lambda body, defaults: events.append('write'), {})
+        self.unit_of_work.defer('outbox', lambda items: events.append(('send', items)), 'm2')
+        self.unit_of_work.flush()
+        self.assertEqual(['write', ('send', ['m1', 'm2'])], events)
+
+    def test_after_flush(self):
+        self.unit_of_work.flush()
+        sent = []
+        self.unit_of_work.defer('outbox', sent.extend, 'm1')
+        self.unit_of_work.write(FakeEntity(1), {'a': 1}, self._writer, {'id': 1, 'a': 1})
+        # Performed straight away, rather than lost
+        self.assertEqual(['m1'], sent)
+        self.assertEqual([({'a': 1}, {})], self.writes)
+
+    def test_concurrent_writes(self):
+        def write(thread):
+            for i in range(100):
+                self.unit_of_work.write(FakeEntity(1), {'{}_{}'.format(thread, i): i}, self._writer, {})
+        threads = [threading.Thread(target=write, args=(thread,)) for thread in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.unit_of_work.flush()
+        self.assertEqual(1, len(self.writes))
+        self.assertEqual(800, len(self.writes[0][0]))
+
+
+if __name__ == '__main__':
+    unittest.main()